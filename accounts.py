@@ -0,0 +1,8 @@
+# Account rules shared by the app (actions.py) and the roster import
+# (roster.py), kept apart from both so neither pulls in the other
+
+
+def is_edu_email(email):
+    # Check if email ends with .edu or similar educational domains
+    edu_domains = ['.edu', '.ac.', '.edu.']
+    return any(domain in email.lower() for domain in edu_domains)
@@ -0,0 +1,180 @@
+import os
+import sqlite3
+from datetime import datetime
+
+import blobstore
+import cache
+import chat
+import metrics
+import recommend
+import shards
+import writer
+from accounts import is_edu_email
+
+# What the app and api.py let people do to projects, chat, messages, files
+# and memberships, without Streamlit. Each call takes a connection to the
+# project's shard (shards.project_connection), or to the user's own for
+# create_project, checks who is asking, and raises ActionError with a message
+# fit to show them when it can't go ahead.
+
+ROLES = ("Student", "Teacher")
+FILE_TYPES = ("pdf", "docx", "txt", "png", "jpg", "jpeg", "csv", "xlsx")
+
+
+class ActionError(ValueError):
+    pass
+
+
+class NotFound(ActionError):
+    pass
+
+
+class Forbidden(ActionError):
+    pass
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def login(email):
+    user_id = shards.find_user(email.strip())
+    if not user_id:
+        raise NotFound("User not found")
+    return user_id
+
+
+def register(name, email, institution, role):
+    if not is_edu_email(email):
+        raise ActionError("Please use an educational email address")
+    if role not in ROLES:
+        raise ActionError(f"Role must be one of: {', '.join(ROLES)}")
+    try:
+        user_id = shards.register_user(name, email, institution, role, datetime.now().strftime("%Y-%m-%d"))
+    except sqlite3.IntegrityError:
+        raise ActionError("An account with this email already exists")
+    cache.bump('users')
+    return user_id
+
+
+# A user's own profile: name, institution, role, skills and picture (the
+# value avatars.process_upload() returned, or the one they have). The rows
+# go through the write-behind writer together; the caches and the user's
+# copies on other shards follow once they are committed.
+def update_profile(conn, user_id, name, institution, role, skills=(), profile_pic=None):
+    if not name.strip():
+        raise ActionError("Name is required")
+    if role not in ROLES:
+        raise ActionError(f"Role must be one of: {', '.join(ROLES)}")
+    if cache.get_cache().user(conn, user_id) is None:
+        raise NotFound("User not found")
+    writes = writer.get_writer()
+    pending = [writes.submit("UPDATE users SET name=?, institution=?, role=?, profile_pic=? WHERE id=?",
+                             (name.strip(), institution, role, profile_pic, user_id))]
+    pending += [writes.submit(sql, params) for sql, params in recommend.user_skill_writes(user_id, skills)]
+    for future in pending:
+        future.result()
+    cache.bump('users')
+    shards.user_changed(user_id)
+    recommend.get_index().user_changed(conn, user_id)
+
+
+# (id, title, description, created_by, created_date)
+def project(conn, project_id):
+    row = cache.get_cache().project(conn, project_id)
+    if row is None:
+        raise NotFound("Project not found")
+    return row
+
+
+def is_member(conn, user_id, project_id):
+    return project_id in cache.get_cache().member_of(conn, user_id)
+
+
+def can_upload(conn, user_id, project_id):
+    return is_member(conn, user_id, project_id) or project(conn, project_id)[3] == user_id
+
+
+# The project goes on the current shard, the creator's own, with the creator
+# as its first member. Returns the new project's id.
+def create_project(conn, user_id, title, description, skills=(), max_members=None):
+    if not title.strip():
+        raise ActionError("Project title is required")
+    c = conn.cursor()
+    c.execute("INSERT INTO projects (id, title, description, created_by, created_date, max_members) VALUES (?, ?, ?, ?, ?, ?)",
+              (shards.new_project_id(), title, description, user_id, datetime.now().strftime("%Y-%m-%d"), max_members))
+    project_id = c.lastrowid
+    c.execute("INSERT INTO project_members (project_id, user_id) VALUES (?, ?)", (project_id, user_id))
+    recommend.set_project_skills(conn, project_id, skills)
+    conn.commit()
+    cache.bump('projects', 'project_members')
+    recommend.get_index().project_changed(conn, project_id)
+    return project_id
+
+
+def _add_member(conn, project_id, user_id):
+    shards.ensure_member_row(project_id, user_id)
+    writer.get_writer().execute("INSERT OR IGNORE INTO project_members (project_id, user_id) VALUES (?, ?)",
+                                (project_id, user_id))
+    cache.bump('project_members')
+    recommend.get_index().project_changed(conn, project_id)
+
+
+# False if the user was a member already
+def join_project(conn, user_id, project_id):
+    project(conn, project_id)
+    if is_member(conn, user_id, project_id):
+        return False
+    _add_member(conn, project_id, user_id)
+    return True
+
+
+# The creator adds someone by email. False if they were a member already.
+def invite(conn, user_id, project_id, email):
+    if project(conn, project_id)[3] != user_id:
+        raise Forbidden("Only the project's creator can invite people")
+    invited = shards.find_user(email.strip())
+    if not invited:
+        raise NotFound("No user found with that email.")
+    if invited in cache.get_cache().members(conn, project_id):
+        return False
+    _add_member(conn, project_id, invited)
+    return True
+
+
+# Returns the message as (id, message, sender_name, sent_date)
+def send_chat(conn, user_id, project_id, text):
+    if not text.strip():
+        raise ActionError("Cannot send an empty message.")
+    project(conn, project_id)
+    return chat.get_service().send(conn, project_id, user_id, text)
+
+
+# Messages are for members. Returns the message as (id, message,
+# sender_name, sent_date), like data.message_page().
+def send_message(conn, user_id, project_id, text):
+    if not text.strip():
+        raise ActionError("Cannot send an empty message.")
+    project(conn, project_id)
+    if not is_member(conn, user_id, project_id):
+        raise Forbidden("Only members can message this project")
+    sent_date = _now()
+    msg_id, _ = writer.get_writer().execute(
+        "INSERT INTO messages (project_id, sender_id, message, sent_date) VALUES (?, ?, ?, ?)",
+        (project_id, user_id, text, sent_date), result=True)
+    sender = cache.get_cache().user(conn, user_id)
+    return (msg_id, text, sender[1] if sender else None, sent_date)
+
+
+# Members and the creator can upload. False if the project has this file
+# under this name already.
+def upload_file(conn, user_id, project_id, filename, fileobj):
+    filename = os.path.basename((filename or "").replace("\\", "/")).strip()
+    if not filename:
+        raise ActionError("File name is required")
+    if filename.rsplit(".", 1)[-1].lower() not in FILE_TYPES:
+        raise ActionError(f"Allowed file types: {', '.join(FILE_TYPES)}")
+    if not can_upload(conn, user_id, project_id):
+        raise Forbidden("Only members can upload files to this project")
+    with metrics.timed("file_upload"):
+        return blobstore.add_project_file(conn, project_id, user_id, filename, fileobj)
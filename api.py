@@ -0,0 +1,600 @@
+import argparse
+import asyncio
+import base64
+import contextvars
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import re
+import secrets
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
+
+import actions
+import avatars
+import blobstore
+import cache
+import chat
+import data
+import db
+import metrics
+import migrations
+import recommend
+import shards
+import writer
+
+# A JSON API over actions.py and the data layer, for mobile apps and LMS
+# integrations. One asyncio loop holds every connection; database work runs on
+# a small thread pool, so an idle or waiting client costs a socket rather
+# than a thread and a Streamlit session. Start it inside the app
+# (EDUCOLLAB_API_PORT) to share the app's lookup cache and live chat, or on
+# its own with `python api.py`: it then sees the app's writes once cached
+# entries expire, and app chat feeds see its messages when they next reload.
+API_PORT = int(os.environ.get("EDUCOLLAB_API_PORT", "0"))
+# Signs login tokens; without it, tokens only last as long as the process
+API_SECRET = os.environ.get("EDUCOLLAB_API_SECRET") or secrets.token_hex(32)
+TOKEN_TTL = 30 * 86400
+# Threads doing database work; requests beyond that wait on the loop
+WORKERS = db.POOL_SIZE
+# Requests waiting for a worker before new ones get 503
+MAX_PENDING = 2000
+BACKLOG = 1024
+MAX_BODY = 1024 * 1024
+MAX_UPLOAD = 50 * 1024 * 1024
+MAX_HEADERS = 100
+IDLE_TIMEOUT = 30
+MAX_PAGE = 100
+# Longest a chat long poll (?wait=) is held open
+MAX_WAIT = 30
+
+log = logging.getLogger("educollab.api")
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# -- tokens: "<user_id>.<issued>.<signature>", checked without any lookup
+
+def _sign(payload):
+    return hmac.new(API_SECRET.encode(), payload.encode(), hashlib.sha256).hexdigest()
+
+
+def make_token(user_id, issued=None):
+    payload = f"{user_id}.{int(issued or time.time())}"
+    return f"{payload}.{_sign(payload)}"
+
+
+def token_user(token):
+    user_id, _, rest = (token or "").partition(".")
+    issued, _, signature = rest.partition(".")
+    if not (user_id.isdigit() and issued.isdigit()):
+        return None
+    if not hmac.compare_digest(signature, _sign(f"{user_id}.{issued}")) or time.time() - int(issued) > TOKEN_TTL:
+        return None
+    return int(user_id)
+
+
+# -- requests
+
+class Request:
+    __slots__ = ('method', 'path', 'query', 'headers', 'body', 'user_id')
+
+    def __init__(self, method, path, query, headers, body, user_id=None):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+        self.user_id = user_id
+
+    def json(self):
+        if not self.body:
+            return {}
+        try:
+            body = json.loads(self.body)
+        except ValueError:
+            raise HTTPError(400, "Body is not valid JSON")
+        if not isinstance(body, dict):
+            raise HTTPError(400, "Body must be a JSON object")
+        return body
+
+    def int_arg(self, name, default=None, low=None, high=None):
+        value = self.query.get(name)
+        if value in (None, ""):
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            raise HTTPError(400, f"{name} must be a number")
+        if low is not None:
+            value = max(value, low)
+        return min(value, high) if high is not None else value
+
+    def limit(self, default):
+        return self.int_arg("limit", default, 1, MAX_PAGE)
+
+    # The ?cursor= a previous page handed out. Clients send it back, so it
+    # must have the `shape` this endpoint's cursors have: one type, or a type
+    # per item of a pair.
+    def cursor(self, *shape):
+        value = self.query.get("cursor")
+        if not value:
+            return None
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(value.encode() + b"=" * (-len(value) % 4)))
+        except ValueError:
+            raise HTTPError(400, "Bad cursor")
+        if len(shape) == 1:
+            valid = _is(cursor, shape[0])
+        else:
+            valid = (isinstance(cursor, list) and len(cursor) == len(shape)
+                     and all(_is(item, types) for item, types in zip(cursor, shape)))
+        if not valid:
+            raise HTTPError(400, "Bad cursor")
+        return cursor
+
+
+# isinstance(), except that JSON true/false are not numbers
+def _is(value, types):
+    return isinstance(value, types) and not isinstance(value, bool)
+
+
+def _cursor(value):
+    if value is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+
+def _text(body, name, required=True):
+    value = body.get(name)
+    if value is None and not required:
+        return ""
+    if not isinstance(value, str) or (required and not value.strip()):
+        raise HTTPError(400, f"{name} is required")
+    return value
+
+
+# -- JSON shapes
+
+def _user(row, email=False):
+    user = {'id': row[0], 'name': row[1], 'institution': row[3], 'role': row[4], 'avatar': avatars.avatar_url(row[6], 48)}
+    if email:
+        user['email'] = row[2]
+    return user
+
+
+def _project(row):
+    return {'id': row[0], 'title': row[1], 'description': row[2], 'created_by': row[3], 'created_date': row[4]}
+
+
+def _message(row):
+    return {'id': row[0], 'message': row[1], 'sender': row[2], 'sent_date': row[3]}
+
+
+def _file(project_id, row):
+    filename, uploader, upload_date, sha256, size = row
+    url = blobstore.file_url(sha256, filename) if sha256 else f"project_uploads/{project_id}_{filename}"
+    return {'filename': filename, 'uploader': uploader, 'upload_date': upload_date, 'size': size, 'url': url}
+
+
+# -- routes. Handlers run on a worker thread with the user's shard current
+# and return a JSON-able value, or (status, value). Async handlers run on the
+# loop and hand database work to api.run().
+
+ROUTES = []
+
+
+def route(method, pattern, auth=True, max_body=MAX_BODY):
+    def register(handler):
+        ROUTES.append((method, re.compile(pattern + "$"), handler, auth, max_body))
+        return handler
+    return register
+
+
+@route("GET", "/api/health", auth=False)
+def health(request):
+    return {'ok': True}
+
+
+@route("POST", "/api/login", auth=False)
+def login(request):
+    user_id = actions.login(_text(request.json(), "email"))
+    shards.bind(user_id)
+    with db.connection() as conn:
+        user = cache.get_cache().user(conn, user_id)
+    return {'token': make_token(user_id), 'user': _user(user, email=True)}
+
+
+@route("POST", "/api/register", auth=False)
+def register(request):
+    body = request.json()
+    user_id = actions.register(_text(body, "name"), _text(body, "email"), _text(body, "institution", False),
+                               body.get("role") or "Student")
+    return 201, {'token': make_token(user_id), 'id': user_id}
+
+
+@route("GET", "/api/me")
+def me(request):
+    with db.connection() as conn:
+        user = cache.get_cache().user(conn, request.user_id)
+        if user is None:
+            raise actions.NotFound("User not found")
+        return dict(_user(user, email=True), skills=recommend.user_skills(conn, request.user_id),
+                    projects=sorted(cache.get_cache().member_of(conn, request.user_id)))
+
+
+# Change any of name, institution, role and skills; the rest stay as they are
+@route("POST", "/api/me")
+def update_me(request):
+    body = request.json()
+    skills = body.get("skills")
+    if skills is not None and (not isinstance(skills, list) or not all(isinstance(s, str) for s in skills)):
+        raise HTTPError(400, "skills must be a list of names")
+    with db.connection() as conn:
+        user = cache.get_cache().user(conn, request.user_id)
+        if user is None:
+            raise actions.NotFound("User not found")
+        actions.update_profile(conn, request.user_id,
+                               _text(body, "name") if "name" in body else user[1],
+                               _text(body, "institution", False) if "institution" in body else user[3],
+                               body.get("role") or user[4],
+                               recommend.user_skills(conn, request.user_id) if skills is None else skills,
+                               user[6])
+    return me(request)
+
+
+@route("GET", "/api/me/projects")
+def my_projects(request):
+    with db.connection() as conn:
+        rows = shards.my_projects(conn, request.user_id)
+    return {'projects': [dict(_project(row), member_count=row[5]) for row in rows]}
+
+
+@route("GET", "/api/me/recommendations")
+def recommendations(request):
+    with db.connection() as conn:
+        matches = recommend.get_index().for_user(conn, request.user_id, request.limit(recommend.TOP_K))
+        projects = cache.get_cache().projects(conn, [pid for pid, _ in matches])
+    return {'projects': [dict(_project(projects[pid]), score=score) for pid, score in matches if pid in projects]}
+
+
+@route("GET", "/api/projects")
+def browse(request):
+    text = request.query.get("q")
+    # Searches page on (rank, id), the newest-first list on the project id
+    cursor = request.cursor((int, float), int) if text else request.cursor(int)
+    with db.connection() as conn:
+        rows, next_cursor = shards.browse_projects(conn, text, cursor, request.limit(data.PAGE_SIZE))
+    return {'projects': [dict(_project(row), creator=row[5], snippet=row[6]) for row in rows],
+            'cursor': _cursor(next_cursor)}
+
+
+@route("POST", "/api/projects")
+def create_project(request):
+    body = request.json()
+    skills = body.get("skills") or []
+    max_members = body.get("max_members")
+    if not isinstance(skills, list) or not all(isinstance(s, str) for s in skills):
+        raise HTTPError(400, "skills must be a list of names")
+    if max_members is not None and (not isinstance(max_members, int) or max_members < 1):
+        raise HTTPError(400, "max_members must be a positive number")
+    with db.connection() as conn:
+        project_id = actions.create_project(conn, request.user_id, _text(body, "title"),
+                                            _text(body, "description", False), skills, max_members)
+    return 201, {'id': project_id}
+
+
+@route("GET", r"/api/projects/(\d+)")
+def project(request, project_id):
+    with shards.project_connection(project_id) as conn:
+        row = actions.project(conn, project_id)
+        lookups = cache.get_cache()
+        members = lookups.users(conn, lookups.members(conn, project_id))
+        return dict(_project(row), skills=recommend.project_skills(conn, project_id),
+                    members=[_user(user) for user in members.values()],
+                    is_member=request.user_id in members)
+
+
+@route("POST", r"/api/projects/(\d+)/join")
+def join(request, project_id):
+    with shards.project_connection(project_id) as conn:
+        return {'joined': actions.join_project(conn, request.user_id, project_id)}
+
+
+@route("POST", r"/api/projects/(\d+)/members")
+def invite(request, project_id):
+    with shards.project_connection(project_id) as conn:
+        return {'added': actions.invite(conn, request.user_id, project_id, _text(request.json(), "email"))}
+
+
+def _chat_page(request, project_id, after):
+    with shards.project_connection(project_id) as conn:
+        actions.project(conn, project_id)
+        service = chat.get_service()
+        if after is None:
+            rows = service.recent(conn, project_id, request.limit(chat.HISTORY))
+        else:
+            rows = service.since(conn, project_id, after, request.limit(MAX_PAGE))
+    return {'messages': [_message(row) for row in rows], 'after': rows[-1][0] if rows else after}
+
+
+# The latest messages, or those after ?after=<id>. With ?wait=<seconds> an
+# empty answer is held until something is sent (or the wait runs out),
+# without tying up a worker meanwhile.
+@route("GET", r"/api/projects/(\d+)/chat")
+async def chat_messages(api, request, project_id):
+    after = request.int_arg("after")
+    wait = request.int_arg("wait", 0, 0, MAX_WAIT)
+    if after is None or not wait:
+        return await api.run(_chat_page, request, project_id, after)
+    loop = asyncio.get_running_loop()
+    sent = asyncio.Event()
+    # Subscribed before the first read, so nothing sent in between is missed
+    subscription = chat.get_service().hub.subscribe(('chat', project_id),
+                                                    notify=lambda: loop.call_soon_threadsafe(sent.set))
+    try:
+        page = await api.run(_chat_page, request, project_id, after)
+        if page['messages']:
+            return page
+        try:
+            await asyncio.wait_for(sent.wait(), wait)
+        except asyncio.TimeoutError:
+            return page
+        return await api.run(_chat_page, request, project_id, after)
+    finally:
+        subscription.close()
+
+
+@route("POST", r"/api/projects/(\d+)/chat")
+def send_chat(request, project_id):
+    with shards.project_connection(project_id) as conn:
+        return 201, _message(actions.send_chat(conn, request.user_id, project_id, _text(request.json(), "message")))
+
+
+# Members only, newest first; pass back `cursor` for older pages
+@route("GET", r"/api/projects/(\d+)/messages")
+def messages(request, project_id):
+    limit = request.limit(data.MESSAGE_PAGE)
+    before = request.cursor(str, int)
+    with shards.project_connection(project_id) as conn:
+        actions.project(conn, project_id)
+        if not actions.is_member(conn, request.user_id, project_id):
+            raise actions.Forbidden("Only members can read this project's messages")
+        rows = data.message_page(conn, project_id, before, limit)
+    return {'messages': [_message(row) for row in rows],
+            'cursor': _cursor((rows[-1][3], rows[-1][0])) if len(rows) == limit else None}
+
+
+@route("POST", r"/api/projects/(\d+)/messages")
+def send_message(request, project_id):
+    with shards.project_connection(project_id) as conn:
+        return 201, _message(actions.send_message(conn, request.user_id, project_id,
+                                                  _text(request.json(), "message")))
+
+
+@route("GET", r"/api/projects/(\d+)/files")
+def files(request, project_id):
+    with shards.project_connection(project_id) as conn:
+        actions.project(conn, project_id)
+        return {'files': [_file(project_id, row) for row in data.project_files(conn, project_id)]}
+
+
+# The file's bytes are the request body; its name goes in ?filename=
+@route("POST", r"/api/projects/(\d+)/files", max_body=MAX_UPLOAD)
+def upload(request, project_id):
+    with shards.project_connection(project_id) as conn:
+        added = actions.upload_file(conn, request.user_id, project_id, request.query.get("filename"),
+                                    io.BytesIO(request.body))
+    return 201 if added else 200, {'added': added}
+
+
+# -- errors
+
+def _error(e):
+    if isinstance(e, HTTPError):
+        return e.status, str(e)
+    if isinstance(e, actions.NotFound):
+        return 404, str(e)
+    if isinstance(e, actions.Forbidden):
+        return 403, str(e)
+    if isinstance(e, actions.ActionError):
+        return 400, str(e)
+    if isinstance(e, writer.QueueFull):
+        return 503, str(e)
+    log.error("unhandled %s", type(e).__name__, exc_info=e)
+    return 500, "Internal error"
+
+
+def _call(handler, request, args):
+    with metrics.request(f"API {handler.__name__.lstrip('_')}"):
+        shards.bind(request.user_id)
+        return handler(request, *args)
+
+
+# -- server
+
+class APIServer:
+    def __init__(self, workers=WORKERS, max_pending=MAX_PENDING):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="api")
+        self.max_pending = max_pending
+        self.pending = 0
+        self._counts = {'connections': 0, 'requests': 0, 'errors': 0, 'rejected': 0}
+
+    # Run a sync handler on a worker, with the request's user's shard current
+    async def run(self, handler, request, *args):
+        context = contextvars.copy_context()
+        if self.pending >= self.max_pending:
+            self._counts['rejected'] += 1
+            raise HTTPError(503, "The server is busy; please try again in a moment.")
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, context.run, _call, handler,
+                                                                    request, args)
+        finally:
+            self.pending -= 1
+
+    def run_forever(self, sock):
+        asyncio.run(self._serve(sock))
+
+    async def _serve(self, sock):
+        server = await asyncio.start_server(self._connection, sock=sock, backlog=BACKLOG)
+        async with server:
+            await server.serve_forever()
+
+    async def _connection(self, reader, out):
+        self._counts['connections'] += 1
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not line:
+                    break
+                keep_alive = await self._request(line, reader, out)
+                await out.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            out.close()
+
+    # Read one request, answer it, and say whether the connection stays open
+    async def _request(self, line, reader, out):
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            self._respond(out, 400, {'error': "Bad request line"}, False)
+            return False
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= MAX_HEADERS:
+                self._respond(out, 431, {'error': "Too many headers"}, False)
+                return False
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        self._counts['requests'] += 1
+
+        url = urlsplit(target)
+        found, allowed = None, False
+        for route_method, pattern, handler, auth, max_body in ROUTES:
+            match = pattern.match(url.path)
+            if match:
+                allowed = True
+                if route_method == method:
+                    found = (handler, auth, max_body, [int(arg) for arg in match.groups()])
+                    break
+        if "transfer-encoding" in headers:
+            self._respond(out, 411, {'error': "Send a Content-Length"}, False)
+            return False
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0 or (found and length > found[2]) or (not found and length > MAX_BODY):
+            self._respond(out, 413, {'error': "Request body too large"}, False)
+            return False
+        if found and length and headers.get("expect", "").lower() == "100-continue":
+            out.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        body = await reader.readexactly(length) if length else b""
+        if found is None:
+            self._respond(out, 405 if allowed else 404, {'error': "Method not allowed" if allowed else "Not found"},
+                          keep_alive)
+            return keep_alive
+
+        handler, auth, _, args = found
+        request = Request(method, url.path, dict(parse_qsl(url.query)), headers, body)
+        if auth:
+            scheme, _, token = headers.get("authorization", "").partition(" ")
+            request.user_id = token_user(token.strip()) if scheme.lower() == "bearer" else None
+            if request.user_id is None:
+                self._respond(out, 401, {'error': "Log in first: POST /api/login"}, keep_alive)
+                return keep_alive
+        try:
+            if asyncio.iscoroutinefunction(handler):
+                result = await handler(self, request, *args)
+            else:
+                result = await self.run(handler, request, *args)
+            status, payload = result if isinstance(result, tuple) else (200, result)
+        except Exception as e:
+            status, message = _error(e)
+            payload = {'error': message}
+            self._counts['errors'] += 1
+        self._respond(out, status, payload, keep_alive)
+        return keep_alive
+
+    def _respond(self, out, status, payload, keep_alive):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        out.write((f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                   f"Content-Type: application/json; charset=utf-8\r\n"
+                   f"Content-Length: {len(body)}\r\n"
+                   f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode("latin-1") + body)
+
+    def stats(self):
+        return dict(self._counts, pending=self.pending)
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+# Serve the API from inside the app process, once, if a port is configured
+def start_server(port=None, host="localhost"):
+    global _server
+    port = port or API_PORT
+    if not port or _server is not None:
+        return _server
+    with _server_lock:
+        if _server is None:
+            try:
+                sock = socket.create_server((host, port), backlog=BACKLOG)
+            except OSError:
+                return None
+            _server = APIServer()
+            threading.Thread(target=_server.run_forever, args=(sock,), name="api-server", daemon=True).start()
+    return _server
+
+
+def api_stats():
+    return _server.stats() if _server is not None else {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the JSON API.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=API_PORT or 8503)
+    parser.add_argument("--workers", type=int, default=WORKERS, help="threads doing database work")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    if not db.SHARD_DIR:
+        migrations.migrate()
+    metrics.start_server()
+    sock = socket.create_server((args.host, args.port), backlog=BACKLOG)
+    print(f"Serving the JSON API on http://{args.host}:{args.port}/api/")
+    global _server
+    _server = APIServer(args.workers)
+    try:
+        _server.run_forever(sock)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
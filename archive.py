@@ -0,0 +1,348 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import cache
+import db
+import migrations
+
+try:
+    import zstandard
+except ImportError:  # zlib is always there; zstd only packs a little tighter
+    zstandard = None
+
+# Chat and messages older than this move into compressed monthly blocks
+ARCHIVE_AFTER_DAYS = int(os.environ.get("EDUCOLLAB_ARCHIVE_AFTER_DAYS", "180"))
+# Hours between archive runs inside the app; 0 leaves it to cron
+# (python archive.py run)
+ARCHIVE_EVERY_HOURS = float(os.environ.get("EDUCOLLAB_ARCHIVE_EVERY_HOURS", "0"))
+CODEC = "zstd" if zstandard else "zlib"
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = 19
+# Pages handed back per incremental_vacuum step; writers get the lock in
+# between steps
+VACUUM_STEP = 2000
+# Decoded blocks kept in memory: paging back reads the same block a few times
+BLOCK_CACHE_SIZE = 64
+# The archived tables, and the columns a block keeps of each row
+SOURCES = ("project_chat", "messages")
+COLUMNS = "id, sender_id, message, sent_date"
+
+
+def compress(data, codec=CODEC):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def decompress(payload, codec):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("archived messages are zstd-compressed; pip install zstandard to read them")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return zlib.decompress(payload)
+
+
+def _next_month(month):
+    year, mon = map(int, month.split("-"))
+    return f"{year + mon // 12:04d}-{mon % 12 + 1:02d}"
+
+
+class BlockCache:
+    def __init__(self, size=BLOCK_CACHE_SIZE):
+        self.size = size
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    # A block's rows as [id, sender_id, message, sent_date] lists, oldest
+    # first. Blocks never change once written: a merge writes a new one under
+    # a new id (archive_blocks.id is AUTOINCREMENT), so (project_id, block_id)
+    # is a safe key, on every shard.
+    def rows(self, conn, project_id, block_id):
+        key = (project_id, block_id)
+        with self._lock:
+            rows = self._blocks.get(key)
+            if rows is not None:
+                self._blocks.move_to_end(key)
+                self._stats['hits'] += 1
+                return rows
+            self._stats['misses'] += 1
+        codec, payload = conn.execute("SELECT codec, payload FROM archive_blocks WHERE id=?", (block_id,)).fetchone()
+        rows = json.loads(decompress(payload, codec))
+        with self._lock:
+            self._blocks[key] = rows
+            while len(self._blocks) > self.size:
+                self._blocks.popitem(last=False)
+        return rows
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, blocks=len(self._blocks))
+
+    def discard(self, project_id, block_id):
+        with self._lock:
+            self._blocks.pop((project_id, block_id), None)
+
+
+_blocks = BlockCache()
+_counts = {'runs': 0, 'rows': 0, 'blocks': 0, 'raw_bytes': 0, 'stored_bytes': 0, 'vacuumed_pages': 0,
+           'seconds': 0.0, 'last_run': None}
+_counts_lock = threading.Lock()
+
+
+# -- reading
+
+# A project's archived rows older than `before` ((sent_date, id), or None for
+# the newest), newest first, as (id, message, sender_name, sent_date) like the
+# live tables. Blocks are read newest month first and only as far back as
+# `limit` needs.
+def page(conn, source, project_id, before=None, limit=50):
+    sql = "SELECT id FROM archive_blocks WHERE source=? AND project_id=?"
+    params = [source, project_id]
+    if before is not None:
+        sql += " AND first_date <= ?"
+        params.append(before[0])
+    blocks = [row[0] for row in conn.execute(sql + " ORDER BY month DESC", params).fetchall()]
+    found = []
+    for block_id in blocks:
+        for row in reversed(_blocks.rows(conn, project_id, block_id)):
+            if before is None or (row[3], row[0]) < tuple(before):
+                found.append(row)
+                if len(found) == limit:
+                    break
+        if len(found) == limit:
+            break
+    names = cache.get_cache().users(conn, {row[1] for row in found if row[1] is not None})
+    return [(msg_id, message, names[sender][1] if sender in names else None, sent_date)
+            for msg_id, sender, message, sent_date in found]
+
+
+# Fill out a page read from the live table with archived rows. Only costs a
+# query when the page came up short or reaches back past the newest archived
+# row, so recent history never touches the archive.
+def merge_page(conn, source, project_id, rows, before=None, limit=50):
+    horizon = conn.execute("SELECT MAX(last_date) FROM archive_blocks WHERE source=? AND project_id=?",
+                           (source, project_id)).fetchone()[0]
+    if horizon is None or (len(rows) == limit and (rows[-1][3] or "") > horizon):
+        return rows
+    archived = page(conn, source, project_id, before, limit)
+    return sorted(rows + archived, key=lambda row: (row[3] or "", row[0]), reverse=True)[:limit]
+
+
+# -- archiving
+
+def _store_block(conn, source, project_id, month, rows, codec):
+    rows = [list(row) for row in rows]
+    old = conn.execute("SELECT id, codec, payload FROM archive_blocks WHERE source=? AND project_id=? AND month=?",
+                       (source, project_id, month)).fetchone()
+    if old:
+        # Rows dated back into a month that was archived already
+        rows = sorted(json.loads(decompress(old[2], old[1])) + rows, key=lambda row: (row[3], row[0]))
+        conn.execute("DELETE FROM archive_blocks WHERE id=?", (old[0],))
+        _blocks.discard(project_id, old[0])
+    raw = json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    payload = compress(raw, codec)
+    block_id = conn.execute("""
+        INSERT INTO archive_blocks (source, project_id, month, first_date, last_date, row_count, codec,
+                                    raw_size, payload, created_date)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (source, project_id, month, rows[0][3], rows[-1][3], len(rows), codec, len(raw), payload,
+          datetime.now().strftime("%Y-%m-%d %H:%M:%S"))).lastrowid
+    senders = {}
+    for _, sender, _, sent_date in rows:
+        if sender is not None:
+            senders[sender] = max(senders.get(sender, sent_date), sent_date)
+    conn.executemany("INSERT INTO archive_senders (block_id, sender_id, last_date) VALUES (?, ?, ?)",
+                     [(block_id, sender, last) for sender, last in senders.items()])
+    return len(raw), len(payload)
+
+
+# Move chat and messages from before the month `older_than_days` ago into one
+# compressed block per project and month. Whole months only, so a month is
+# archived once. Each block is its own short transaction, so sends carry on
+# while this runs. Returns counts for the run.
+def archive(conn, older_than_days=ARCHIVE_AFTER_DAYS, codec=CODEC):
+    cutoff = (datetime.now() - timedelta(days=older_than_days)).strftime("%Y-%m-01")
+    counts = {'rows': 0, 'blocks': 0, 'raw_bytes': 0, 'stored_bytes': 0}
+    for source in SOURCES:
+        groups = conn.execute(f"""
+            SELECT DISTINCT project_id, substr(sent_date, 1, 7) FROM {source}
+            WHERE project_id IS NOT NULL AND sent_date < ?
+        """, (cutoff,)).fetchall()
+        for project_id, month in groups:
+            where = "project_id=? AND sent_date >= ? AND sent_date < ?"
+            params = (project_id, month, _next_month(month))
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(f"SELECT {COLUMNS} FROM {source} WHERE {where} ORDER BY sent_date, id",
+                                    params).fetchall()
+                if rows:
+                    raw, stored = _store_block(conn, source, project_id, month, rows, codec)
+                    conn.execute(f"DELETE FROM {source} WHERE {where}", params)
+                    counts['rows'] += len(rows)
+                    counts['blocks'] += 1
+                    counts['raw_bytes'] += raw
+                    counts['stored_bytes'] += stored
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    return counts
+
+
+# Hand the pages archiving freed back to the file system, VACUUM_STEP pages
+# per transaction. Does nothing until the file is in incremental auto-vacuum
+# mode: new databases are (db.PRAGMAS); older ones need one full VACUUM
+# (python archive.py vacuum --full). Returns the number of pages freed.
+def vacuum(conn, step=VACUUM_STEP):
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    freed = 0
+    while True:
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not free:
+            break
+        # executescript() steps the pragma to the end; execute() would stop
+        # after the first page
+        conn.executescript(f"PRAGMA incremental_vacuum({step})")
+        freed += min(free, step)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    return freed
+
+
+# Switch an existing database to incremental auto-vacuum. Rewrites the whole
+# file and locks it meanwhile, so run it during a quiet moment.
+def enable_incremental_vacuum(conn):
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+
+
+def run(conn, older_than_days=ARCHIVE_AFTER_DAYS, codec=CODEC):
+    started = time.perf_counter()
+    counts = archive(conn, older_than_days, codec)
+    counts['vacuumed_pages'] = vacuum(conn)
+    counts['seconds'] = time.perf_counter() - started
+    with _counts_lock:
+        _counts['runs'] += 1
+        for key, value in counts.items():
+            _counts[key] += value
+        _counts['last_run'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return counts
+
+
+# Every database this process serves: each shard when sharded, else `path`
+# or the app's own
+def _connections(path=None):
+    if db.SHARD_DIR:
+        import shards
+        router = shards.get_router()
+        for key in router.keys():
+            with router.connection(key) as conn:
+                yield key, conn
+    else:
+        pool = db.ConnectionPool(path, size=1) if path else db.get_pool()
+        migrations.migrate(pool)
+        with pool.connection() as conn:
+            yield pool.path, conn
+        if path:
+            pool.close()
+
+
+def run_all(older_than_days=ARCHIVE_AFTER_DAYS, codec=CODEC):
+    return {name: run(conn, older_than_days, codec) for name, conn in _connections()}
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def _schedule(every):
+    while True:
+        time.sleep(every)
+        try:
+            run_all()
+        except Exception as e:
+            print(f"archive run failed: {e}", file=sys.stderr)
+
+
+# Archive in the background every ARCHIVE_EVERY_HOURS, if set. Runs in
+# several app processes at once are harmless: each block is claimed under
+# the write lock, and the later run finds nothing left to move.
+def start_scheduler(every_hours=None):
+    global _scheduler
+    every_hours = every_hours or ARCHIVE_EVERY_HOURS
+    if not every_hours or _scheduler is not None:
+        return _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = threading.Thread(target=_schedule, args=(every_hours * 3600,), name="archiver", daemon=True)
+            _scheduler.start()
+    return _scheduler
+
+
+def archive_stats():
+    with _counts_lock:
+        stats = dict(_counts)
+    stats.update((f"block_cache_{key}", value) for key, value in _blocks.stats().items())
+    return stats
+
+
+# Live and archived rows, and how much the archive saves, for one database
+def status(conn):
+    report = {}
+    for source in SOURCES:
+        live = conn.execute(f"SELECT COUNT(*) FROM {source}").fetchone()[0]
+        blocks, rows, raw, stored = conn.execute("""
+            SELECT COUNT(*), COALESCE(SUM(row_count), 0), COALESCE(SUM(raw_size), 0),
+                   COALESCE(SUM(length(payload)), 0)
+            FROM archive_blocks WHERE source=?
+        """, (source,)).fetchone()
+        report[source] = {'live_rows': live, 'archived_rows': rows, 'blocks': blocks,
+                          'raw_bytes': raw, 'stored_bytes': stored}
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    report['file'] = {'bytes': conn.execute("PRAGMA page_count").fetchone()[0] * page_size,
+                      'free_bytes': conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size,
+                      'auto_vacuum': ("none", "full", "incremental")[conn.execute("PRAGMA auto_vacuum").fetchone()[0]]}
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Archive old chat and messages into compressed monthly blocks.")
+    parser.add_argument("--db", default=db.DB_PATH, help="database file (ignored when sharded: every shard is done)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    p = commands.add_parser("run", help="archive old rows, then hand the freed space back")
+    p.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS, help="archive rows older than this")
+    p.add_argument("--codec", choices=["zlib", "zstd"], default=CODEC)
+    p = commands.add_parser("vacuum", help="hand free pages back to the file system")
+    p.add_argument("--full", action="store_true", help="switch to incremental auto-vacuum first (rewrites the file)")
+    commands.add_parser("status", help="live and archived rows, and file sizes")
+    args = parser.parse_args(argv)
+    if args.command == "run" and args.codec == "zstd" and zstandard is None:
+        sys.exit("zstd needs the zstandard package")
+
+    for name, conn in _connections(args.db):
+        if args.command == "run":
+            counts = run(conn, args.days, args.codec)
+            saved = counts['raw_bytes'] / counts['stored_bytes'] if counts['stored_bytes'] else 0
+            print(f"{name}: {counts['rows']:,} rows into {counts['blocks']:,} blocks ({saved:.1f}x smaller), "
+                  f"{counts['vacuumed_pages']:,} pages freed in {counts['seconds']:.1f}s")
+        elif args.command == "vacuum":
+            if args.full:
+                enable_incremental_vacuum(conn)
+            print(f"{name}: {vacuum(conn):,} pages freed")
+        else:
+            print(name)
+            for part, values in status(conn).items():
+                print(f"  {part:<14} " + "  ".join(f"{key}={value:,}" if isinstance(value, int) else f"{key}={value}"
+                                                    for key, value in values.items()))
+
+
+if __name__ == "__main__":
+    main()
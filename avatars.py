@@ -0,0 +1,91 @@
+import base64
+import hashlib
+import io
+import os
+import re
+
+import blobstore
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow ships with Streamlit, but keep uploads working without it
+    Image = None
+
+# What process_upload() raises for a file that isn't a picture Pillow can read
+BAD_UPLOAD = (Image.UnidentifiedImageError, Image.DecompressionBombError, OSError) if Image else (OSError,)
+
+AVATAR_DIR = os.path.join("uploads", "avatars")
+SIZES = (48, 120, 256)
+QUALITY = 82
+
+_HASH = re.compile(r'^[0-9a-f]{64}$')
+VARIANT_NAME = re.compile(r'^[0-9a-f]{64}_\d+\.(webp|jpg)$')
+
+
+def _extension():
+    return "webp" if features.check("webp") else "jpg"
+
+
+def _variant(key, size, ext):
+    return os.path.join(AVATAR_DIR, f"{key}_{size}.{ext}")
+
+
+# Turn an uploaded picture into square thumbnails at every size in SIZES,
+# named by the hash of the upload so the same picture is only processed once.
+# Returns the value to store in users.profile_pic: the hash, or, without
+# Pillow, the original saved the old way under uploads/.
+def process_upload(user_id, uploaded):
+    data = uploaded.getvalue()
+    if Image is None:
+        os.makedirs("uploads", exist_ok=True)
+        filename = f"user_{user_id}_{uploaded.name}"
+        with open(os.path.join("uploads", filename), "wb") as f:
+            f.write(data)
+        return filename
+    key = hashlib.sha256(data).hexdigest()
+    ext = _extension()
+    if all(os.path.exists(_variant(key, size, ext)) for size in SIZES):
+        return key
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    image = image.convert("RGBA" if ext == "webp" and "A" in image.getbands() else "RGB")
+    os.makedirs(AVATAR_DIR, exist_ok=True)
+    for size in SIZES:
+        thumb = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        path = _variant(key, size, ext)
+        tmp_path = path + ".tmp"
+        thumb.save(tmp_path, format="WEBP" if ext == "webp" else "JPEG", quality=QUALITY, method=4 if ext == "webp" else 0)
+        os.replace(tmp_path, path)
+    return key
+
+
+def _pick_size(px):
+    return next((size for size in SIZES if size >= px), SIZES[-1])
+
+
+# Local file for showing `profile_pic` at `px` pixels (st.image), or None
+def variant_path(profile_pic, px):
+    if not profile_pic:
+        return None
+    if not _HASH.match(profile_pic):
+        return os.path.join("uploads", profile_pic)
+    size = _pick_size(px)
+    for ext in ("webp", "jpg"):
+        path = _variant(profile_pic, size, ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+# URL for embedding in HTML, served by the file server with far-future cache
+# headers (the name changes whenever the picture does). With no file server
+# configured the thumbnail is inlined as a data: URL instead. None for
+# pictures uploaded before thumbnails existed.
+def avatar_url(profile_pic, px):
+    path = variant_path(profile_pic, px) if profile_pic and _HASH.match(profile_pic) else None
+    if path is None:
+        return None
+    if not blobstore.FILE_SERVER_URL:
+        with open(path, "rb") as f:
+            data = base64.b64encode(f.read()).decode("ascii")
+        return f"data:image/{'webp' if path.endswith('.webp') else 'jpeg'};base64,{data}"
+    return f"{blobstore.FILE_SERVER_URL}/avatars/{os.path.basename(path)}"
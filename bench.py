@@ -0,0 +1,298 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import actions
+import cache
+import data
+import db
+import metrics
+import migrations
+import page_data
+import shards
+
+RESULTS_DIR = "bench_results"
+
+
+# Stands in for st.session_state: editor sessions, chat feeds and the
+# message window live here between reruns, exactly as they do in edutech3.py
+class Session:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.state = {}
+
+
+# The data path of each main() menu branch, minus the widgets: the same
+# page_data calls as the page, in the same order, on the same (shard)
+# connections. Each takes (conn, session, env).
+
+def page_header(conn, session, env):
+    page_data.current_user(conn, session.user_id)
+
+
+# What an opened panel loads on the project's shard
+def _open_panel(conn, session, project_id):
+    page_data.editor_session(session.state, conn, project_id).pull(conn)
+    page_data.chat_feed(session.state, conn, project_id).poll(conn)
+    data.project_files(conn, project_id)
+
+
+# A Browse Projects panel: the membership check always, the editor, chat
+# and files only once it is opened
+def browse_panel(session, project, opened):
+    with shards.project_connection(project[0]) as conn:
+        actions.is_member(conn, session.user_id, project[0])
+        if opened:
+            _open_panel(conn, session, project[0])
+
+
+# A My Projects panel: the team always; teammate suggestions for the
+# creator, then the editor, chat and files, once it is opened
+def my_project_panel(session, project, opened):
+    with shards.project_connection(project[0]) as conn:
+        page_data.team(conn, project[0])
+        if opened:
+            if project[3] == session.user_id:
+                page_data.suggested_teammates(conn, project[0])
+            _open_panel(conn, session, project[0])
+
+
+def page_browse(conn, session, env, search=None, pages=1):
+    page_header(conn, session, env)
+    cursor = None
+    for _ in range(pages):
+        projects, cursor, _ = page_data.browse(conn, session.user_id, search, cursor)
+        for i, project in enumerate(projects):
+            browse_panel(session, project, i < env['open'])
+        if cursor is None:
+            break
+
+
+def page_browse_search(conn, session, env):
+    page_browse(conn, session, env, search=env['search'])
+
+
+def page_browse_deep(conn, session, env):
+    page_browse(conn, session, env, pages=10)
+
+
+def page_my_projects(conn, session, env):
+    page_header(conn, session, env)
+    for i, project in enumerate(page_data.my_projects(conn, session.user_id)):
+        my_project_panel(session, project, i < env['open'])
+
+
+def page_messages(conn, session, env):
+    page_header(conn, session, env)
+    projects = page_data.message_projects(conn, session.user_id)
+    if not projects:
+        return
+    with shards.project_connection(projects[0][0]) as conn:
+        page_data.message_window(session.state, conn, projects[0][0])
+
+
+def page_community(conn, session, env):
+    page_header(conn, session, env)
+    page_data.community(conn)
+
+
+def page_create_project(conn, session, env):
+    page_header(conn, session, env)
+    page_data.skill_names(conn)
+
+
+def page_profile(conn, session, env):
+    page_header(conn, session, env)
+    page_data.profile(conn, session.user_id)
+
+
+PAGES = {
+    'header': page_header,
+    'browse': page_browse,
+    'browse_search': page_browse_search,
+    'browse_deep': page_browse_deep,
+    'my_projects': page_my_projects,
+    'messages': page_messages,
+    'community': page_community,
+    'create_project': page_create_project,
+    'profile': page_profile,
+}
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)]
+
+
+# The first run of a page is a fresh session with an empty lookup cache
+# (first visit after a restart); the rest are reruns of the same session.
+# Queries are counted from the rerun's metrics trace, which sees every
+# connection the page uses on this thread; shard fan-outs run on worker
+# threads and are not counted.
+def bench_page(name, page, users, runs, env):
+    registry = metrics.get_registry()
+    results = {'cold': [], 'warm': [], 'queries_cold': [], 'queries_warm': [], 'peak_kb': []}
+    for user_id in users:
+        shards.bind(user_id)
+        session = Session(user_id)
+        cache.get_cache().clear()
+        with db.connection() as conn:
+            for i in range(runs + 1):
+                with registry.rerun() as trace:
+                    registry.set_page(f"bench: {name}")
+                    started = time.perf_counter()
+                    page(conn, session, env)
+                    elapsed = time.perf_counter() - started
+                results['cold' if i == 0 else 'warm'].append(elapsed * 1000)
+                results['queries_cold' if i == 0 else 'queries_warm'].append(len(trace.statements))
+        # Memory on its own pass: tracemalloc slows everything down
+        session = Session(user_id)
+        cache.get_cache().clear()
+        with db.connection() as conn:
+            tracemalloc.start()
+            try:
+                page(conn, session, env)
+                results['peak_kb'].append(tracemalloc.get_traced_memory()[1] / 1024)
+            finally:
+                tracemalloc.stop()
+    return {
+        'runs': len(results['warm']),
+        'cold_ms': round(statistics.median(results['cold']), 3),
+        'warm_ms': round(statistics.median(results['warm']), 3) if results['warm'] else None,
+        'warm_p95_ms': round(_percentile(results['warm'], 95), 3) if results['warm'] else None,
+        'queries_cold': round(statistics.mean(results['queries_cold']), 1),
+        'queries_warm': round(statistics.mean(results['queries_warm']), 1) if results['queries_warm'] else None,
+        'peak_kb': round(max(results['peak_kb']), 1),
+    }
+
+
+# fn(conn) on every shard, or on the single database
+def _each_database(fn):
+    if shards.enabled():
+        return list(shards.get_router().fan_out(fn).values())
+    with db.connection() as conn:
+        return [fn(conn)]
+
+
+def _pick_users(count, seed):
+    # Busiest members first: they are the ones whose pages load the most
+    busy, ids = [], set()
+    for shard_busy, shard_ids in _each_database(lambda conn: (
+            [row[0] for row in conn.execute(
+                "SELECT user_id FROM user_stats ORDER BY projects_involved DESC, user_id LIMIT ?", (count,))],
+            [row[0] for row in conn.execute("SELECT id FROM users")])):
+        busy += shard_busy
+        ids.update(shard_ids)
+    rng = random.Random(seed)
+    rest = rng.sample(sorted(ids), min(count, len(ids)))
+    return list(dict.fromkeys(busy[:max(count // 2, 1)] + rest))[:count]
+
+
+TABLES = ('users', 'projects', 'project_members', 'project_chat', 'messages', 'project_code', 'project_files')
+
+
+def _table_sizes():
+    sizes = dict.fromkeys(TABLES, 0)
+    for counts in _each_database(lambda conn: [conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                                               for table in TABLES]):
+        for table, n in zip(TABLES, counts):
+            sizes[table] += n
+    return sizes
+
+
+def _git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    print(f"{'page':<16}{'warm ms':>22}{'queries':>18}{'peak KB':>24}")
+    for name, now in current['pages'].items():
+        before = previous['pages'].get(name)
+        if before is None:
+            continue
+        cells = []
+        for key in ('warm_ms', 'queries_warm', 'peak_kb'):
+            old, new = before.get(key), now.get(key)
+            change = f"{(new - old) / old * 100:+.0f}%" if old and new is not None else "n/a"
+            cells.append(f"{old} -> {new} ({change})")
+        print(f"{name:<16}{cells[0]:>22}{cells[1]:>18}{cells[2]:>24}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time each page's data path against a database.")
+    parser.add_argument("--db", default=db.DB_PATH)
+    parser.add_argument("--dir", default=db.SHARD_DIR,
+                        help="shard directory to benchmark instead of --db (default: $EDUCOLLAB_SHARD_DIR)")
+    parser.add_argument("--pages", nargs="*", choices=sorted(PAGES), default=sorted(PAGES))
+    parser.add_argument("--users", type=int, default=5, help="distinct users to load each page as")
+    parser.add_argument("--runs", type=int, default=5, help="reruns per user after the first load")
+    parser.add_argument("--search", default="learning", help="query for the browse_search page")
+    parser.add_argument("--open", type=int, default=1, help="project panels opened on each list page")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help=f"results file (default: {RESULTS_DIR}/<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+
+    if not metrics.ENABLED:
+        sys.exit("queries are counted through metrics.py; unset EDUCOLLAB_INSTRUMENT=0")
+    # The app's own pools and routing, so pages run exactly as they do there
+    if args.dir:
+        if not os.path.isdir(args.dir):
+            sys.exit(f"{args.dir} does not exist; split a database into it with shards.py first")
+        shards.enable(args.dir)
+    else:
+        if not os.path.exists(args.db):
+            sys.exit(f"{args.db} does not exist; fill one with datagen.py first")
+        db.set_database(args.db)
+        migrations.migrate()
+    users = _pick_users(args.users, args.seed)
+    sizes = _table_sizes()
+    if not users:
+        sys.exit("no users in the database")
+    env = {'search': args.search, 'open': args.open}
+
+    results = {
+        'date': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'git_rev': _git_rev(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'db': args.dir or args.db,
+        'sharded': bool(args.dir),
+        'tables': sizes,
+        'users': users,
+        'runs': args.runs,
+        'pages': {},
+    }
+    for name in args.pages:
+        result = bench_page(name, PAGES[name], users, args.runs, env)
+        results['pages'][name] = result
+        print(f"{name:<16} cold {result['cold_ms']:>9.2f} ms  warm {result['warm_ms'] or 0:>9.2f} ms "
+              f"(p95 {result['warm_p95_ms'] or 0:.2f})  queries {result['queries_cold']:>6} / "
+              f"{result['queries_warm']}  peak {result['peak_kb']:,.0f} KB")
+    results['cache'] = cache.cache_stats()
+
+    out = args.out or os.path.join(RESULTS_DIR, datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {out}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
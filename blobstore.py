@@ -0,0 +1,258 @@
+import hashlib
+import mmap
+import os
+import re
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote
+
+import db
+import writer
+
+BLOB_DIR = os.path.join("project_uploads", "blobs")
+CHUNK_SIZE = 1024 * 1024
+# Unreferenced blobs touched more recently than this are left alone by gc():
+# an upload writes its blob a moment before the project_files row that
+# references it
+GC_GRACE = timedelta(hours=1)
+# Where `python blobstore.py serve` answers. Set EDUCOLLAB_FILE_SERVER to an
+# empty string to run without it: avatars are then inlined into the page
+FILE_SERVER_URL = os.environ.get("EDUCOLLAB_FILE_SERVER", "http://localhost:8502").rstrip("/")
+
+_SHA256 = re.compile(r'^[0-9a-f]{64}$')
+# Storing content that is already there touches created_date, so gc() gives
+# the upload its grace period too
+INSERT_BLOB = """
+    INSERT INTO blobs (sha256, size, ref_count, created_date) VALUES (?, ?, 0, ?)
+    ON CONFLICT(sha256) DO UPDATE SET created_date = excluded.created_date
+"""
+
+
+def blob_path(sha256):
+    return os.path.join(BLOB_DIR, sha256[:2], sha256)
+
+
+def file_url(sha256, filename):
+    return f"{FILE_SERVER_URL}/files/{sha256}/{quote(filename)}"
+
+
+# Stream `fileobj` to disk under its SHA-256, a chunk at a time. Identical
+# content is stored once however many projects upload it. Returns
+# (sha256, size) and makes sure a `blobs` row exists for it.
+def store(conn, fileobj, chunk_size=CHUNK_SIZE):
+    sha256, size = _write_blob(fileobj, chunk_size)
+    conn.execute(INSERT_BLOB, (sha256, size, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    return sha256, size
+
+
+def _write_blob(fileobj, chunk_size=CHUNK_SIZE):
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=BLOB_DIR, prefix=".upload_")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = fileobj.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        sha256 = digest.hexdigest()
+        path = blob_path(sha256)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return sha256, size
+
+
+# Store an upload and attach it to a project. The same content under the same
+# name is only recorded once per project, so uploading it again doesn't add a
+# second row. Returns True if a row was added.
+# Both rows go through the write-behind queue, in order, so the blob row is
+# always there before the file that references it.
+def add_project_file(conn, project_id, uploader_id, filename, fileobj):
+    sha256, size = _write_blob(fileobj)
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    writes = writer.get_writer()
+    writes.submit(INSERT_BLOB, (sha256, size, now))
+    _, added = writes.execute("""
+        INSERT INTO project_files (project_id, filename, uploader_id, upload_date, sha256, size)
+        SELECT ?, ?, ?, ?, ?, ?
+        WHERE NOT EXISTS (SELECT 1 FROM project_files WHERE project_id=? AND sha256=? AND filename=?)
+    """, (project_id, filename, uploader_id, now, sha256, size, project_id, sha256, filename), result=True)
+    # gc() took the blob between our finding it on disk and the blob row
+    # being touched: write it again
+    if not os.path.exists(blob_path(sha256)):
+        fileobj.seek(0)
+        _write_blob(fileobj)
+    return added > 0
+
+
+# Parse an HTTP Range header against a file of `size` bytes. Returns an
+# inclusive (start, end) pair, None to send the whole file, or raises
+# ValueError when the range can't be satisfied (416).
+def parse_range(header, size):
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[len("bytes="):].strip().partition("-")
+    if start:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    elif end:
+        start = max(size - int(end), 0)
+        end = size - 1
+    else:
+        return None
+    if start > end or start >= size:
+        raise ValueError(f"unsatisfiable range {header!r} for {size} bytes")
+    return start, end
+
+
+# Inclusive byte range of a blob, read through a memory map
+def read_range(sha256, start, end):
+    with open(blob_path(sha256), "rb") as f:
+        if end < start:
+            return b""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return m[start:end + 1]
+
+
+# Delete blobs nothing references any more. Returns (count, bytes) removed.
+def gc(conn, grace=GC_GRACE):
+    cutoff = (datetime.now() - grace).strftime("%Y-%m-%d %H:%M:%S")
+    rows = conn.execute("SELECT sha256, size FROM blobs WHERE ref_count <= 0 AND created_date < ?", (cutoff,)).fetchall()
+    removed = freed = 0
+    for sha256, size in rows:
+        # The check, the delete and the file's removal under one write lock:
+        # an upload of the same content that got in first has touched the
+        # row or referenced it, and one that comes after finds it gone
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("DELETE FROM blobs WHERE sha256=? AND ref_count <= 0 AND created_date < ?",
+                            (sha256, cutoff)).rowcount:
+                try:
+                    os.remove(blob_path(sha256))
+                except FileNotFoundError:
+                    pass
+                removed += 1
+                freed += size
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    # Leftovers from uploads that died half way
+    for name in os.listdir(BLOB_DIR) if os.path.isdir(BLOB_DIR) else ():
+        path = os.path.join(BLOB_DIR, name)
+        if name.startswith(".upload_") and datetime.fromtimestamp(os.path.getmtime(path)) < datetime.now() - grace:
+            os.remove(path)
+    return removed, freed
+
+
+# Move files uploaded before the blob store (project_uploads/{id}_{name})
+# into it. The originals are left in place; delete them once checked.
+def import_legacy(conn):
+    imported = 0
+    rows = conn.execute("SELECT id, project_id, filename FROM project_files WHERE sha256 IS NULL").fetchall()
+    for file_id, project_id, filename in rows:
+        path = os.path.join("project_uploads", f"{project_id}_{filename}")
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            sha256, size = store(conn, f)
+        conn.execute("UPDATE project_files SET sha256=?, size=? WHERE id=?", (sha256, size, file_id))
+        imported += 1
+    conn.commit()
+    return imported
+
+
+class BlobRequestHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self._send(head_only=True)
+
+    def do_GET(self):
+        self._send()
+
+    def _send(self, head_only=False):
+        import avatars
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if len(parts) == 3 and parts[0] == "files" and _SHA256.match(parts[1]):
+            path, etag = blob_path(parts[1]), parts[1]
+            content_type = "application/octet-stream"
+            disposition = f"attachment; filename*=UTF-8''{quote(unquote(parts[2]))}"
+        elif len(parts) == 2 and parts[0] == "avatars" and avatars.VARIANT_NAME.match(parts[1]):
+            path, etag = os.path.join(avatars.AVATAR_DIR, parts[1]), parts[1]
+            content_type = "image/webp" if parts[1].endswith(".webp") else "image/jpeg"
+            disposition = "inline"
+        else:
+            self.send_error(404)
+            return
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            self.send_error(404)
+            return
+        try:
+            byte_range = parse_range(self.headers.get("Range"), size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.end_headers()
+            return
+        start, end = byte_range or (0, size - 1)
+        self.send_response(206 if byte_range else 200)
+        if byte_range:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Disposition", disposition)
+        # Content never changes under a given name: both are content hashes
+        self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+        self.send_header("ETag", f'"{etag}"')
+        self.end_headers()
+        if head_only or size == 0:
+            return
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            view = memoryview(m)
+            try:
+                for offset in range(start, end + 1, CHUNK_SIZE):
+                    self.wfile.write(view[offset:min(offset + CHUNK_SIZE, end + 1)])
+            finally:
+                view.release()
+
+
+def serve(host="localhost", port=8502):
+    server = ThreadingHTTPServer((host, port), BlobRequestHandler)
+    print(f"Serving project files and avatars on http://{host}:{port}/")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "serve":
+        serve(port=int(sys.argv[2]) if len(sys.argv) > 2 else 8502)
+    elif command in ("gc", "import-legacy"):
+        # Shards share the blob directory, so one shard's unreferenced blob
+        # may still be another's file
+        if command == "gc" and db.SHARD_DIR:
+            sys.exit("gc is not shard-aware yet; unset EDUCOLLAB_SHARD_DIR to collect a single database")
+        import migrations
+        migrations.migrate()
+        with db.connection() as conn:
+            if command == "gc":
+                removed, freed = gc(conn)
+                print(f"Removed {removed} unreferenced blobs ({freed} bytes)")
+            else:
+                print(f"Imported {import_legacy(conn)} legacy files")
+    else:
+        sys.exit("usage: python blobstore.py serve [port] | gc | import-legacy")
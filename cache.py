@@ -0,0 +1,173 @@
+import threading
+import time
+from collections import OrderedDict
+
+MAX_ENTRIES = 10000
+TTL = 300
+
+# Each kind of lookup: the table whose version guards it, and the query that
+# loads a batch of keys. Queries return (key, ...) rows.
+USER_COLUMNS = "id, name, email, institution, role, join_date, profile_pic"
+PROJECT_COLUMNS = "id, title, description, created_by, created_date"
+
+
+def _marks(keys):
+    return ','.join(['?'] * len(keys))
+
+
+def _load_users(conn, ids):
+    rows = conn.execute(f"SELECT {USER_COLUMNS} FROM users WHERE id IN ({_marks(ids)})", list(ids))
+    return {row[0]: row for row in rows}
+
+
+def _load_projects(conn, ids):
+    rows = conn.execute(f"SELECT {PROJECT_COLUMNS} FROM projects WHERE id IN ({_marks(ids)})", list(ids))
+    return {row[0]: row for row in rows}
+
+
+def _load_member_of(conn, user_ids):
+    found = {user_id: set() for user_id in user_ids}
+    for user_id, project_id in conn.execute(
+            f"SELECT user_id, project_id FROM project_members WHERE user_id IN ({_marks(user_ids)})", list(user_ids)):
+        found[user_id].add(project_id)
+    return {user_id: frozenset(projects) for user_id, projects in found.items()}
+
+
+def _load_members(conn, project_ids):
+    found = {project_id: [] for project_id in project_ids}
+    for project_id, user_id in conn.execute(
+            f"SELECT project_id, user_id FROM project_members WHERE project_id IN ({_marks(project_ids)}) ORDER BY rowid",
+            list(project_ids)):
+        found[project_id].append(user_id)
+    return {project_id: tuple(users) for project_id, users in found.items()}
+
+
+KINDS = {
+    'user': ('users', _load_users),
+    'project': ('projects', _load_projects),
+    'member_of': ('project_members', _load_member_of),
+    'members': ('project_members', _load_members),
+}
+# The loaders above, which read the connection they are given; shards.py
+# points KINDS at loaders that find the right shard and calls these on it
+LOCAL_LOADERS = {kind: load for kind, (table, load) in KINDS.items()}
+
+
+# Process-wide read-through cache for the small lookups every rerun repeats:
+# user rows, project rows and memberships. Entries remember the version of
+# their table when they were read; writers call bump() after committing, and
+# anything read under an older version counts as a miss. The TTL bounds how
+# stale an entry can get when another process (a CLI script) writes instead.
+class LookupCache:
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0}
+
+    def bump(self, *tables):
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    def version(self, table):
+        with self._lock:
+            return self._versions.get(table, 0)
+
+    # {key: value} for every key that exists; missing rows are left out
+    def get_many(self, conn, kind, keys):
+        table, load = KINDS[kind]
+        keys = list(dict.fromkeys(keys))
+        found, missing = {}, []
+        now = time.monotonic()
+        with self._lock:
+            version = self._versions.get(table, 0)
+            for key in keys:
+                entry = self._entries.get((kind, key))
+                if entry is not None and entry[1] == version and entry[2] > now:
+                    self._entries.move_to_end((kind, key))
+                    found[key] = entry[0]
+                    self._stats['hits'] += 1
+                else:
+                    if entry is not None:
+                        self._stats['stale'] += 1
+                    missing.append(key)
+            self._stats['misses'] += len(missing)
+        if not missing:
+            return found
+        # Loaded outside the lock. `version` was read before the query, so a
+        # write that lands meanwhile makes these entries stale, not wrong.
+        loaded = load(conn, missing)
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in loaded.items():
+                self._entries[(kind, key)] = (value, version, expires)
+                self._entries.move_to_end((kind, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+        found.update(loaded)
+        return found
+
+    def get(self, conn, kind, key):
+        return self.get_many(conn, kind, [key]).get(key)
+
+    # (id, name, email, institution, role, join_date, profile_pic) or None
+    def user(self, conn, user_id):
+        return self.get(conn, 'user', user_id)
+
+    def users(self, conn, user_ids):
+        return self.get_many(conn, 'user', user_ids)
+
+    # (id, title, description, created_by, created_date) or None
+    def project(self, conn, project_id):
+        return self.get(conn, 'project', project_id)
+
+    def projects(self, conn, project_ids):
+        return self.get_many(conn, 'project', project_ids)
+
+    # Ids of the projects a user belongs to, as a frozenset
+    def member_of(self, conn, user_id):
+        return self.get(conn, 'member_of', user_id) or frozenset()
+
+    # Ids of a project's members, in the order they joined
+    def members(self, conn, project_id):
+        return self.get(conn, 'members', project_id) or ()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['max_entries'] = self.max_entries
+            stats['versions'] = dict(self._versions)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LookupCache()
+    return _cache
+
+
+# Call after committing a write to any of `tables`
+def bump(*tables):
+    get_cache().bump(*tables)
+
+
+def cache_stats():
+    return get_cache().stats()
@@ -0,0 +1,99 @@
+import threading
+from collections import deque
+from datetime import datetime
+
+import archive
+import cache
+import pubsub
+import writer
+
+HISTORY = 10
+CATCH_UP_LIMIT = 500
+
+# Chat rows everywhere are (id, message, sender_name, sent_date). Ids come from
+# an AUTOINCREMENT key, so they only ever grow and work as a cursor.
+_SELECT = """
+    SELECT ch.id, ch.message, u.name, ch.sent_date
+    FROM project_chat ch
+    LEFT JOIN users u ON u.id = ch.sender_id
+"""
+
+
+class ChatService:
+    def __init__(self, hub=None):
+        self.hub = hub or pubsub.get_hub()
+
+    # A quiet project's last messages may all have been archived
+    def recent(self, conn, project_id, limit=HISTORY):
+        rows = conn.execute(_SELECT + " WHERE ch.project_id=? ORDER BY ch.id DESC LIMIT ?",
+                            (project_id, limit)).fetchall()
+        if len(rows) < limit:
+            rows += archive.page(conn, 'project_chat', project_id, limit=limit - len(rows))
+        return rows[::-1]
+
+    def since(self, conn, project_id, after_id, limit=CATCH_UP_LIMIT):
+        return conn.execute(_SELECT + " WHERE ch.project_id=? AND ch.id > ? ORDER BY ch.id LIMIT ?",
+                            (project_id, after_id, limit)).fetchall()
+
+    # Store a message and push it to every feed open on the project. The
+    # sender's name travels with it, so receivers never look it up. The insert
+    # goes through the write-behind queue and is committed with whatever else
+    # is being sent at the same moment.
+    def send(self, conn, project_id, sender_id, message):
+        sent_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        msg_id, _ = writer.get_writer().execute(
+            "INSERT INTO project_chat (project_id, sender_id, message, sent_date) VALUES (?, ?, ?, ?)",
+            (project_id, sender_id, message, sent_date), result=True)
+        sender = cache.get_cache().user(conn, sender_id)
+        msg = (msg_id, message, sender[1] if sender else None, sent_date)
+        self.hub.publish(('chat', project_id), msg)
+        return msg
+
+
+# One project's chat as seen by one browser session: the last `limit`
+# messages plus a cursor. poll() only picks up what the hub delivered since
+# the last call, so an idle rerun costs no queries at all.
+class ChatFeed:
+    def __init__(self, service, conn, project_id, limit=HISTORY):
+        self.service = service
+        self.project_id = project_id
+        # Subscribe before reading so nothing sent in between is missed
+        self.subscription = service.hub.subscribe(('chat', project_id))
+        rows = service.recent(conn, project_id, limit)
+        self.messages = deque(rows, maxlen=limit)
+        self.cursor = rows[-1][0] if rows else 0
+
+    def poll_database(self, conn):
+        for msg in self.service.since(conn, self.project_id, self.cursor):
+            self.messages.append(msg)
+            self.cursor = msg[0]
+
+    # Senders publish once their batch has committed, so two messages
+    # committed together can arrive in either order. Anything that doesn't
+    # follow on from the cursor (a gap before it, or one of them still in
+    # flight) is read back from the database instead, where it is already
+    # committed. Ids are shared by every project, so another project's
+    # message shows up as a gap too; that costs one indexed read.
+    def poll(self, conn):
+        new, overflowed = self.subscription.drain()
+        new = sorted((msg for msg in new if msg[0] > self.cursor), key=lambda msg: msg[0])
+        if overflowed or [msg[0] for msg in new] != list(range(self.cursor + 1, self.cursor + 1 + len(new))):
+            self.poll_database(conn)
+        for msg in new:
+            if msg[0] > self.cursor:
+                self.messages.append(msg)
+                self.cursor = msg[0]
+        return list(self.messages)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = ChatService()
+    return _service
@@ -0,0 +1,297 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, TimeoutError
+
+WORKERS = 4
+TIMEOUT = 5
+CPU_SECONDS = 5
+MEMORY_BYTES = 256 * 1024 * 1024
+OUTPUT_BYTES = 64 * 1024
+MAX_QUEUED = 64
+MAX_QUEUED_PER_USER = 3
+CACHE_SIZE = 256
+# How long run() waits for a result, queueing included, before giving up
+WAIT_TIMEOUT = 60
+
+RunResult = namedtuple('RunResult', 'output returncode timed_out cached queue_time run_time')
+
+
+class QueueFull(Exception):
+    pass
+
+
+# Runs inside each worker process. The interpreter is already up and parked on
+# stdin.read() by the time a job arrives, so a run only pays for the user code.
+# Limits are applied after the source is written out, just before it executes.
+WORKER_STUB = r'''
+import os, sys
+code = sys.stdin.read()
+with open("main.py", "w", encoding="utf-8") as f:
+    f.write(code)
+cpu, memory, output = (int(v) for v in sys.argv[1:4])
+try:
+    import resource
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (output, output))
+except (ImportError, ValueError, OSError):
+    pass
+sys.argv = ["main.py"]
+sys.path.insert(0, os.getcwd())
+try:
+    exec(compile(code, "main.py", "exec"), {"__name__": "__main__", "__file__": "main.py"})
+except SystemExit:
+    raise
+except BaseException as e:
+    import traceback
+    traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+    sys.exit(1)
+'''
+
+
+def _worker_env():
+    env = {'PATH': os.environ.get('PATH', ''), 'PYTHONIOENCODING': 'utf-8'}
+    # Windows won't start an interpreter without these
+    for key in ('SYSTEMROOT', 'TEMP', 'TMP'):
+        if key in os.environ:
+            env[key] = os.environ[key]
+    return env
+
+
+# A started interpreter waiting for one job in its own temp directory.
+# Workers are single-use: whatever a job leaves behind goes with the directory.
+class _Worker:
+    def __init__(self, cpu_seconds, memory_bytes, output_bytes):
+        self.output_bytes = output_bytes
+        self.dir = tempfile.mkdtemp(prefix='educollab_run_')
+        self.out = open(os.path.join(self.dir, 'output.txt'), 'wb')
+        self.proc = subprocess.Popen(
+            [sys.executable, '-u', '-I', '-c', WORKER_STUB,
+             str(cpu_seconds), str(memory_bytes), str(output_bytes)],
+            stdin=subprocess.PIPE, stdout=self.out, stderr=subprocess.STDOUT,
+            cwd=self.dir, env=_worker_env())
+
+    def run(self, code, timeout):
+        timed_out = False
+        try:
+            self.proc.stdin.write(code.encode('utf-8'))
+            self.proc.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        try:
+            returncode = self.proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            returncode = self.proc.wait()
+            timed_out = True
+        self.out.close()
+        with open(os.path.join(self.dir, 'output.txt'), 'rb') as f:
+            output = f.read(self.output_bytes + 1)
+        text = output[:self.output_bytes].decode('utf-8', errors='replace')
+        if len(output) > self.output_bytes:
+            text += "\n[output truncated]"
+        if timed_out:
+            text += f"\n[timed out after {timeout}s]"
+        return text, returncode, timed_out
+
+    def discard(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        if not self.out.closed:
+            self.out.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+# FIFO per user, round-robin across users, so one person queueing several runs
+# can't starve everyone else.
+class FairQueue:
+    def __init__(self, max_total=MAX_QUEUED, max_per_user=MAX_QUEUED_PER_USER):
+        self.max_total = max_total
+        self.max_per_user = max_per_user
+        self._queues = OrderedDict()
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def put(self, user_id, item):
+        with self._cond:
+            if self._size >= self.max_total:
+                raise QueueFull("The code runner is busy, please try again shortly.")
+            pending = self._queues.setdefault(user_id, deque())
+            if len(pending) >= self.max_per_user:
+                raise QueueFull("You already have runs waiting; wait for them to finish.")
+            pending.append(item)
+            self._size += 1
+            self._cond.notify()
+
+    def get(self):
+        with self._cond:
+            while not self._size:
+                self._cond.wait()
+            user_id, pending = next(iter(self._queues.items()))
+            item = pending.popleft()
+            if pending:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            self._size -= 1
+            return item
+
+    def __len__(self):
+        with self._cond:
+            return self._size
+
+
+class CodeRunner:
+    def __init__(self, workers=WORKERS, timeout=TIMEOUT, cpu_seconds=CPU_SECONDS,
+                 memory_bytes=MEMORY_BYTES, output_bytes=OUTPUT_BYTES, cache_size=CACHE_SIZE):
+        self.timeout = timeout
+        self.limits = (cpu_seconds, memory_bytes, output_bytes)
+        self.cache_size = cache_size
+        self._queue = FairQueue()
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._running = 0
+        self._counts = {'submitted': 0, 'completed': 0, 'timeouts': 0, 'cache_hits': 0, 'rejected': 0,
+                        'worker_failures': 0, 'abandoned': 0}
+        self._queue_times = deque(maxlen=500)
+        self._run_times = deque(maxlen=500)
+        for i in range(workers):
+            threading.Thread(target=self._dispatch, name=f"code-runner-{i}", daemon=True).start()
+
+    # Each dispatcher keeps one warm worker ready while it waits for a job,
+    # then starts the next one as soon as the job finishes. If a worker won't
+    # start, the job is failed rather than left waiting, and the dispatcher
+    # carries on with the next one.
+    def _dispatch(self):
+        while True:
+            worker = self._start_worker()
+            key, code, future, queued_at = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                # Everyone waiting on it gave up (run() timed out)
+                if worker is not None:
+                    worker.discard()
+                continue
+            if worker is None:
+                worker = self._start_worker()
+            if worker is None:
+                self._finish(key, future, error=RuntimeError("Couldn't start a Python worker; please try again."))
+                time.sleep(1)
+                continue
+            started = time.perf_counter()
+            with self._lock:
+                self._running += 1
+            try:
+                output, returncode, timed_out = worker.run(code, self.timeout)
+            except Exception as e:
+                self._finish(key, future, error=e)
+                continue
+            finally:
+                worker.discard()
+                with self._lock:
+                    self._running -= 1
+            finished = time.perf_counter()
+            self._finish(key, future, RunResult(output, returncode, timed_out, False,
+                                                started - queued_at, finished - started))
+
+    def _start_worker(self):
+        try:
+            return _Worker(*self.limits)
+        except Exception:
+            with self._lock:
+                self._counts['worker_failures'] += 1
+            return None
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._inflight.pop(key, None)
+            if error is not None:
+                future.set_exception(error)
+                return
+            self._counts['completed'] += 1
+            self._queue_times.append(result.queue_time)
+            self._run_times.append(result.run_time)
+            if result.timed_out:
+                self._counts['timeouts'] += 1
+            # Only clean runs: a timeout or crash under load may well succeed
+            # next time, and would otherwise stick for everyone
+            if not result.timed_out and result.returncode == 0:
+                self._cache[key] = result
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        future.set_result(result)
+
+    # Queue a run and return a Future for its RunResult. Code that has been run
+    # before comes straight back from the cache; code that is already queued
+    # shares the pending run instead of being executed twice.
+    def submit(self, user_id, code):
+        key = hashlib.sha256(code.encode('utf-8')).hexdigest()
+        future = Future()
+        with self._lock:
+            self._counts['submitted'] += 1
+            if key in self._cache:
+                self._counts['cache_hits'] += 1
+                self._cache.move_to_end(key)
+                future.set_result(self._cache[key]._replace(cached=True, queue_time=0.0, run_time=0.0))
+                return future
+            if key in self._inflight:
+                return self._inflight[key]
+            try:
+                self._queue.put(user_id, (key, code, future, time.perf_counter()))
+            except QueueFull:
+                self._counts['rejected'] += 1
+                raise
+            self._inflight[key] = future
+        return future
+
+    # submit() and wait for the result. Raises QueueFull if it hasn't come
+    # back within `timeout` seconds; a run that hasn't started by then is
+    # dropped from the queue.
+    def run(self, user_id, code, timeout=WAIT_TIMEOUT):
+        future = self.submit(user_id, code)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            if future.cancel():
+                key = hashlib.sha256(code.encode('utf-8')).hexdigest()
+                with self._lock:
+                    self._counts['abandoned'] += 1
+                    # So the next submit queues a fresh run
+                    if self._inflight.get(key) is future:
+                        del self._inflight[key]
+            raise QueueFull("The code runner is busy, please try again shortly.")
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._counts)
+            metrics['running'] = self._running
+            metrics['cache_entries'] = len(self._cache)
+            queue_times = sorted(self._queue_times)
+            run_times = sorted(self._run_times)
+        metrics['queue_depth'] = len(self._queue)
+        for name, samples in (('queue_time', queue_times), ('run_time', run_times)):
+            metrics[f'{name}_p50'] = samples[len(samples) // 2] if samples else 0.0
+            metrics[f'{name}_p95'] = samples[int(len(samples) * 0.95)] if samples else 0.0
+        return metrics
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_runner():
+    global _runner
+    if _runner is None:
+        with _runner_lock:
+            if _runner is None:
+                _runner = CodeRunner()
+    return _runner
@@ -0,0 +1,287 @@
+import json
+import threading
+from datetime import datetime
+from difflib import SequenceMatcher
+
+import pubsub
+import stats
+
+# How often (in revisions) the full text is written back to project_code, and
+# how many ops are kept behind it for editors that are catching up.
+SNAPSHOT_EVERY = 50
+KEEP_OPS = 500
+
+
+class StaleRevision(Exception):
+    pass
+
+
+# Operations are lists of components applied left to right over the document:
+# an int > 0 keeps that many characters, an int < 0 deletes that many, and a
+# str inserts itself. This is the classic text OT representation (ot.js).
+
+def _retain(op, n):
+    if n <= 0:
+        return
+    if op and isinstance(op[-1], int) and op[-1] > 0:
+        op[-1] += n
+    else:
+        op.append(n)
+
+
+def _insert(op, s):
+    if not s:
+        return
+    if op and isinstance(op[-1], str):
+        op[-1] += s
+    elif op and isinstance(op[-1], int) and op[-1] < 0:
+        # Canonical form puts an insert before an adjacent delete
+        if len(op) > 1 and isinstance(op[-2], str):
+            op[-2] += s
+        else:
+            op.insert(len(op) - 1, s)
+    else:
+        op.append(s)
+
+
+def _delete(op, n):
+    if n <= 0:
+        return
+    if op and isinstance(op[-1], int) and op[-1] < 0:
+        op[-1] -= n
+    else:
+        op.append(-n)
+
+
+def base_length(op):
+    return sum(abs(c) for c in op if isinstance(c, int))
+
+
+def apply(text, op):
+    if base_length(op) != len(text):
+        raise ValueError("operation does not match document length")
+    parts = []
+    pos = 0
+    for c in op:
+        if isinstance(c, str):
+            parts.append(c)
+        elif c > 0:
+            parts.append(text[pos:pos + c])
+            pos += c
+        else:
+            pos -= c
+    return ''.join(parts)
+
+
+# Given a and b made against the same document, returns (a', b') such that
+# apply(apply(doc, a), b') == apply(apply(doc, b), a'). When both insert at
+# the same spot, a's text ends up first.
+def transform(a, b):
+    a_prime, b_prime = [], []
+    ia, ib = iter(a), iter(b)
+    x, y = next(ia, None), next(ib, None)
+    while x is not None or y is not None:
+        if isinstance(x, str):
+            _insert(a_prime, x)
+            _retain(b_prime, len(x))
+            x = next(ia, None)
+            continue
+        if isinstance(y, str):
+            _retain(a_prime, len(y))
+            _insert(b_prime, y)
+            y = next(ib, None)
+            continue
+        if x is None or y is None:
+            raise ValueError("operations were not made against the same document")
+        n = min(abs(x), abs(y))
+        if x > 0 and y > 0:
+            _retain(a_prime, n)
+            _retain(b_prime, n)
+        elif x < 0 and y > 0:
+            _delete(a_prime, n)
+        elif x > 0 and y < 0:
+            _delete(b_prime, n)
+        # both deleting the same text: nothing left for either to do
+        x = _shrink(x, n) or next(ia, None)
+        y = _shrink(y, n) or next(ib, None)
+    return a_prime, b_prime
+
+
+def _shrink(c, n):
+    return c - n if c > 0 else c + n
+
+
+# The op turning `old` into `new`. Unchanged head and tail are trimmed, then
+# the middle is diffed by line so separate edits stay separate ops components
+# (and so merge cleanly with other people's edits).
+def diff(old, new):
+    op = []
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    _retain(op, prefix)
+    a_lines = old[prefix:len(old) - suffix].splitlines(keepends=True)
+    b_lines = new[prefix:len(new) - suffix].splitlines(keepends=True)
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, a_lines, b_lines, autojunk=False).get_opcodes():
+        a_seg = ''.join(a_lines[i1:i2])
+        if tag == 'equal':
+            _retain(op, len(a_seg))
+        else:
+            _insert(op, ''.join(b_lines[j1:j2]))
+            _delete(op, len(a_seg))
+    _retain(op, suffix)
+    return op
+
+
+# Server side: orders edits per project. The head document is rebuilt from
+# the last snapshot in project_code plus the ops after it, and cached in
+# memory. Accepted ops are published on the hub under ('code', project_id).
+class DocumentStore:
+    def __init__(self, hub=None):
+        self.hub = hub or pubsub.get_hub()
+        self._docs = {}
+        self._lock = threading.RLock()
+
+    def _ops(self, conn, project_id, after_rev, upto_rev=None):
+        sql = "SELECT rev, op FROM code_ops WHERE project_id=? AND rev > ?"
+        params = [project_id, after_rev]
+        if upto_rev is not None:
+            sql += " AND rev <= ?"
+            params.append(upto_rev)
+        return [(rev, json.loads(op)) for rev, op in conn.execute(sql + " ORDER BY rev", params)]
+
+    # (snapshot_rev, head_rev) without loading any text
+    def revisions(self, conn, project_id):
+        return conn.execute("""
+            SELECT COALESCE((SELECT rev FROM project_code WHERE project_id=?), 0),
+                   COALESCE((SELECT MAX(rev) FROM code_ops WHERE project_id=?), 0)
+        """, (project_id, project_id)).fetchone()
+
+    def head_rev(self, conn, project_id):
+        return max(self.revisions(conn, project_id))
+
+    # (rev, text) of the current document
+    def open(self, conn, project_id):
+        with self._lock:
+            snapshot_rev, ops_rev = self.revisions(conn, project_id)
+            head = max(snapshot_rev, ops_rev)
+            cached = self._docs.get(project_id)
+            if cached and cached[0] == head:
+                return cached
+            if cached and snapshot_rev <= cached[0] < head:
+                rev, text = cached
+            else:
+                row = conn.execute("SELECT rev, code FROM project_code WHERE project_id=?", (project_id,)).fetchone()
+                rev, text = (row[0], row[1] or "") if row else (0, "")
+            for rev, op in self._ops(conn, project_id, rev, head):
+                text = apply(text, op)
+            self._docs[project_id] = (rev, text)
+            return rev, text
+
+    # Ops after `rev`, for an editor that is behind. Raises StaleRevision if
+    # they have been pruned and the editor has to reopen the document instead.
+    def changes_since(self, conn, project_id, rev):
+        ops = self._ops(conn, project_id, rev)
+        first = ops[0][0] if ops else self.head_rev(conn, project_id) + 1
+        if first != rev + 1:
+            raise StaleRevision(f"project {project_id} has no history from revision {rev}")
+        return ops
+
+    # Apply an op made against `base_rev`. It is transformed past anything
+    # that was accepted since, so concurrent saves merge instead of the last
+    # one winning. Returns (new_rev, op_as_applied).
+    def submit(self, conn, project_id, user_id, base_rev, op):
+        with self._lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rev, text = self.open(conn, project_id)
+                if base_rev > rev:
+                    raise ValueError(f"revision {base_rev} is ahead of the document")
+                if base_rev < rev:
+                    for _, other in self.changes_since(conn, project_id, base_rev):
+                        op = transform(op, other)[0]
+                text = apply(text, op)
+                rev += 1
+                now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                conn.execute("INSERT INTO code_ops (project_id, rev, user_id, op, created_date) VALUES (?, ?, ?, ?, ?)",
+                             (project_id, rev, user_id, json.dumps(op, separators=(',', ':')), now))
+                snapshot = conn.execute("SELECT rev FROM project_code WHERE project_id=?", (project_id,)).fetchone()
+                if snapshot is None or rev - snapshot[0] >= SNAPSHOT_EVERY:
+                    conn.execute("""
+                        INSERT INTO project_code (project_id, code, rev) VALUES (?, ?, ?)
+                        ON CONFLICT(project_id) DO UPDATE SET code=excluded.code, rev=excluded.rev
+                    """, (project_id, text, rev))
+                    conn.execute("DELETE FROM code_ops WHERE project_id=? AND rev <= ?", (project_id, rev - KEEP_OPS))
+                stats.code_saved(conn, project_id, user_id, text, now)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                self._docs.pop(project_id, None)
+                raise
+            self._docs[project_id] = (rev, text)
+        self.hub.publish(('code', project_id), (rev, op))
+        return rev, op
+
+
+# Client side: one per open editor. Tracks the last revision seen and the
+# user's unsaved buffer. pull() applies only the ops published since then,
+# rebasing the unsaved buffer over them; push() sends just the user's delta.
+class EditorSession:
+    def __init__(self, store, conn, project_id):
+        self.store = store
+        self.project_id = project_id
+        self.subscription = store.hub.subscribe(('code', project_id))
+        self.rev, self.text = store.open(conn, project_id)
+        self.buffer = self.text
+
+    def pull(self, conn):
+        messages, overflowed = self.subscription.drain()
+        ops = [(rev, op) for rev, op in messages if rev > self.rev]
+        if overflowed or (ops and [rev for rev, _ in ops] != list(range(self.rev + 1, self.rev + 1 + len(ops)))):
+            try:
+                ops = self.store.changes_since(conn, self.project_id, self.rev)
+            except StaleRevision:
+                # Too far behind to rebase; start over from the current text
+                self.rev, self.text = self.store.open(conn, self.project_id)
+                self.buffer = self.text
+                return self.buffer
+        if not ops:
+            return self.buffer
+        local = diff(self.text, self.buffer) if self.buffer != self.text else None
+        for rev, op in ops:
+            self.text = apply(self.text, op)
+            if local is not None:
+                local = transform(local, op)[0]
+            self.rev = rev
+        self.buffer = apply(self.text, local) if local is not None else self.text
+        return self.buffer
+
+    # Returns True if there was anything to save
+    def push(self, conn, user_id):
+        self.pull(conn)
+        if self.buffer == self.text:
+            return False
+        op = diff(self.text, self.buffer)
+        self.store.submit(conn, self.project_id, user_id, self.rev, op)
+        # Our own op comes back through the hub, after anything it was
+        # transformed past; replaying them all leaves text == server head
+        self.buffer = self.text
+        self.pull(conn)
+        return True
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = DocumentStore()
+    return _store
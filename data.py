@@ -0,0 +1,90 @@
+import archive
+import search as project_search
+
+PAGE_SIZE = 20
+MESSAGE_PAGE = 50
+
+
+def _marks(ids):
+    return ','.join(['?'] * len(ids))
+
+
+# One page of projects: newest first, or best match first when searching.
+# Keyset pagination: pass the cursor returned with the previous page rather
+# than an OFFSET, so deep pages cost the same as the first one. Returns
+# (projects, next_cursor); rows are (id, title, description, created_by,
+# created_date, creator_name, snippet), snippet being None unless searching.
+def browse_projects(conn, search=None, cursor=None, page_size=PAGE_SIZE):
+    if search:
+        return project_search.search_projects(conn, search, cursor, page_size)
+    sql = """
+        SELECT p.id, p.title, p.description, p.created_by, p.created_date, u.name, NULL
+        FROM projects p
+        LEFT JOIN users u ON u.id = p.created_by
+    """
+    params = []
+    if cursor is not None:
+        sql += " WHERE p.id < ?"
+        params.append(cursor)
+    sql += " ORDER BY p.id DESC LIMIT ?"
+    params.append(page_size + 1)
+    rows = conn.execute(sql, params).fetchall()
+    next_cursor = rows[page_size - 1][0] if len(rows) > page_size else None
+    return rows[:page_size], next_cursor
+
+
+# The projects a user belongs to with their member counts, as (id, title,
+# description, created_by, created_date, member_count)
+def my_projects(conn, user_id):
+    return conn.execute("""
+        SELECT p.id, p.title, p.description, p.created_by, p.created_date, COUNT(pm.user_id) as member_count
+        FROM projects p
+        JOIN project_members pm ON p.id = pm.project_id
+        WHERE p.id IN (
+            SELECT project_id FROM project_members WHERE user_id=?
+        )
+        GROUP BY p.id
+    """, (user_id,)).fetchall()
+
+
+# Project messages, newest first, in (id, message, sender_name, sent_date)
+# rows. Keyset on (sent_date, id): `before` is the (sent_date, id) of the
+# oldest row already shown, and the (project_id, sent_date) index, which
+# carries the rowid, serves both the seek and the ordering. Past the live
+# rows, the page carries on into the archive.
+def message_page(conn, project_id, before=None, limit=MESSAGE_PAGE):
+    sql = """
+        SELECT m.id, m.message, u.name, m.sent_date
+        FROM messages m
+        LEFT JOIN users u ON u.id = m.sender_id
+        WHERE m.project_id=?
+    """
+    params = [project_id]
+    if before is not None:
+        sql += " AND (m.sent_date, m.id) < (?, ?)"
+        params += list(before)
+    sql += " ORDER BY m.sent_date DESC, m.id DESC LIMIT ?"
+    params.append(limit)
+    return archive.merge_page(conn, 'messages', project_id, conn.execute(sql, params).fetchall(), before, limit)
+
+
+# Messages newer than `after` (the newest row already shown), newest first
+def messages_after(conn, project_id, after):
+    return conn.execute("""
+        SELECT m.id, m.message, u.name, m.sent_date
+        FROM messages m
+        LEFT JOIN users u ON u.id = m.sender_id
+        WHERE m.project_id=? AND (m.sent_date, m.id) > (?, ?)
+        ORDER BY m.sent_date DESC, m.id DESC
+    """, [project_id] + list(after)).fetchall()
+
+
+# One project's files as (filename, uploader_name, upload_date, sha256, size)
+def project_files(conn, project_id):
+    return conn.execute("""
+        SELECT f.filename, u.name, f.upload_date, f.sha256, f.size
+        FROM project_files f
+        LEFT JOIN users u ON u.id = f.uploader_id
+        WHERE f.project_id=?
+        ORDER BY f.id
+    """, (project_id,)).fetchall()
@@ -0,0 +1,236 @@
+import argparse
+import io
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import blobstore
+import db
+import migrations
+import stats
+
+BATCH = 10000
+INSTITUTIONS = ["state", "tech", "city", "valley", "coastal", "northern", "metro", "central"]
+SUBJECTS = ["Machine Learning", "Robotics", "Climate Data", "Web Platform", "Genomics", "Compilers",
+            "Game Engine", "Accessibility", "Networking", "Quantum Circuits", "Urban Mobility", "NLP"]
+KINDS = ["Toolkit", "Study", "Dashboard", "Simulator", "Library", "Survey", "Prototype", "Benchmark"]
+WORDS = ("the we should try a new approach for data model tests fix bug deploy review merge meeting "
+         "tomorrow today notes paper results plot api schema refactor python sql cache page slow fast "
+         "draft figure dataset training eval metric baseline idea question thanks done").split()
+FILE_TYPES = ["pdf", "docx", "txt", "png", "csv", "xlsx"]
+
+
+def _sentence(rng, low=4, high=18):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high))).capitalize() + "."
+
+
+def _date(rng, start, days, fmt="%Y-%m-%d %H:%M:%S"):
+    return (start + timedelta(seconds=rng.randrange(days * 86400))).strftime(fmt)
+
+
+def _code(rng, lines):
+    body = [f"def step_{i}(x):\n    return x * {rng.randint(2, 9)} + {i}\n" for i in range(max(lines // 3, 1))]
+    return "".join(body) + "\nprint(step_0(1))\n"
+
+
+def _batched(rows, size=BATCH):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Generator:
+    def __init__(self, conn, seed=0, days=365, out=sys.stdout):
+        self.conn = conn
+        self.rng = random.Random(seed)
+        self.days = days
+        self.start = datetime.now() - timedelta(days=days)
+        self.out = out
+
+    def _insert(self, label, sql, rows, total):
+        done = 0
+        started = time.perf_counter()
+        for batch in _batched(rows):
+            self.conn.executemany(sql, batch)
+            self.conn.commit()
+            done += len(batch)
+            rate = done / max(time.perf_counter() - started, 1e-9)
+            self.out.write(f"\r{label}: {done:,}/{total:,} ({rate:,.0f} rows/s)")
+            self.out.flush()
+        self.out.write(f"\r{label}: {done:,} rows in {time.perf_counter() - started:.1f}s\n")
+
+    def _max_id(self, table):
+        return self.conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+
+    def users(self, count):
+        first = self._max_id('users') + 1
+        rng = self.rng
+
+        def rows():
+            for uid in range(first, first + count):
+                institution = rng.choice(INSTITUTIONS)
+                yield (f"Gen User {uid}", f"user{uid}@{institution}.edu", f"{institution.title()} University",
+                       "Teacher" if rng.random() < 0.1 else "Student", _date(rng, self.start, self.days, "%Y-%m-%d"))
+        self._insert("users", "INSERT INTO users (name, email, institution, role, join_date) VALUES (?, ?, ?, ?, ?)",
+                     rows(), count)
+
+    def projects(self, count):
+        user_ids = self._ids('users')
+        rng = self.rng
+
+        def rows():
+            for _ in range(count):
+                title = f"{rng.choice(SUBJECTS)} {rng.choice(KINDS)} {rng.randint(1, 999)}"
+                yield (title, " ".join(_sentence(rng) for _ in range(3)), rng.choice(user_ids),
+                       _date(rng, self.start, self.days, "%Y-%m-%d"))
+        self._insert("projects", "INSERT INTO projects (title, description, created_by, created_date) VALUES (?, ?, ?, ?)",
+                     rows(), count)
+
+    # Creators first, then `per_project` random members on average
+    def memberships(self, per_project):
+        user_ids = self._ids('users')
+        projects = self.conn.execute("SELECT id, created_by FROM projects").fetchall()
+        rng = self.rng
+
+        def rows():
+            for project_id, created_by in projects:
+                if created_by is not None:
+                    yield (project_id, created_by)
+                for _ in range(rng.randint(0, max(2 * per_project - 1, 0))):
+                    yield (project_id, rng.choice(user_ids))
+        self._insert("memberships", "INSERT OR IGNORE INTO project_members (project_id, user_id) VALUES (?, ?)",
+                     rows(), len(projects) * (per_project + 1))
+
+    def _members(self):
+        members = {}
+        for project_id, user_id in self.conn.execute("SELECT project_id, user_id FROM project_members"):
+            members.setdefault(project_id, []).append(user_id)
+        return list(members.items())
+
+    def _ids(self, table):
+        ids = [row[0] for row in self.conn.execute(f"SELECT id FROM {table}")]
+        if not ids:
+            sys.exit(f"no {table} to attach to; generate some first")
+        return ids
+
+    # One to three skills per user and per project, and a team size limit
+    # on `limited` of the projects
+    def skills(self, limited=0.5):
+        skill_ids = self._ids('skills')
+        rng = self.rng
+
+        def rows(owners):
+            for owner_id in owners:
+                for skill_id in rng.sample(skill_ids, min(rng.randint(1, 3), len(skill_ids))):
+                    yield (owner_id, skill_id)
+        user_ids = self._ids('users')
+        self._insert("user skills", "INSERT OR IGNORE INTO user_skills (user_id, skill_id) VALUES (?, ?)",
+                     rows(user_ids), len(user_ids) * 2)
+        project_ids = self._ids('projects')
+        self._insert("project skills", "INSERT OR IGNORE INTO project_skills (project_id, skill_id) VALUES (?, ?)",
+                     rows(project_ids), len(project_ids) * 2)
+        sizes = ((rng.randint(3, 12), pid) for pid in project_ids if rng.random() < limited)
+        self._insert("team sizes", "UPDATE projects SET max_members=? WHERE id=?", sizes, int(len(project_ids) * limited))
+
+    # Chat and messages both come from a project's members
+    def _conversation(self, table, count):
+        members = self._members()
+        if not members:
+            sys.exit("no memberships to send messages from; generate some first")
+        rng = self.rng
+
+        def rows():
+            for _ in range(count):
+                project_id, user_ids = rng.choice(members)
+                yield (project_id, rng.choice(user_ids), _sentence(rng), _date(rng, self.start, self.days))
+        self._insert(table, f"INSERT INTO {table} (project_id, sender_id, message, sent_date) VALUES (?, ?, ?, ?)",
+                     rows(), count)
+
+    def chat(self, count):
+        self._conversation('project_chat', count)
+
+    def messages(self, count):
+        self._conversation('messages', count)
+
+    # A code snapshot for `share` of the projects
+    def code(self, share, lines=60):
+        projects = self._ids('projects')
+        rng = self.rng
+        chosen = [pid for pid in projects if rng.random() < share]
+        rows = ((pid, _code(rng, rng.randint(lines // 2, lines * 2))) for pid in chosen)
+        self._insert("code", """INSERT INTO project_code (project_id, code, rev) VALUES (?, ?, 0)
+                                ON CONFLICT(project_id) DO UPDATE SET code=excluded.code""", rows, len(chosen))
+
+    # Files share a small set of blobs, the way course handouts get uploaded
+    # to many projects
+    def files(self, count, distinct=50):
+        members = self._members()
+        rng = self.rng
+        blobs = []
+        for i in range(min(distinct, count)):
+            content = (f"generated file {i}\n" + "\n".join(_sentence(rng) for _ in range(rng.randint(5, 200)))).encode()
+            blobs.append(blobstore.store(self.conn, io.BytesIO(content)))
+        self.conn.commit()
+
+        def rows():
+            for i in range(count):
+                project_id, user_ids = rng.choice(members)
+                sha256, size = rng.choice(blobs)
+                yield (project_id, f"file_{i}.{rng.choice(FILE_TYPES)}", rng.choice(user_ids),
+                       _date(rng, self.start, self.days), sha256, size)
+        self._insert("files", """INSERT INTO project_files (project_id, filename, uploader_id, upload_date, sha256, size)
+                                 VALUES (?, ?, ?, ?, ?, ?)""", rows(), count)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fill a database with synthetic users, projects and activity.")
+    parser.add_argument("--db", default=db.DB_PATH, help="database file (created and migrated if needed)")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--projects", type=int, default=200)
+    parser.add_argument("--members", type=int, default=5, help="average members per project, besides the creator")
+    parser.add_argument("--skills", type=float, default=0.5,
+                        help="give users and projects skills, and this share of projects a team size limit")
+    parser.add_argument("--chat", type=int, default=10000, help="project chat messages")
+    parser.add_argument("--messages", type=int, default=20000, help="Messages page messages")
+    parser.add_argument("--code", type=float, default=0.5, help="share of projects with saved code")
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--days", type=int, default=365, help="spread activity over this many days")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    pool = db.ConnectionPool(args.db, size=1)
+    migrations.migrate(pool)
+    started = time.perf_counter()
+    with pool.connection() as conn:
+        gen = Generator(conn, seed=args.seed, days=args.days)
+
+        with stats.bulk_load(conn):
+            if args.users:
+                gen.users(args.users)
+            if args.projects:
+                gen.projects(args.projects)
+            if args.members and args.projects:
+                gen.memberships(args.members)
+            if args.skills and args.users and args.projects:
+                gen.skills(args.skills)
+            if args.chat:
+                gen.chat(args.chat)
+            if args.messages:
+                gen.messages(args.messages)
+            if args.code:
+                gen.code(args.code)
+            if args.files:
+                gen.files(args.files)
+        conn.execute("PRAGMA optimize")
+    pool.close()
+    print(f"Done in {time.perf_counter() - started:.1f}s: {args.db}")
+
+
+if __name__ == "__main__":
+    main()
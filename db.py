@@ -0,0 +1,218 @@
+import contextvars
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+DB_PATH = 'student_projects.db'
+POOL_SIZE = 8
+POOL_TIMEOUT = 10
+# Sharding (shards.py): with EDUCOLLAB_SHARD_DIR set, each institution gets
+# its own database file in that directory, and get_pool() hands out the pool
+# of whichever shard is current
+SHARD_DIR = os.environ.get("EDUCOLLAB_SHARD_DIR") or None
+SHARD_POOL_SIZE = 4
+STATEMENT_CACHE_SIZE = 256
+
+# Applied to every new connection. WAL lets readers run alongside the single
+# writer, so concurrent sessions stop tripping over "database is locked".
+# auto_vacuum only takes on a new, empty file; archive.py hands back the
+# space its runs free with incremental_vacuum.
+PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",
+)
+
+
+class ConnectionPool:
+    def __init__(self, path=DB_PATH, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {'hits': 0, 'misses': 0, 'waits': 0, 'wait_time': 0.0, 'max_wait': 0.0}
+
+    def _connect(self):
+        # cached_statements keeps prepared statements around per connection,
+        # so the same SQL text is only compiled once for the life of the pool.
+        # The factory times every statement for metrics.py.
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE, factory=metrics.connection_factory())
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    # A connection of our own, outside the pool, for a thread that keeps one
+    # for its whole life (the write-behind writer) and must never have to
+    # wait behind the sessions it is serving
+    def connect(self):
+        return self._connect()
+
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self._stats['hits'] += 1
+            return conn
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                self._stats['misses'] += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        # Pool exhausted: wait for another thread to hand a connection back
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("timed out waiting for a database connection")
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._stats['waits'] += 1
+            self._stats['wait_time'] += waited
+            self._stats['max_wait'] = max(self._stats['max_wait'], waited)
+        return conn
+
+    def release(self, conn):
+        # Never hand out a connection with a half-finished transaction
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        # Re-entrant per thread: nested blocks share the outer connection
+        local = self._local
+        if getattr(local, 'conn', None) is not None:
+            local.depth += 1
+            try:
+                yield local.conn
+            finally:
+                local.depth -= 1
+            return
+        conn = self.acquire()
+        local.conn = conn
+        local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            local.conn = None
+            local.depth = 0
+            self.release(conn)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['open'] = self._created
+        stats['idle'] = self._idle.qsize()
+        stats['in_use'] = stats['open'] - stats['idle']
+        requests = stats['hits'] + stats['misses'] + stats['waits']
+        stats['hit_rate'] = (stats['hits'] + stats['waits']) / requests if requests else 0.0
+        stats['avg_wait'] = stats['wait_time'] / stats['waits'] if stats['waits'] else 0.0
+        return stats
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._created -= 1
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_shard_pools = {}
+_current_shard = contextvars.ContextVar("shard", default=None)
+
+
+def shard_path(shard):
+    return os.path.join(SHARD_DIR, f"{shard}.db")
+
+
+# The pool for `shard`, or for the current shard (see use_shard()), or the
+# single database when nothing is sharded
+def get_pool(shard=None):
+    global _pool
+    shard = shard or _current_shard.get()
+    if shard is not None:
+        pool = _shard_pools.get(shard)
+        if pool is None:
+            with _pool_lock:
+                pool = _shard_pools.get(shard)
+                if pool is None:
+                    pool = _shard_pools[shard] = ConnectionPool(shard_path(shard), size=SHARD_POOL_SIZE)
+        return pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+# Point the single-database pool at another file (CLIs taking --db); the
+# pool it replaces is closed
+def set_database(path):
+    global _pool
+    with _pool_lock:
+        old, _pool = _pool, ConnectionPool(path)
+    if old is not None:
+        old.close()
+
+
+def current_shard():
+    return _current_shard.get()
+
+
+# Route db.connection() (and everything built on get_pool()) to `shard` for
+# the duration of the block
+@contextmanager
+def use_shard(shard):
+    token = _current_shard.set(shard)
+    try:
+        yield
+    finally:
+        _current_shard.reset(token)
+
+
+# Make `shard` current for the rest of this thread's work, e.g. a session's
+# home shard for a whole Streamlit rerun
+def set_shard(shard):
+    _current_shard.set(shard)
+
+
+def connection():
+    return get_pool().connection()
+
+
+def pool_stats():
+    return get_pool().stats()
@@ -1,50 +1,57 @@
 import streamlit as st
-import re
-from datetime import datetime
-import sqlite3
-from streamlit_ace import st_ace
+import html
 from streamlit_monaco import st_monaco
-import subprocess
-import sys
-
-# Initialize database
-def init_db():
-    conn = sqlite3.connect('student_projects.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY, name TEXT, email TEXT, institution TEXT, 
-                  role TEXT, join_date TEXT, profile_pic TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS projects
-                 (id INTEGER PRIMARY KEY, title TEXT, description TEXT, 
-                  created_by INTEGER, created_date TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS project_members
-                 (project_id INTEGER, user_id INTEGER)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS messages
-                 (id INTEGER PRIMARY KEY, project_id INTEGER, sender_id INTEGER,
-                  message TEXT, sent_date TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS project_code (project_id INTEGER PRIMARY KEY, code TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS project_chat (project_id INTEGER, sender_id INTEGER, message TEXT, sent_date TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS project_files (id INTEGER PRIMARY KEY, project_id INTEGER, filename TEXT, uploader_id INTEGER, upload_date TEXT)''')
-    try:
-        c.execute('ALTER TABLE users ADD COLUMN profile_pic TEXT')
-    except sqlite3.OperationalError:
-        pass
-    conn.commit()
-    conn.close()
-
-def is_edu_email(email):
-    # Check if email ends with .edu or similar educational domains
-    edu_domains = ['.edu', '.ac.', '.edu.']
-    return any(domain in email.lower() for domain in edu_domains)
-
-def user_profile_card(name, role, projects_involved, lines_of_code):
+import db
+import migrations
+import data
+import page_data
+import code_runner
+import blobstore
+import avatars
+import cache
+import metrics
+import writer
+import recommend
+import shards
+import archive
+import actions
+import api
+
+
+# The whole message list as one markdown block instead of a widget per message
+def render_messages(rows):
+    if not rows:
+        st.caption("No messages yet.")
+        return
+    items = "".join(
+        f"<div style='padding:6px 10px;border-bottom:1px solid #eee;'>"
+        f"<b>{html.escape(name or 'Unknown')}</b> <span style='color:#888;font-size:0.85em;'>({html.escape(sent_date or '')})</span><br>"
+        f"{html.escape(message or '').replace(chr(10), '<br>')}</div>"
+        for _, message, name, sent_date in rows
+    )
+    st.markdown(f"<div style='max-height:500px;overflow-y:auto;border:1px solid #ddd;border-radius:8px;'>{items}</div>",
+                unsafe_allow_html=True)
+
+# Blob store download link; files from before the blob store keep their old path
+def file_link(project_id, file):
+    if file[3]:
+        return blobstore.file_url(file[3], file[0])
+    return f"project_uploads/{project_id}_{file[0]}"
+
+def user_profile_card(name, role, projects_involved, lines_of_code, last_activity=None, profile_pic=None):
     initials = "".join([n[0] for n in name.split()][:2]).upper()
+    # 48px thumbnail when there is one, initials otherwise
+    avatar_src = avatars.avatar_url(profile_pic, 48)
+    if avatar_src:
+        avatar = f"<img src='{avatar_src}' width='48' height='48' style='border-radius:50%;margin-right:12px;object-fit:cover;'>"
+    else:
+        avatar = f"""<div style='background:#1976d2;color:white;border-radius:50%;width:48px;height:48px;display:flex;align-items:center;justify-content:center;font-size:1.5em;font-weight:bold;margin-right:12px;'>
+                {initials}
+            </div>"""
     card_html = f"""
     <div style='background:white;border-radius:12px;box-shadow:0 2px 8px #eee;padding:20px 24px 16px 24px;width:270px;display:inline-block;margin:10px;'>
         <div style='display:flex;align-items:center;'>
-            <div style='background:#1976d2;color:white;border-radius:50%;width:48px;height:48px;display:flex;align-items:center;justify-content:center;font-size:1.5em;font-weight:bold;margin-right:12px;'>
-                {initials}
-            </div>
+            {avatar}
             <div>
                 <div style='font-weight:600;font-size:1.1em;color:#000;'>{name}</div>
                 <div style='color:#000;font-size:0.95em;'>{role}</div>
@@ -58,29 +65,190 @@ def user_profile_card(name, role, projects_involved, lines_of_code):
         <div style='display:flex;justify-content:space-between;font-size:1.08em;font-weight:500;color:#000;'>
             <div style='color:#000;'>Total Lines of Code</div><div style='color:#000;'>{lines_of_code}</div>
         </div>
+        <div style='color:#555;font-size:0.85em;margin-top:8px;'>Last active: {last_activity or "-"}</div>
     </div>
     """
     st.markdown(card_html, unsafe_allow_html=True)
 
+# --- Project panels. Each panel is a fragment: a button inside it reruns
+# just that panel, not the whole page. The editor, chat, files and invite form
+# only mount once the panel is opened.
+
+def code_editor(conn, project_id):
+    st.subheader("Collaborative Code Editor (Prototype)")
+    st.caption("Note: Saving merges your changes with edits other members saved in the meantime.")
+    editor = page_data.editor_session(st.session_state, conn, project_id)
+    new_code = st_monaco(
+        value=editor.pull(conn),
+        language="python",
+        theme="vs-dark",
+        height=300
+    )
+    if new_code is not None:
+        editor.buffer = new_code
+    if st.button(f"Save Code {project_id}"):
+        if editor.push(conn, st.session_state.user_id):
+            st.success("Code saved!")
+        else:
+            st.info("No changes to save.")
+    # Code execution (Python only, demo)
+    if st.button(f"Run Code {project_id}"):
+        try:
+            with st.spinner("Running..."), metrics.timed("code_run"):
+                result = code_runner.get_runner().run(st.session_state.user_id, editor.buffer)
+            st.code(result.output, language="text")
+        except code_runner.QueueFull as e:
+            st.warning(str(e))
+        except Exception as e:
+            st.error(f"Error running code: {e}")
+
+def project_chat(conn, project_id, key):
+    st.subheader("Project Chat")
+    feed = page_data.chat_feed(st.session_state, conn, project_id)
+    chat_box = st.container()
+    chat_input = st.text_input(f"New chat message for project {project_id}", key=key)
+    if st.button(f"Send Chat {project_id}"):
+        if chat_input.strip():
+            try:
+                actions.send_chat(conn, st.session_state.user_id, project_id, chat_input)
+            except writer.QueueFull as e:
+                st.warning(str(e))
+    # Filled in after the send so a new message shows up without a rerun
+    with chat_box:
+        for msg in feed.poll(conn):
+            st.markdown(f"**{msg[2]}** ({msg[3]}): {msg[1]}")
+
+def project_files(conn, project_id, can_upload, key):
+    st.subheader("Project Files")
+    if can_upload:
+        uploaded_file = st.file_uploader(f"Upload a file for this project", type=list(actions.FILE_TYPES), key=key)
+        # The file stays in the uploader across reruns; store it once
+        if uploaded_file and st.session_state.get(f"{key}_stored") != uploaded_file.file_id:
+            uploaded_file.seek(0)
+            try:
+                if actions.upload_file(conn, st.session_state.user_id, project_id, uploaded_file.name, uploaded_file):
+                    st.success("File uploaded!")
+                st.session_state[f"{key}_stored"] = uploaded_file.file_id
+            except (actions.ActionError, writer.QueueFull) as e:
+                st.warning(str(e))
+    # List files
+    files = data.project_files(conn, project_id)
+    if files:
+        for file in files:
+            st.markdown(f"- [{file[0]}]({file_link(project_id, file)}) uploaded by {file[1]} on {file[2]}")
+    else:
+        st.caption("No files uploaded yet.")
+
+def invite_form(conn, project_id, key):
+    st.subheader("Invite User by Email")
+    invite_email = st.text_input(f"Invite user to project {project_id}", key=key)
+    if st.button(f"Send Invite {project_id}"):
+        try:
+            if actions.invite(conn, st.session_state.user_id, project_id, invite_email):
+                st.success("User invited and added to the project!")
+            else:
+                st.info("User is already a member of this project.")
+        except actions.ActionError as e:
+            st.error(str(e))
+        except writer.QueueFull as e:
+            st.warning(str(e))
+
+# One project on Browse Projects
+@st.fragment
+@metrics.instrument_fragment("Browse Projects: panel")
+def browse_panel(project):
+    with st.container(border=True), shards.project_connection(project[0]) as conn:
+        st.markdown(f"**Project: {project[1]}**")
+        if project[6]:
+            st.markdown(f"Match: {project[6]}")
+        st.write(f"Description: {project[2]}")
+        st.write(f"Created by: {project[5]}")
+
+        # Check if user is already a member
+        is_member = actions.is_member(conn, st.session_state.user_id, project[0])
+
+        if not is_member:
+            if st.button(f"Join Project {project[0]}"):
+                try:
+                    actions.join_project(conn, st.session_state.user_id, project[0])
+                    is_member = True
+                    st.success("Joined project successfully!")
+                except writer.QueueFull as e:
+                    st.warning(str(e))
+        else:
+            st.info("You are already a member of this project")
+
+        if not st.toggle("Open project", key=f"open_{project[0]}"):
+            return
+        code_editor(conn, project[0])
+        project_chat(conn, project[0], f"chat_input_{project[0]}")
+        is_creator = project[3] == st.session_state.user_id
+        project_files(conn, project[0], is_member or is_creator, f"file_upload_{project[0]}")
+        # Project invitations (only for creator)
+        if is_creator:
+            invite_form(conn, project[0], f"invite_email_{project[0]}")
+
+# One project on My Projects
+@st.fragment
+@metrics.instrument_fragment("My Projects: panel")
+def my_project_panel(project):
+    with st.container(border=True), shards.project_connection(project[0]) as conn:
+        st.markdown(f"**Project: {project[1]}**")
+        st.write(f"Description: {project[2]}")
+        st.write(f"Start Date: {project[4]}")
+
+        # Show team members
+        members = page_data.team(conn, project[0])
+
+        st.write("Team:")
+        for member in members.values():
+            st.write(f"- {member[1]} ({member[4]})")
+
+        if not st.toggle("Open project", key=f"open_my_{project[0]}"):
+            return
+        is_creator = project[3] == st.session_state.user_id
+        # Creators get people whose skills fit what the project needs
+        if is_creator:
+            suggested = page_data.suggested_teammates(conn, project[0])
+            if suggested:
+                st.write("Suggested teammates:")
+                st.markdown("\n".join(f"- {person[1]} ({person[4]}, {person[2]}): {score:.0%} skill match"
+                                      for person, score in suggested))
+        code_editor(conn, project[0])
+        project_chat(conn, project[0], f"chat_input_my_{project[0]}")
+        project_files(conn, project[0], is_creator, f"file_upload_my_{project[0]}")
+        # Project invitations (only for creator)
+        if is_creator:
+            invite_form(conn, project[0], f"invite_email_my_{project[0]}")
+
+@metrics.instrument_rerun
 def main():
     st.title("Student Project Collaboration Platform (Prototype)")
     st.sidebar.image("https://img.icons8.com/color/96/000000/student-center.png", width=100)
     
-    # Initialize database
-    init_db()
+    # Bring the schema up to date (no-op after the first run in this process).
+    # Shards are migrated as they are first opened instead.
+    if not db.SHARD_DIR:
+        migrations.migrate()
+    # /metrics endpoint, if EDUCOLLAB_METRICS_PORT is set
+    metrics.start_server()
+    # Background archiving of old chat, if EDUCOLLAB_ARCHIVE_EVERY_HOURS is set
+    archive.start_scheduler()
+    # JSON API for mobile and LMS clients, if EDUCOLLAB_API_PORT is set
+    api.start_server()
     
     # Session state for login
     if 'user_id' not in st.session_state:
         st.session_state.user_id = None
+    # Sharded: this session's queries go to the user's institution
+    shards.bind(st.session_state.user_id)
 
     # Always fetch user info if logged in
     if st.session_state.user_id is not None:
-        conn = sqlite3.connect('student_projects.db')
-        c = conn.cursor()
-        user = c.execute("SELECT name, role FROM users WHERE id=?", (st.session_state.user_id,)).fetchone()
-        conn.close()
+        with db.connection() as conn:
+            user = page_data.current_user(conn, st.session_state.user_id)
         if user:
-            st.session_state.user_info = {'name': user[0], 'role': user[1]}
+            st.session_state.user_info = {'name': user[1], 'role': user[4], 'email': user[2]}
         else:
             st.session_state.user_info = None
     else:
@@ -105,7 +273,10 @@ def main():
         menu = "Login/Register"
     else:
         menu_options = ["Create Project", "Browse Projects", "My Projects", "Messages", "Community", "Logout", "Profile"]
+        if metrics.is_admin((st.session_state.user_info or {}).get('email')):
+            menu_options.append("Admin")
         menu = st.sidebar.selectbox("Menu", menu_options)
+    metrics.set_page(menu)
     
     if menu == "Login/Register":
         col1, col2 = st.columns(2)
@@ -115,16 +286,15 @@ def main():
             with st.form("login_form"):
                 login_email = st.text_input("Email")
                 if st.form_submit_button("Login"):
-                    conn = sqlite3.connect('student_projects.db')
-                    c = conn.cursor()
-                    user = c.execute("SELECT id FROM users WHERE email=?", (login_email,)).fetchone()
-                    conn.close()
-                    if user:
-                        st.session_state.user_id = user[0]
+                    try:
+                        user_id = actions.login(login_email)
+                    except actions.NotFound as e:
+                        user_id = None
+                        st.error(str(e))
+                    if user_id:
+                        st.session_state.user_id = user_id
                         st.success("Logged in successfully!")
                         st.rerun()
-                    else:
-                        st.error("User not found")
         
         with col2:
             st.header("Register")
@@ -135,16 +305,11 @@ def main():
                 role = st.selectbox("Role", ["Student", "Teacher"])
                 
                 if st.form_submit_button("Register"):
-                    if not is_edu_email(email):
-                        st.error("Please use an educational email address")
-                    else:
-                        conn = sqlite3.connect('student_projects.db')
-                        c = conn.cursor()
-                        c.execute("INSERT INTO users (name, email, institution, role, join_date) VALUES (?, ?, ?, ?, ?)",
-                                (name, email, institution, role, datetime.now().strftime("%Y-%m-%d")))
-                        conn.commit()
-                        conn.close()
+                    try:
+                        actions.register(name, email, institution, role)
                         st.success("Registration successful! Please login.")
+                    except actions.ActionError as e:
+                        st.error(str(e))
 
     elif menu == "Create Project":
         st.header("Create New Project")
@@ -152,377 +317,210 @@ def main():
         with st.form("project_form"):
             title = st.text_input("Project Title")
             description = st.text_area("Project Description")
-            skills_needed = st.multiselect("Skills Needed", 
-                ["Programming", "Design", "Writing", "Research", "Data Analysis"])
+            with db.connection() as conn:
+                skills_needed = st.multiselect("Skills Needed", page_data.skill_names(conn))
             max_members = st.number_input("Maximum Team Members", min_value=2, value=5)
             
             if st.form_submit_button("Create Project"):
-                conn = sqlite3.connect('student_projects.db')
-                c = conn.cursor()
-                c.execute("INSERT INTO projects (title, description, created_by, created_date) VALUES (?, ?, ?, ?)",
-                         (title, description, st.session_state.user_id, datetime.now().strftime("%Y-%m-%d")))
-                project_id = c.lastrowid
-                # Add creator as first member
-                c.execute("INSERT INTO project_members (project_id, user_id) VALUES (?, ?)",
-                         (project_id, st.session_state.user_id))
-                conn.commit()
-                conn.close()
-                st.success("Project created successfully!")
+                try:
+                    with db.connection() as conn:
+                        actions.create_project(conn, st.session_state.user_id, title, description,
+                                               skills_needed, max_members)
+                    st.success("Project created successfully!")
+                except actions.ActionError as e:
+                    st.error(str(e))
 
     elif menu == "Browse Projects":
         st.header("Available Projects")
         
         # Search and filter
         search = st.text_input("Search projects")
+        page_size = st.selectbox("Projects per page", [10, 20, 50, 100], index=1)
+
+        # Keyset pagination: a stack of "before id" cursors, one per page visited
+        if st.session_state.get("browse_query") != (search, page_size):
+            st.session_state.browse_query = (search, page_size)
+            st.session_state.browse_cursors = [None]
+        cursors = st.session_state.browse_cursors
         
-        conn = sqlite3.connect('student_projects.db')
-        c = conn.cursor()
-        if search:
-            projects = c.execute("SELECT * FROM projects WHERE title LIKE ? OR description LIKE ?",
-                               (f"%{search}%", f"%{search}%")).fetchall()
-        else:
-            projects = c.execute("SELECT * FROM projects").fetchall()
-        
-        for project in projects:
-            with st.expander(f"Project: {project[1]}"):
-                st.write(f"Description: {project[2]}")
-                creator = c.execute("SELECT name FROM users WHERE id=?", (project[3],)).fetchone()
-                st.write(f"Created by: {creator[0]}")
-                
-                # Check if user is already a member
-                is_member = c.execute("""
-                    SELECT 1 FROM project_members 
-                    WHERE project_id=? AND user_id=?
-                """, (project[0], st.session_state.user_id)).fetchone()
-                
-                if not is_member:
-                    if st.button(f"Join Project {project[0]}"):
-                        c.execute("INSERT INTO project_members (project_id, user_id) VALUES (?, ?)",
-                                 (project[0], st.session_state.user_id))
-                        conn.commit()
-                        st.success("Joined project successfully!")
-                else:
-                    st.info("You are already a member of this project")
-                
-                # --- Collaborative Code Editor (Prototype) ---
-                st.subheader("Collaborative Code Editor (Prototype)")
-                st.caption("Note: Code is saved per project. Not real-time collaborative.")
-                # Load last code for this project
-                code_row = c.execute("SELECT code FROM project_code WHERE project_id=?", (project[0],)).fetchone()
-                code = code_row[0] if code_row else ""
-                new_code = st_monaco(
-                    value=code,
-                    language="python",
-                    theme="vs-dark",
-                    height=300
-                )
-                if st.button(f"Save Code {project[0]}"):
-                    if code_row:
-                        c.execute("UPDATE project_code SET code=? WHERE project_id=?", (new_code, project[0]))
-                    else:
-                        c.execute("INSERT INTO project_code (project_id, code) VALUES (?, ?)", (project[0], new_code))
-                    conn.commit()
-                    st.success("Code saved!")
-                # Code execution (Python only, demo)
-                if st.button(f"Run Code {project[0]}"):
-                    try:
-                        # Save code to temp file
-                        with open("temp_code.py", "w", encoding="utf-8") as f:
-                            f.write(new_code)
-                        result = subprocess.run([sys.executable, "temp_code.py"], capture_output=True, text=True, timeout=5)
-                        st.code(result.stdout + result.stderr, language="text")
-                    except Exception as e:
-                        st.error(f"Error running code: {e}")
-                # --- Project Chat ---
-                st.subheader("Project Chat")
-                chat_msgs = c.execute("SELECT message, sender_id, sent_date FROM project_chat WHERE project_id=? ORDER BY sent_date DESC LIMIT 10", (project[0],)).fetchall()
-                for msg in reversed(chat_msgs):
-                    sender = c.execute("SELECT name FROM users WHERE id=?", (msg[1],)).fetchone()
-                    st.markdown(f"**{sender[0]}** ({msg[2]}): {msg[0]}")
-                chat_input = st.text_input(f"New chat message for project {project[0]}", key=f"chat_input_{project[0]}")
-                if st.button(f"Send Chat {project[0]}"):
-                    if chat_input.strip():
-                        c.execute("INSERT INTO project_chat (project_id, sender_id, message, sent_date) VALUES (?, ?, ?, ?)",
-                                  (project[0], st.session_state.user_id, chat_input, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-                        conn.commit()
-                        st.rerun()
-                # --- Project File Uploads ---
-                st.subheader("Project Files")
-                if is_member or ("created_by" in project and project[3] == st.session_state.user_id):
-                    uploaded_file = st.file_uploader(f"Upload a file for this project", type=["pdf", "docx", "txt", "png", "jpg", "jpeg", "csv", "xlsx"], key=f"file_upload_{project[0]}")
-                    if uploaded_file:
-                        import os
-                        os.makedirs("project_uploads", exist_ok=True)
-                        file_path = f"project_uploads/{project[0]}_{uploaded_file.name}"
-                        with open(file_path, "wb") as f:
-                            f.write(uploaded_file.getbuffer())
-                        c.execute("INSERT INTO project_files (project_id, filename, uploader_id, upload_date) VALUES (?, ?, ?, ?)",
-                                  (project[0], uploaded_file.name, st.session_state.user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-                        conn.commit()
-                        st.success("File uploaded!")
-                # List files
-                files = c.execute("SELECT filename, uploader_id, upload_date FROM project_files WHERE project_id=?", (project[0],)).fetchall()
-                if files:
-                    for file in files:
-                        uploader = c.execute("SELECT name FROM users WHERE id=?", (file[1],)).fetchone()
-                        st.markdown(f"- [{file[0]}](project_uploads/{project[0]}_{file[0]}) uploaded by {uploader[0]} on {file[2]}")
-                else:
-                    st.caption("No files uploaded yet.")
-                # --- Project Invitations (only for creator) ---
-                if "created_by" in project and project[3] == st.session_state.user_id:
-                    st.subheader("Invite User by Email")
-                    invite_email = st.text_input(f"Invite user to project {project[0]}", key=f"invite_email_{project[0]}")
-                    if st.button(f"Send Invite {project[0]}"):
-                        invited_user = c.execute("SELECT id FROM users WHERE email=?", (invite_email,)).fetchone()
-                        if not invited_user:
-                            st.error("No user found with that email.")
-                        else:
-                            already_member = c.execute("SELECT 1 FROM project_members WHERE project_id=? AND user_id=?", (project[0], invited_user[0])).fetchone()
-                            if already_member:
-                                st.info("User is already a member of this project.")
-                            else:
-                                c.execute("INSERT INTO project_members (project_id, user_id) VALUES (?, ?)", (project[0], invited_user[0]))
-                                conn.commit()
-                                st.success("User invited and added to the project!")
+        with db.connection() as conn:
+            projects, next_cursor, recommended = page_data.browse(conn, st.session_state.user_id, search,
+                                                                  cursors[-1], page_size)
+
+            if not projects:
+                st.info("No projects found.")
+
+            # Skill matches, on the first page of the unfiltered list
+            if recommended:
+                st.subheader("Recommended for you")
+                st.markdown("\n".join(f"- **{title}** ({score:.0%} skill match)" for title, score in recommended))
         
-        conn.close()
+            for project in projects:
+                browse_panel(project)
+
+        # Page navigation
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col1:
+            if len(cursors) > 1 and st.button("Previous page"):
+                cursors.pop()
+                st.rerun()
+        with col2:
+            st.caption(f"Page {len(cursors)}")
+        with col3:
+            if next_cursor is not None and st.button("Next page"):
+                cursors.append(next_cursor)
+                st.rerun()
 
     elif menu == "My Projects":
         st.header("My Projects")
         
-        conn = sqlite3.connect('student_projects.db')
-        c = conn.cursor()
-        my_projects = c.execute("""
-            SELECT p.*, COUNT(pm.user_id) as member_count 
-            FROM projects p
-            JOIN project_members pm ON p.id = pm.project_id
-            WHERE p.id IN (
-                SELECT project_id FROM project_members WHERE user_id=?
-            )
-            GROUP BY p.id
-        """, (st.session_state.user_id,)).fetchall()
-        
-        for project in my_projects:
-            with st.expander(f"Project: {project[1]}"):
-                st.write(f"Description: {project[2]}")
-                st.write(f"Start Date: {project[4]}")
-                
-                # Show team members
-                members = c.execute("""
-                    SELECT u.name, u.role FROM users u
-                    JOIN project_members pm ON u.id = pm.user_id
-                    WHERE pm.project_id=?
-                """, (project[0],)).fetchall()
-                
-                st.write("Team:")
-                for member in members:
-                    st.write(f"- {member[0]} ({member[1]})")
-                
-                # --- Collaborative Code Editor (Prototype) ---
-                st.subheader("Collaborative Code Editor (Prototype)")
-                st.caption("Note: Code is saved per project. Not real-time collaborative.")
-                c.execute("""CREATE TABLE IF NOT EXISTS project_code (project_id INTEGER PRIMARY KEY, code TEXT)""")
-                code_row = c.execute("SELECT code FROM project_code WHERE project_id=?", (project[0],)).fetchone()
-                code = code_row[0] if code_row else ""
-                new_code = st_monaco(
-                    value=code,
-                    language="python",
-                    theme="vs-dark",
-                    height=300
-                )
-                if st.button(f"Save Code {project[0]}"):
-                    if code_row:
-                        c.execute("UPDATE project_code SET code=? WHERE project_id=?", (new_code, project[0]))
-                    else:
-                        c.execute("INSERT INTO project_code (project_id, code) VALUES (?, ?)", (project[0], new_code))
-                    conn.commit()
-                    st.success("Code saved!")
-                # Code execution (Python only, demo)
-                if st.button(f"Run Code {project[0]}"):
-                    try:
-                        with open("temp_code.py", "w", encoding="utf-8") as f:
-                            f.write(new_code)
-                        result = subprocess.run([sys.executable, "temp_code.py"], capture_output=True, text=True, timeout=5)
-                        st.code(result.stdout + result.stderr, language="text")
-                    except Exception as e:
-                        st.error(f"Error running code: {e}")
-                # --- Project Chat ---
-                st.subheader("Project Chat")
-                chat_msgs = c.execute("SELECT message, sender_id, sent_date FROM project_chat WHERE project_id=? ORDER BY sent_date DESC LIMIT 10", (project[0],)).fetchall()
-                for msg in reversed(chat_msgs):
-                    sender = c.execute("SELECT name FROM users WHERE id=?", (msg[1],)).fetchone()
-                    st.markdown(f"**{sender[0]}** ({msg[2]}): {msg[0]}")
-                chat_input = st.text_input(f"New chat message for project {project[0]}", key=f"chat_input_my_{project[0]}")
-                if st.button(f"Send Chat {project[0]}"):
-                    if chat_input.strip():
-                        c.execute("INSERT INTO project_chat (project_id, sender_id, message, sent_date) VALUES (?, ?, ?, ?)",
-                                  (project[0], st.session_state.user_id, chat_input, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-                        conn.commit()
-                        st.rerun()
-                # --- Project File Uploads ---
-                st.subheader("Project Files")
-                if ("created_by" in project and project[3] == st.session_state.user_id):
-                    uploaded_file = st.file_uploader(f"Upload a file for this project", type=["pdf", "docx", "txt", "png", "jpg", "jpeg", "csv", "xlsx"], key=f"file_upload_my_{project[0]}")
-                    if uploaded_file:
-                        import os
-                        os.makedirs("project_uploads", exist_ok=True)
-                        file_path = f"project_uploads/{project[0]}_{uploaded_file.name}"
-                        with open(file_path, "wb") as f:
-                            f.write(uploaded_file.getbuffer())
-                        c.execute("INSERT INTO project_files (project_id, filename, uploader_id, upload_date) VALUES (?, ?, ?, ?)",
-                                  (project[0], uploaded_file.name, st.session_state.user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-                        conn.commit()
-                        st.success("File uploaded!")
-                # List files
-                files = c.execute("SELECT filename, uploader_id, upload_date FROM project_files WHERE project_id=?", (project[0],)).fetchall()
-                if files:
-                    for file in files:
-                        uploader = c.execute("SELECT name FROM users WHERE id=?", (file[1],)).fetchone()
-                        st.markdown(f"- [{file[0]}](project_uploads/{project[0]}_{file[0]}) uploaded by {uploader[0]} on {file[2]}")
-                else:
-                    st.caption("No files uploaded yet.")
-                # --- Project Invitations (only for creator) ---
-                if "created_by" in project and project[3] == st.session_state.user_id:
-                    st.subheader("Invite User by Email")
-                    invite_email = st.text_input(f"Invite user to project {project[0]}", key=f"invite_email_my_{project[0]}")
-                    if st.button(f"Send Invite {project[0]}"):
-                        invited_user = c.execute("SELECT id FROM users WHERE email=?", (invite_email,)).fetchone()
-                        if not invited_user:
-                            st.error("No user found with that email.")
-                        else:
-                            already_member = c.execute("SELECT 1 FROM project_members WHERE project_id=? AND user_id=?", (project[0], invited_user[0])).fetchone()
-                            if already_member:
-                                st.info("User is already a member of this project.")
-                            else:
-                                c.execute("INSERT INTO project_members (project_id, user_id) VALUES (?, ?)", (project[0], invited_user[0]))
-                                conn.commit()
-                                st.success("User invited and added to the project!")
+        with db.connection() as conn:
+            my_projects = page_data.my_projects(conn, st.session_state.user_id)
         
-        conn.close()
+            for project in my_projects:
+                my_project_panel(project)
 
     elif menu == "Messages":
         st.header("Project Messages")
         
-        conn = sqlite3.connect('student_projects.db')
-        c = conn.cursor()
-        
-        # Get user's projects
-        projects = c.execute("""
-            SELECT p.id, p.title FROM projects p
-            JOIN project_members pm ON p.id = pm.project_id
-            WHERE pm.user_id=?
-        """, (st.session_state.user_id,)).fetchall()
+        with db.connection() as conn:
+            # Get user's projects
+            projects = page_data.message_projects(conn, st.session_state.user_id)
         
         if projects:
             selected_project = st.selectbox("Select Project", 
                 [p[1] for p in projects], key='selected_project')
             project_id = projects[[p[1] for p in projects].index(selected_project)][0]
             
-            # Show messages
-            messages = c.execute("""
-                SELECT m.message, u.name, m.sent_date 
-                FROM messages m
-                JOIN users u ON m.sender_id = u.id
-                WHERE m.project_id=?
-                ORDER BY m.sent_date DESC
-            """, (project_id,)).fetchall()
-            
-            st.write("Messages:")
-            for i, msg in enumerate(messages):
-                st.text_area(
-                    "",
-                    f"{msg[1]} ({msg[2]}): {msg[0]}",
-                    height=70,
-                    disabled=True,
-                    key=f"msg_{i}_{msg[2]}"
-                )
+            # The rest of the page reads and writes the project's own shard
+            with shards.project_connection(project_id) as conn:
+                # Show messages: a window of the latest page, extended on demand
+                jump_to = st.date_input("Jump to date", value=None, key="message_jump")
+                window = page_data.message_window(st.session_state, conn, project_id, jump_to)
+
+                st.write("Messages:")
+                message_box = st.container()
+                if window['more'] and st.button("Load older messages"):
+                    page_data.older_messages(conn, window)
+                with message_box:
+                    render_messages(window['rows'])
             
-            # Before the form, check if we need to clear the text area
-            if "clear_new_message" in st.session_state and st.session_state["clear_new_message"]:
-                st.session_state["new_message"] = ""
-                st.session_state["clear_new_message"] = False
-
-            with st.form("message_form"):
-                message = st.text_area("New Message", key="new_message")
-                if st.form_submit_button("Send"):
-                    if message.strip():
-                        c.execute(
-                            "INSERT INTO messages (project_id, sender_id, message, sent_date) VALUES (?, ?, ?, ?)",
-                            (project_id, st.session_state.user_id, message, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-                        )
-                        conn.commit()
-                        st.success("Message sent!")
-                        st.session_state["clear_new_message"] = True  # Set flag to clear on next run
-                        st.rerun()
-                    else:
-                        st.warning("Cannot send an empty message.")
+                # Before the form, check if we need to clear the text area
+                if "clear_new_message" in st.session_state and st.session_state["clear_new_message"]:
+                    st.session_state["new_message"] = ""
+                    st.session_state["clear_new_message"] = False
+
+                with st.form("message_form"):
+                    message = st.text_area("New Message", key="new_message")
+                    if st.form_submit_button("Send"):
+                        try:
+                            actions.send_message(conn, st.session_state.user_id, project_id, message)
+                            sent = True
+                        except (actions.ActionError, writer.QueueFull) as e:
+                            st.warning(str(e))
+                            sent = False
+                        if sent:
+                            st.success("Message sent!")
+                            st.session_state["clear_new_message"] = True  # Set flag to clear on next run
+                            st.rerun()
         else:
             st.info("Join some projects to start messaging!")
         
-        conn.close()
 
     elif menu == "Community":
         st.header("Community: Students & Teachers")
-        conn = sqlite3.connect('student_projects.db')
-        c = conn.cursor()
-        users = c.execute("SELECT id, name, institution, role, profile_pic FROM users").fetchall()
+        if "community_cursors" not in st.session_state:
+            st.session_state.community_cursors = [None]
+        cursors = st.session_state.community_cursors
+        with db.connection() as conn:
+            # Projects involved / lines of code come precomputed from user_stats
+            users, next_cursor = page_data.community(conn, cursors[-1])
         for user in users:
-            user_id, name, institution, role, profile_pic = user
-            # Projects involved: number of projects the user is a member of
-            projects_involved = c.execute("SELECT COUNT(*) FROM project_members WHERE user_id=?", (user_id,)).fetchone()[0]
-            # Lines of code contributed: sum of lines in all project_code entries for projects the user is a member of
-            project_ids = c.execute("SELECT project_id FROM project_members WHERE user_id=?", (user_id,)).fetchall()
-            project_ids = [pid[0] for pid in project_ids]
-            lines_of_code = 0
-            if project_ids:
-                q_marks = ','.join(['?']*len(project_ids))
-                codes = c.execute(f"SELECT code FROM project_code WHERE project_id IN ({q_marks})", project_ids).fetchall()
-                for code_row in codes:
-                    code = code_row[0] if code_row and code_row[0] else ""
-                    lines_of_code += len(code.splitlines())
-            user_profile_card(name, role, projects_involved, lines_of_code)
-        conn.close()
+            user_id, name, institution, role, profile_pic, projects_involved, lines_of_code, last_activity = user
+            user_profile_card(name, role, projects_involved, lines_of_code, last_activity, profile_pic)
+
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col1:
+            if len(cursors) > 1 and st.button("Previous page"):
+                cursors.pop()
+                st.rerun()
+        with col2:
+            st.caption(f"Page {len(cursors)}")
+        with col3:
+            if next_cursor is not None and st.button("Next page"):
+                cursors.append(next_cursor)
+                st.rerun()
 
     elif menu == "Profile":
         st.header("My Profile")
-        conn = sqlite3.connect('student_projects.db')
-        c = conn.cursor()
-        user = c.execute("SELECT id, name, email, institution, role, join_date, profile_pic FROM users WHERE id=?", (st.session_state.user_id,)).fetchone()
-        if user:
-            user_id, name, email, institution, role, join_date, profile_pic = user
-            col1, col2 = st.columns([1, 2])
-            with col1:
-                if profile_pic:
-                    st.image(f"uploads/{profile_pic}", width=120)
-                else:
-                    st.image("https://www.gravatar.com/avatar/00000000000000000000000000000000?d=mp&f=y", width=120)
-            with col2:
-                st.subheader(name)
-                st.write(f"**Email:** {email}")
-                st.write(f"**Role:** {role}")
-                st.write(f"**Institution:** {institution}")
-                st.write(f"**Joined:** {join_date}")
-            st.markdown("---")
-            st.subheader("Edit Profile")
-            new_name = st.text_input("Full Name", value=name)
-            new_institution = st.text_input("Institution", value=institution)
-            new_role = st.selectbox("Role", ["Student", "Teacher"], index=0 if role.lower()=="student" else 1)
-            uploaded_pic = st.file_uploader("Upload Profile Picture", type=["png", "jpg", "jpeg"])
-            if st.button("Update Profile"):
-                pic_filename = profile_pic
-                if uploaded_pic:
-                    import os
-                    os.makedirs("uploads", exist_ok=True)
-                    pic_filename = f"user_{user_id}_{uploaded_pic.name}"
-                    with open(f"uploads/{pic_filename}", "wb") as f:
-                        f.write(uploaded_pic.getbuffer())
-                c.execute("UPDATE users SET name=?, institution=?, role=?, profile_pic=? WHERE id=?", (new_name, new_institution, new_role, pic_filename, user_id))
-                conn.commit()
-                st.success("Profile updated!")
-                st.rerun()
-        else:
-            st.error("User not found.")
-        conn.close()
+        with db.connection() as conn:
+            user, skill_names, user_skills = page_data.profile(conn, st.session_state.user_id)
+            if user:
+                user_id, name, email, institution, role, join_date, profile_pic = user
+                col1, col2 = st.columns([1, 2])
+                with col1:
+                    pic_path = avatars.variant_path(profile_pic, 120)
+                    if pic_path:
+                        st.image(pic_path, width=120)
+                    else:
+                        st.image("https://www.gravatar.com/avatar/00000000000000000000000000000000?d=mp&f=y", width=120)
+                with col2:
+                    st.subheader(name)
+                    st.write(f"**Email:** {email}")
+                    st.write(f"**Role:** {role}")
+                    st.write(f"**Institution:** {institution}")
+                    st.write(f"**Joined:** {join_date}")
+                st.markdown("---")
+                st.subheader("Edit Profile")
+                new_name = st.text_input("Full Name", value=name)
+                new_institution = st.text_input("Institution", value=institution)
+                new_role = st.selectbox("Role", ["Student", "Teacher"], index=0 if role.lower()=="student" else 1)
+                new_skills = st.multiselect("Skills", skill_names, default=user_skills)
+                uploaded_pic = st.file_uploader("Upload Profile Picture", type=["png", "jpg", "jpeg"])
+                if st.button("Update Profile"):
+                    pic_filename = profile_pic
+                    if uploaded_pic:
+                        # Resized once here; pages then load the thumbnail they need
+                        try:
+                            with metrics.timed("avatar_upload"):
+                                pic_filename = avatars.process_upload(user_id, uploaded_pic)
+                        except avatars.BAD_UPLOAD:
+                            st.error("That file isn't a picture we can read. Try another PNG or JPEG.")
+                            st.stop()
+                    try:
+                        actions.update_profile(conn, user_id, new_name, new_institution, new_role, new_skills, pic_filename)
+                    except (actions.ActionError, writer.QueueFull) as e:
+                        st.error(str(e))
+                        st.stop()
+                    st.success("Profile updated!")
+                    st.rerun()
+            else:
+                st.error("User not found.")
+
+    elif menu == "Admin":
+        st.header("Admin: Performance")
+        registry = metrics.get_registry()
+        st.subheader("Pages")
+        st.dataframe([dict(page=name, **p) for name, p in sorted(registry.pages().items())])
+        st.subheader("Top statements")
+        order = st.selectbox("Order by", ["seconds", "count", "max_seconds", "rows", "slow"])
+        st.dataframe(registry.top_statements(by=order))
+        st.subheader(f"Slow queries (over {metrics.SLOW_QUERY_MS:g} ms)")
+        slow = list(registry.recent_slow)[::-1]
+        if not slow:
+            st.caption("None yet.")
+        for entry in slow[:20]:
+            with st.expander(f"{entry['ms']} ms on {entry['page']} at {entry['date']}"):
+                st.code(entry['sql'], language="sql")
+                st.code(entry['plan'], language="text")
+        st.subheader("Recent reruns")
+        st.dataframe(list(registry.recent_reruns)[::-1][:50])
+        st.subheader("Connection pool, lookup cache, code runner, writer, recommendations, shards, archive and API")
+        st.json({'pool': db.pool_stats(), 'cache': cache.cache_stats(),
+                 'code_runner': code_runner.get_runner().metrics(), 'writer': writer.get_writer().metrics(),
+                 'recommend': recommend.get_index().stats(), 'shards': shards.shard_stats(),
+                 'archive': archive.archive_stats(), 'api': api.api_stats()})
+        st.download_button("Download metrics (Prometheus text)", metrics.prometheus(), file_name="metrics.prom")
 
     elif menu == "Logout":
         st.session_state.user_id = None
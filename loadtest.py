@@ -0,0 +1,224 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+from urllib.parse import quote, urlsplit
+
+import db
+
+# Virtual clients against a running api.py, each on its own keep-alive
+# connection: log in as a real user from the database, then loop over a
+# weighted mix of what a mobile client does. Reports requests per second and
+# latency percentiles per action.
+
+MIX = {'browse': 20, 'search': 5, 'project': 15, 'chat': 15, 'poll': 20, 'send_chat': 5,
+       'messages': 10, 'send_message': 3, 'files': 7}
+SEARCH_WORDS = ["machine", "robotics", "climate", "web", "genomics", "compilers", "game", "quantum", "nlp"]
+
+
+class Connection:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=None, token=None):
+        for attempt in (0, 1):
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                return await self._request(method, path, body, token)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if attempt:
+                    raise
+
+    async def _request(self, method, path, body, token):
+        payload = json.dumps(body).encode() if body is not None else b""
+        head = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}", f"Content-Length: {len(payload)}"]
+        if payload:
+            head.append("Content-Type: application/json")
+        if token:
+            head.append(f"Authorization: Bearer {token}")
+        self.writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + payload)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        data = await self.reader.readexactly(int(headers.get("content-length", 0)))
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, json.loads(data) if data else None
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class Results:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+
+    def record(self, action, seconds, status):
+        if 200 <= status < 300:
+            self.latencies.setdefault(action, []).append(seconds)
+        else:
+            self.errors[action] = self.errors.get(action, 0) + 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def summary(self, elapsed):
+        actions = {}
+        for action in sorted(set(self.latencies) | set(self.errors)):
+            samples = sorted(self.latencies.get(action, []))
+
+            def pct(p):
+                return samples[min(int(len(samples) * p), len(samples) - 1)] * 1000 if samples else 0.0
+            actions[action] = {'ok': len(samples), 'errors': self.errors.get(action, 0),
+                               'rps': len(samples) / elapsed,
+                               'p50_ms': pct(0.5), 'p95_ms': pct(0.95), 'p99_ms': pct(0.99),
+                               'max_ms': samples[-1] * 1000 if samples else 0.0}
+        total = sum(a['ok'] for a in actions.values())
+        return {'seconds': elapsed, 'requests': total, 'rps': total / elapsed,
+                'errors': sum(a['errors'] for a in actions.values()),
+                'statuses': {str(k): v for k, v in sorted(self.statuses.items())}, 'actions': actions}
+
+
+async def client(host, port, email, deadline, mix, think, results, rng):
+    conn = Connection(host, port)
+    try:
+        status, body = await conn.request("POST", "/api/login", {'email': email})
+        if status != 200:
+            results.record('login', 0, status)
+            return
+        token = body['token']
+        status, me = await conn.request("GET", "/api/me", token=token)
+        projects = me['projects'] if status == 200 else []
+        chat_cursor = {}
+        actions, weights = zip(*mix.items())
+        while time.monotonic() < deadline:
+            action = rng.choices(actions, weights)[0]
+            project_id = rng.choice(projects) if projects else None
+            if project_id is None and action not in ('browse', 'search'):
+                action = 'browse'
+            if action == 'browse':
+                request = ("GET", "/api/projects?limit=20", None)
+            elif action == 'search':
+                request = ("GET", f"/api/projects?limit=20&q={quote(rng.choice(SEARCH_WORDS))}", None)
+            elif action == 'project':
+                request = ("GET", f"/api/projects/{project_id}", None)
+            elif action == 'chat':
+                request = ("GET", f"/api/projects/{project_id}/chat", None)
+            elif action == 'poll':
+                after = chat_cursor.get(project_id)
+                request = ("GET", f"/api/projects/{project_id}/chat" + (f"?after={after}" if after else ""), None)
+            elif action == 'send_chat':
+                request = ("POST", f"/api/projects/{project_id}/chat", {'message': f"load test {rng.random():.6f}"})
+            elif action == 'messages':
+                request = ("GET", f"/api/projects/{project_id}/messages", None)
+            elif action == 'send_message':
+                request = ("POST", f"/api/projects/{project_id}/messages", {'message': f"load test {rng.random():.6f}"})
+            else:
+                request = ("GET", f"/api/projects/{project_id}/files", None)
+            started = time.perf_counter()
+            status, body = await conn.request(*request, token=token)
+            results.record(action, time.perf_counter() - started, status)
+            if action in ('chat', 'poll') and status == 200 and body['after'] is not None:
+                chat_cursor[project_id] = body['after']
+            if think:
+                await asyncio.sleep(rng.expovariate(1 / think))
+    except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+        results.record(f'connection ({type(e).__name__})', 0, 0)
+    finally:
+        conn.close()
+
+
+# Emails of users to log in as: members of some project first, so project
+# actions have something to act on
+def pick_emails(path, count, seed):
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name='user_directory'").fetchone():
+            emails = [row[0] for row in conn.execute("SELECT email FROM user_directory")]
+        else:
+            emails = [row[0] for row in conn.execute(
+                "SELECT email FROM users WHERE id IN (SELECT user_id FROM project_members)")]
+    finally:
+        conn.close()
+    rng = random.Random(seed)
+    return [rng.choice(emails) for _ in range(count)] if emails else []
+
+
+def parse_mix(text):
+    mix = dict(MIX)
+    for part in filter(None, (text or "").split(",")):
+        name, _, weight = part.partition("=")
+        if name not in MIX:
+            raise argparse.ArgumentTypeError(f"unknown action {name!r}; one of {', '.join(MIX)}")
+        mix[name] = float(weight)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+async def run(url, emails, duration, mix, think, ramp, seed):
+    parts = urlsplit(url)
+    results = Results()
+    deadline = time.monotonic() + duration
+    tasks = []
+    started = time.monotonic()
+    for n, email in enumerate(emails):
+        tasks.append(asyncio.create_task(client(parts.hostname, parts.port or 80, email, deadline, mix, think,
+                                                results, random.Random(seed + n))))
+        if ramp:
+            await asyncio.sleep(ramp / len(emails))
+    await asyncio.gather(*tasks)
+    return results.summary(time.monotonic() - started)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test a running JSON API (api.py).")
+    parser.add_argument("--url", default="http://localhost:8503")
+    parser.add_argument("--db", default=db.SHARD_DIR and os.path.join(db.SHARD_DIR, "directory.db") or db.DB_PATH,
+                        help="database (or shard directory.db) to take login emails from")
+    parser.add_argument("--clients", type=int, default=100, help="concurrent virtual clients")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--ramp", type=float, default=2, help="seconds over which clients start")
+    parser.add_argument("--think", type=float, default=0, help="mean pause between a client's requests, seconds")
+    parser.add_argument("--mix", type=parse_mix, default=dict(MIX),
+                        help="action weights to change, e.g. send_chat=0,poll=40 "
+                             f"(default {','.join(f'{k}={v}' for k, v in MIX.items())})")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the results as JSON here too")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        sys.exit(f"{args.db} does not exist")
+    emails = pick_emails(args.db, args.clients, args.seed)
+    if not emails:
+        sys.exit(f"no users in {args.db}")
+    summary = asyncio.run(run(args.url, emails, args.duration, args.mix, args.think, args.ramp, args.seed))
+    summary['clients'] = args.clients
+
+    print(f"{'action':<14} {'ok':>8} {'errors':>7} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for action, a in summary['actions'].items():
+        print(f"{action:<14} {a['ok']:>8,} {a['errors']:>7,} {a['rps']:>9,.1f} {a['p50_ms']:>8.1f} "
+              f"{a['p95_ms']:>8.1f} {a['p99_ms']:>8.1f} {a['max_ms']:>8.1f}")
+    print(f"{summary['requests']:,} requests from {args.clients} clients in {summary['seconds']:.1f}s: "
+          f"{summary['rps']:,.0f} req/s, {summary['errors']:,} errors, statuses {summary['statuses']}")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,548 @@
+import functools
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# Set EDUCOLLAB_INSTRUMENT=0 to get plain sqlite3 connections back
+ENABLED = os.environ.get("EDUCOLLAB_INSTRUMENT", "1") != "0"
+SLOW_QUERY_MS = float(os.environ.get("EDUCOLLAB_SLOW_QUERY_MS", "50"))
+SLOW_QUERY_LOG = os.environ.get("EDUCOLLAB_SLOW_QUERY_LOG", "slow_queries.log")
+METRICS_FILE = os.environ.get("EDUCOLLAB_METRICS_FILE", "metrics.prom")
+METRICS_PORT = int(os.environ.get("EDUCOLLAB_METRICS_PORT", "0"))
+# Users who get the Admin page, by email (comma separated)
+ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get("EDUCOLLAB_ADMIN_EMAILS", "").split(",") if e.strip()}
+EXPORT_EVERY = 15
+# Plans are looked up at most this often per statement
+PLAN_EVERY = 300
+RECENT_RERUNS = 200
+RECENT_SLOW = 100
+
+# Seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_IN_LIST = re.compile(r'\?(\s*,\s*\?)+')
+_SPACE = re.compile(r'\s+')
+
+
+# One shape per statement: whitespace collapsed and IN (?, ?, ...) lists of
+# any length folded together, so ids don't multiply the number of series
+def normalize(sql):
+    return _IN_LIST.sub('?, ...', _SPACE.sub(' ', sql).strip())
+
+
+def fingerprint(sql):
+    return hashlib.sha1(sql.encode('utf-8')).hexdigest()[:12]
+
+
+class Histogram:
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+# A statement as it runs: created on execute, updated by every fetch, and
+# finished when the cursor moves on, runs dry or goes away. That can be long
+# after its connection went back to the pool, so it keeps the database's
+# path, not the connection.
+class StatementRecord:
+    __slots__ = ('sql', 'params', 'path', 'seconds', 'rows', 'done')
+
+    def __init__(self, sql, params, path, seconds, rows):
+        self.sql = sql
+        self.params = params
+        self.path = path
+        self.seconds = seconds
+        self.rows = rows
+        self.done = False
+
+
+# Everything one run of main() did
+class RerunTrace:
+    def __init__(self):
+        self.page = None
+        self.started = time.perf_counter()
+        self.statements = []
+
+    def summary(self):
+        return {
+            'page': self.page or 'unknown',
+            'date': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'seconds': time.perf_counter() - self.started,
+            'statements': len(self.statements),
+            'db_seconds': sum(r.seconds for r in self.statements),
+            'rows': sum(r.rows for r in self.statements),
+        }
+
+
+class Registry:
+    def __init__(self, slow_ms=SLOW_QUERY_MS, slow_log=SLOW_QUERY_LOG):
+        self.slow_seconds = slow_ms / 1000
+        self.slow_log = slow_log
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._statements = {}
+        self._pages = {}
+        self._operations = {}
+        self._plans = {}
+        # Read-only connections of our own for EXPLAIN QUERY PLAN, by path
+        self._plan_connections = {}
+        self._plan_lock = threading.Lock()
+        # Serializes appends to slow_log, apart from _lock
+        self._log_lock = threading.Lock()
+        self._slow_total = 0
+        self.recent_reruns = deque(maxlen=RECENT_RERUNS)
+        self.recent_slow = deque(maxlen=RECENT_SLOW)
+
+    # -- statements
+
+    def finish_statement(self, record):
+        if record.done:
+            return
+        record.done = True
+        sql = normalize(record.sql)
+        key = fingerprint(sql)
+        with self._lock:
+            entry = self._statements.get(key)
+            if entry is None:
+                entry = self._statements[key] = {'sql': sql, 'count': 0, 'seconds': 0.0, 'rows': 0,
+                                                 'max_seconds': 0.0, 'slow': 0}
+            entry['count'] += 1
+            entry['seconds'] += record.seconds
+            entry['rows'] += record.rows
+            entry['max_seconds'] = max(entry['max_seconds'], record.seconds)
+            slow = record.seconds >= self.slow_seconds
+            if slow:
+                entry['slow'] += 1
+                self._slow_total += 1
+        if slow:
+            self._log_slow(key, sql, record)
+
+    def _plan(self, key, record):
+        with self._lock:
+            cached = self._plans.get(key)
+        if cached and time.monotonic() - cached[0] < PLAN_EVERY:
+            return cached[1]
+        try:
+            with self._plan_lock:
+                conn = self._plan_connections.get(record.path)
+                if conn is None:
+                    if record.path in (None, "", ":memory:"):
+                        raise ValueError("not a database file")
+                    # Plain sqlite3, so looking up the plan isn't itself recorded
+                    conn = sqlite3.connect(Path(record.path).absolute().as_uri() + "?mode=ro", uri=True,
+                                           check_same_thread=False)
+                    self._plan_connections[record.path] = conn
+                rows = conn.execute("EXPLAIN QUERY PLAN " + record.sql, record.params).fetchall()
+            plan = "\n".join(f"{row[0]}|{row[1]}|{row[-1]}" for row in rows)
+        except (sqlite3.Error, ValueError) as e:
+            plan = f"(no plan: {e})"
+        with self._lock:
+            self._plans[key] = (time.monotonic(), plan)
+        return plan
+
+    # The entry is built under the registry lock but written after it is
+    # released, so a slow disk only holds up other slow-query writers
+    def _log_slow(self, key, sql, record):
+        params = record.params if isinstance(record.params, (list, tuple)) else None
+        plan = self._plan(key, record)
+        with self._lock:
+            entry = {
+                'date': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                'query_id': key,
+                'page': getattr(self.current(), 'page', None),
+                'ms': round(record.seconds * 1000, 3),
+                'rows': record.rows,
+                'sql': sql,
+                'params': [p if isinstance(p, (int, float)) or p is None else str(p)[:80] for p in params or ()][:20],
+                'plan': plan,
+            }
+            self.recent_slow.append(entry)
+            line = json.dumps(entry) + "\n"
+        if self.slow_log:
+            try:
+                with self._log_lock, open(self.slow_log, "a", encoding="utf-8") as f:
+                    f.write(line)
+            except OSError:
+                pass
+
+    # -- reruns
+
+    def current(self):
+        return getattr(self._local, 'trace', None)
+
+    def set_page(self, page):
+        trace = self.current()
+        if trace is not None:
+            trace.page = page
+
+    @contextmanager
+    def rerun(self):
+        trace = RerunTrace()
+        self._local.trace = trace
+        try:
+            yield trace
+        finally:
+            self._local.trace = None
+            for record in trace.statements:
+                self.finish_statement(record)
+            summary = trace.summary()
+            with self._lock:
+                page = self._pages.get(summary['page'])
+                if page is None:
+                    page = self._pages[summary['page']] = {'duration': Histogram(), 'statements': 0,
+                                                           'db_seconds': 0.0, 'rows': 0}
+                page['duration'].observe(summary['seconds'])
+                page['statements'] += summary['statements']
+                page['db_seconds'] += summary['db_seconds']
+                page['rows'] += summary['rows']
+            self.recent_reruns.append(summary)
+            maybe_export()
+
+    # -- anything else worth timing (code runs, uploads)
+
+    def observe(self, operation, seconds):
+        with self._lock:
+            histogram = self._operations.get(operation)
+            if histogram is None:
+                histogram = self._operations[operation] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timed(self, operation):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(operation, time.perf_counter() - started)
+
+    # -- reading
+
+    def top_statements(self, by='seconds', limit=20):
+        with self._lock:
+            rows = [dict(entry, query_id=key) for key, entry in self._statements.items()]
+        rows.sort(key=lambda r: r[by], reverse=True)
+        return rows[:limit]
+
+    def pages(self):
+        with self._lock:
+            return {name: {'reruns': p['duration'].count,
+                           'avg_ms': p['duration'].sum / p['duration'].count * 1000 if p['duration'].count else 0.0,
+                           'avg_statements': p['statements'] / p['duration'].count if p['duration'].count else 0.0,
+                           'avg_db_ms': p['db_seconds'] / p['duration'].count * 1000 if p['duration'].count else 0.0}
+                    for name, p in self._pages.items()}
+
+    def prometheus(self):
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def histogram(name, labels, h):
+            # observe() already counts each value into every bucket it fits
+            for bound, count in zip(h.buckets, h.counts):
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {h.count}')
+            lines.append(f'{name}_sum{{{labels}}} {h.sum:.6f}')
+            lines.append(f'{name}_count{{{labels}}} {h.count}')
+
+        with self._lock:
+            pages = {name: dict(p) for name, p in self._pages.items()}
+            statements = {key: dict(entry) for key, entry in self._statements.items()}
+            operations = dict(self._operations)
+            slow_total = self._slow_total
+
+        metric("educollab_rerun_seconds", "histogram", "Wall time of one run of the app script, by page.")
+        for name, p in sorted(pages.items()):
+            histogram("educollab_rerun_seconds", f'page="{_label(name)}"', p['duration'])
+        for field, help_text in (('statements', "SQL statements issued by reruns, by page."),
+                                 ('db_seconds', "Time spent in SQLite during reruns, by page."),
+                                 ('rows', "Rows fetched by reruns, by page.")):
+            name = f"educollab_rerun_{field}_total"
+            metric(name, "counter", help_text)
+            for page, p in sorted(pages.items()):
+                lines.append(f'{name}{{page="{_label(page)}"}} {p[field]}')
+
+        for field, kind, help_text in (('count', 'counter', "Executions of each statement."),
+                                       ('seconds', 'counter', "Total time in each statement."),
+                                       ('rows', 'counter', "Rows fetched by each statement."),
+                                       ('max_seconds', 'gauge', "Slowest single execution of each statement.")):
+            name = f"educollab_db_statement_{field}" + ("_total" if kind == 'counter' else "")
+            metric(name, kind, help_text)
+            for key, entry in sorted(statements.items()):
+                lines.append(f'{name}{{query_id="{key}"}} {entry[field]}')
+        metric("educollab_db_statement_info", "gauge", "Normalized SQL text of each query_id.")
+        for key, entry in sorted(statements.items()):
+            lines.append(f'educollab_db_statement_info{{query_id="{key}",sql="{_label(entry["sql"][:200])}"}} 1')
+        metric("educollab_db_slow_statements_total", "counter",
+               f"Statements slower than {self.slow_seconds * 1000:g} ms.")
+        lines.append(f"educollab_db_slow_statements_total {slow_total}")
+
+        metric("educollab_operation_seconds", "histogram", "Duration of code runs, uploads and other operations.")
+        for name, h in sorted(operations.items()):
+            histogram("educollab_operation_seconds", f'operation="{_label(name)}"', h)
+
+        # The other components' own counters, as gauges
+        import api
+        import archive
+        import cache
+        import code_runner
+        import db
+        import recommend
+        import writer
+        for prefix, values in (("educollab_db_pool", db.pool_stats()),
+                               ("educollab_lookup_cache", cache.cache_stats()),
+                               ("educollab_code_runner", code_runner.get_runner().metrics()
+                                if code_runner._runner is not None else {}),
+                               ("educollab_writer", writer.get_writer().metrics()
+                                if db.get_pool() in writer._writers else {}),
+                               ("educollab_recommend", recommend.get_index().stats()
+                                if db.get_pool() in recommend._indexes else {}),
+                               ("educollab_archive", archive.archive_stats()),
+                               ("educollab_api", api.api_stats())):
+            for key, value in sorted(values.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    metric(f"{prefix}_{key}", "gauge", f"{prefix.replace('_', ' ')} {key.replace('_', ' ')}.")
+                    lines.append(f"{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    _record = None
+
+    def _start(self, sql, params, run):
+        self._finish()
+        started = time.perf_counter()
+        try:
+            return run()
+        finally:
+            seconds = time.perf_counter() - started
+            record = StatementRecord(sql, params, self.connection.path, seconds, 0)
+            self._record = record
+            trace = _registry.current()
+            if trace is not None:
+                trace.statements.append(record)
+
+    def _finish(self):
+        record = self._record
+        if record is not None:
+            self._record = None
+            _registry.finish_statement(record)
+
+    def _fetched(self, started, rows, exhausted):
+        record = self._record
+        if record is not None:
+            record.seconds += time.perf_counter() - started
+            record.rows += rows
+            if exhausted:
+                self._finish()
+
+    def execute(self, sql, parameters=()):
+        return self._start(sql, parameters, lambda: super(InstrumentedCursor, self).execute(sql, parameters))
+
+    def executemany(self, sql, seq_of_parameters):
+        seq = list(seq_of_parameters)
+        cursor = self._start(sql, seq[0] if seq else (),
+                             lambda: super(InstrumentedCursor, self).executemany(sql, seq))
+        self._record.rows = max(self.rowcount, 0)
+        self._finish()
+        return cursor
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(started, len(rows), not rows)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows), True)
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(started, 0, True)
+            raise
+        self._fetched(started, 1, False)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+
+# Connection.execute() and friends go through the instrumented cursor too
+class InstrumentedConnection(sqlite3.Connection):
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self.path = database
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connection_factory():
+    return InstrumentedConnection if ENABLED else sqlite3.Connection
+
+
+_registry = Registry()
+_last_export = 0.0
+_export_lock = threading.Lock()
+
+
+def get_registry():
+    return _registry
+
+
+def is_admin(email):
+    return bool(email) and email.lower() in ADMIN_EMAILS
+
+
+def set_page(page):
+    _registry.set_page(page)
+
+
+def timed(operation):
+    return _registry.timed(operation)
+
+
+# Wraps the app's main(): everything it does between two reruns becomes one
+# trace. Also covers the exceptions Streamlit uses for st.rerun/st.stop.
+def instrument_rerun(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _registry.rerun():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+# Wraps an st.fragment function. Run as part of main() it belongs to that
+# rerun's trace; rerun on its own (a button inside the fragment) it gets a
+# trace of its own, under `page`.
+def instrument_fragment(page):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _registry.current() is not None:
+                return func(*args, **kwargs)
+            with _registry.rerun():
+                _registry.set_page(page)
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# One API request (api.py) as a trace of its own, under `page`
+@contextmanager
+def request(page):
+    with _registry.rerun():
+        _registry.set_page(page)
+        yield
+
+
+def prometheus():
+    return _registry.prometheus()
+
+
+# Write the Prometheus text file (for node_exporter's textfile collector or
+# anything that scrapes files), at most every EXPORT_EVERY seconds
+def maybe_export(path=None, force=False):
+    global _last_export
+    path = path or METRICS_FILE
+    if not path:
+        return
+    now = time.monotonic()
+    if not force and now - _last_export < EXPORT_EVERY:
+        return
+    if not _export_lock.acquire(blocking=False):
+        return
+    try:
+        _last_export = now
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(_registry.prometheus())
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+    finally:
+        _export_lock.release()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = _registry.prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+# Serve /metrics from inside the app process, once, if a port is configured
+def start_server(port=None, host="localhost"):
+    global _server
+    port = port or METRICS_PORT
+    if not port or _server is not None:
+        return _server
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+            except OSError:
+                return None
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+    return _server
@@ -0,0 +1,413 @@
+import sqlite3
+import threading
+from datetime import datetime
+
+import db
+
+# Paths of the databases already migrated by this process
+_migrated = set()
+_lock = threading.Lock()
+
+
+def _columns(c, table):
+    return [row[1] for row in c.execute(f"PRAGMA table_info({table})")]
+
+
+# 1: the original tables, as init_db() used to create them
+def _base_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                 (id INTEGER PRIMARY KEY, name TEXT, email TEXT, institution TEXT,
+                  role TEXT, join_date TEXT, profile_pic TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS projects
+                 (id INTEGER PRIMARY KEY, title TEXT, description TEXT,
+                  created_by INTEGER, created_date TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS project_members
+                 (project_id INTEGER, user_id INTEGER)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS messages
+                 (id INTEGER PRIMARY KEY, project_id INTEGER, sender_id INTEGER,
+                  message TEXT, sent_date TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS project_code (project_id INTEGER PRIMARY KEY, code TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS project_chat (project_id INTEGER, sender_id INTEGER, message TEXT, sent_date TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS project_files (id INTEGER PRIMARY KEY, project_id INTEGER, filename TEXT, uploader_id INTEGER, upload_date TEXT)''')
+    # Very old databases predate the profile picture column
+    if 'profile_pic' not in _columns(c, 'users'):
+        c.execute('ALTER TABLE users ADD COLUMN profile_pic TEXT')
+
+
+# SQLite can't add a foreign key to an existing table, so each child table is
+# rebuilt: create the new shape, copy rows across (keeping rowids), swap names.
+FOREIGN_KEY_TABLES = {
+    'projects': '''(id INTEGER PRIMARY KEY, title TEXT, description TEXT,
+                    created_by INTEGER REFERENCES users(id) ON DELETE SET NULL,
+                    created_date TEXT)''',
+    'project_members': '''(project_id INTEGER NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+                           user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE)''',
+    'messages': '''(id INTEGER PRIMARY KEY,
+                    project_id INTEGER REFERENCES projects(id) ON DELETE CASCADE,
+                    sender_id INTEGER REFERENCES users(id) ON DELETE SET NULL,
+                    message TEXT, sent_date TEXT)''',
+    'project_code': '''(project_id INTEGER PRIMARY KEY REFERENCES projects(id) ON DELETE CASCADE,
+                        code TEXT)''',
+    'project_chat': '''(project_id INTEGER REFERENCES projects(id) ON DELETE CASCADE,
+                        sender_id INTEGER REFERENCES users(id) ON DELETE SET NULL,
+                        message TEXT, sent_date TEXT)''',
+    'project_files': '''(id INTEGER PRIMARY KEY,
+                         project_id INTEGER REFERENCES projects(id) ON DELETE CASCADE,
+                         filename TEXT,
+                         uploader_id INTEGER REFERENCES users(id) ON DELETE SET NULL,
+                         upload_date TEXT)''',
+}
+
+
+# 2: rebuild child tables with foreign keys
+def _foreign_keys(c):
+    # Clear out rows that already point at missing parents, mirroring what the
+    # ON DELETE actions would have done had the keys existed all along
+    c.execute("UPDATE projects SET created_by=NULL WHERE created_by NOT IN (SELECT id FROM users)")
+    for table in ('project_members', 'messages', 'project_code', 'project_chat', 'project_files'):
+        c.execute(f"DELETE FROM {table} WHERE project_id IS NULL OR project_id NOT IN (SELECT id FROM projects)")
+    c.execute("DELETE FROM project_members WHERE user_id IS NULL OR user_id NOT IN (SELECT id FROM users)")
+    c.execute("UPDATE messages SET sender_id=NULL WHERE sender_id NOT IN (SELECT id FROM users)")
+    c.execute("UPDATE project_chat SET sender_id=NULL WHERE sender_id NOT IN (SELECT id FROM users)")
+    c.execute("UPDATE project_files SET uploader_id=NULL WHERE uploader_id NOT IN (SELECT id FROM users)")
+
+    for table, definition in FOREIGN_KEY_TABLES.items():
+        cols = ', '.join(_columns(c, table))
+        c.execute(f"CREATE TABLE {table}_new {definition}")
+        c.execute(f"INSERT INTO {table}_new (rowid, {cols}) SELECT rowid, {cols} FROM {table}")
+        c.execute(f"DROP TABLE {table}")
+        c.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+    problems = c.execute("PRAGMA foreign_key_check").fetchall()
+    if problems:
+        raise sqlite3.IntegrityError(f"foreign key check failed after migration: {problems[:5]}")
+
+
+# 3: secondary indexes for every hot lookup
+def _indexes(c):
+    # Unique indexes need existing duplicates folded together first. Duplicate
+    # accounts collapse onto the oldest id for that email.
+    dupes = c.execute("""
+        SELECT u.id, keep.id FROM users u
+        JOIN (SELECT email, MIN(id) AS id FROM users GROUP BY email HAVING COUNT(*) > 1) keep
+          ON u.email = keep.email AND u.id != keep.id
+    """).fetchall()
+    for old_id, new_id in dupes:
+        c.execute("UPDATE projects SET created_by=? WHERE created_by=?", (new_id, old_id))
+        c.execute("UPDATE project_members SET user_id=? WHERE user_id=?", (new_id, old_id))
+        c.execute("UPDATE messages SET sender_id=? WHERE sender_id=?", (new_id, old_id))
+        c.execute("UPDATE project_chat SET sender_id=? WHERE sender_id=?", (new_id, old_id))
+        c.execute("UPDATE project_files SET uploader_id=? WHERE uploader_id=?", (new_id, old_id))
+        c.execute("DELETE FROM users WHERE id=?", (old_id,))
+    c.execute("""
+        DELETE FROM project_members WHERE rowid NOT IN
+        (SELECT MIN(rowid) FROM project_members GROUP BY project_id, user_id)
+    """)
+
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_users_email ON users(email)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_project_members ON project_members(project_id, user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_project_members_user ON project_members(user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_projects_created_by ON projects(created_by)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_project_chat_project_date ON project_chat(project_id, sent_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_messages_project_date ON messages(project_id, sent_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_project_files_project ON project_files(project_id)")
+
+
+# 4: full-text index over project titles/descriptions. External-content FTS5
+# table, so the text lives only in `projects`; triggers keep the index in step.
+def _project_search(c):
+    c.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS projects_fts USING fts5(
+                     title, description,
+                     content='projects', content_rowid='id',
+                     tokenize='unicode61 remove_diacritics 2', prefix='2 3')""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS projects_fts_ai AFTER INSERT ON projects BEGIN
+                     INSERT INTO projects_fts (rowid, title, description) VALUES (new.id, new.title, new.description);
+                 END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS projects_fts_ad AFTER DELETE ON projects BEGIN
+                     INSERT INTO projects_fts (projects_fts, rowid, title, description)
+                     VALUES ('delete', old.id, old.title, old.description);
+                 END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS projects_fts_au AFTER UPDATE OF title, description ON projects BEGIN
+                     INSERT INTO projects_fts (projects_fts, rowid, title, description)
+                     VALUES ('delete', old.id, old.title, old.description);
+                     INSERT INTO projects_fts (rowid, title, description) VALUES (new.id, new.title, new.description);
+                 END""")
+    # Index the projects that already exist
+    c.execute("INSERT INTO projects_fts (projects_fts) VALUES ('rebuild')")
+
+
+# 5: materialized contributor stats for the Community page, kept current by
+# triggers (stats.py), and filled in for the rows that already exist
+def _contributor_stats(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS project_stats
+                 (project_id INTEGER PRIMARY KEY REFERENCES projects(id) ON DELETE CASCADE,
+                  member_count INTEGER NOT NULL DEFAULT 0,
+                  lines_of_code INTEGER NOT NULL DEFAULT 0,
+                  last_activity TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS user_stats
+                 (user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+                  projects_involved INTEGER NOT NULL DEFAULT 0,
+                  lines_of_code INTEGER NOT NULL DEFAULT 0,
+                  last_activity TEXT)''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS stats_member_ai AFTER INSERT ON project_members BEGIN
+                     INSERT INTO project_stats (project_id, member_count, last_activity)
+                     VALUES (new.project_id, 1, datetime('now', 'localtime'))
+                     ON CONFLICT(project_id) DO UPDATE SET member_count = member_count + 1,
+                                                           last_activity = excluded.last_activity;
+                     INSERT INTO user_stats (user_id, projects_involved, lines_of_code, last_activity)
+                     VALUES (new.user_id, 1,
+                             COALESCE((SELECT lines_of_code FROM project_stats WHERE project_id = new.project_id), 0),
+                             datetime('now', 'localtime'))
+                     ON CONFLICT(user_id) DO UPDATE SET projects_involved = projects_involved + 1,
+                                                        lines_of_code = lines_of_code + excluded.lines_of_code,
+                                                        last_activity = excluded.last_activity;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS stats_member_ad AFTER DELETE ON project_members BEGIN
+                     UPDATE project_stats SET member_count = MAX(member_count - 1, 0)
+                     WHERE project_id = old.project_id;
+                     UPDATE user_stats SET projects_involved = MAX(projects_involved - 1, 0),
+                                           lines_of_code = MAX(lines_of_code - COALESCE(
+                                               (SELECT lines_of_code FROM project_stats WHERE project_id = old.project_id), 0), 0)
+                     WHERE user_id = old.user_id;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS stats_code_au AFTER UPDATE OF lines_of_code ON project_stats BEGIN
+                     UPDATE user_stats SET lines_of_code = lines_of_code + new.lines_of_code - old.lines_of_code
+                     WHERE user_id IN (SELECT user_id FROM project_members WHERE project_id = new.project_id);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS stats_chat_ai AFTER INSERT ON project_chat BEGIN
+                     UPDATE project_stats SET last_activity = new.sent_date WHERE project_id = new.project_id;
+                     UPDATE user_stats SET last_activity = new.sent_date WHERE user_id = new.sender_id;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS stats_message_ai AFTER INSERT ON messages BEGIN
+                     UPDATE project_stats SET last_activity = new.sent_date WHERE project_id = new.project_id;
+                     UPDATE user_stats SET last_activity = new.sent_date WHERE user_id = new.sender_id;
+                 END''')
+    c.execute("""
+        INSERT INTO project_stats (project_id, member_count, lines_of_code, last_activity)
+        SELECT p.id,
+               (SELECT COUNT(*) FROM project_members pm WHERE pm.project_id = p.id),
+               0,
+               MAX(COALESCE(p.created_date, ''), COALESCE(a.last, ''))
+        FROM projects p
+        LEFT JOIN (
+            SELECT project_id, MAX(last) AS last FROM (
+                SELECT project_id, MAX(sent_date) AS last FROM project_chat GROUP BY project_id
+                UNION ALL SELECT project_id, MAX(sent_date) FROM messages GROUP BY project_id
+                UNION ALL SELECT project_id, MAX(upload_date) FROM project_files GROUP BY project_id
+            ) GROUP BY project_id
+        ) a ON a.project_id = p.id
+    """)
+    # Line counts use str.splitlines(), which SQL can't express. user_stats
+    # is still empty, so the stats_code_au trigger has nothing to move.
+    c.executemany("UPDATE project_stats SET lines_of_code=? WHERE project_id=?",
+                  [(len(code.splitlines()) if code else 0, project_id)
+                   for project_id, code in c.execute("SELECT project_id, code FROM project_code").fetchall()])
+    c.execute("""
+        INSERT INTO user_stats (user_id, projects_involved, lines_of_code, last_activity)
+        SELECT u.id,
+               COUNT(pm.project_id),
+               COALESCE(SUM(ps.lines_of_code), 0),
+               MAX(COALESCE(u.join_date, ''), COALESCE(a.last, ''))
+        FROM users u
+        LEFT JOIN project_members pm ON pm.user_id = u.id
+        LEFT JOIN project_stats ps ON ps.project_id = pm.project_id
+        LEFT JOIN (
+            SELECT sender_id, MAX(last) AS last FROM (
+                SELECT sender_id, MAX(sent_date) AS last FROM project_chat GROUP BY sender_id
+                UNION ALL SELECT sender_id, MAX(sent_date) FROM messages GROUP BY sender_id
+            ) GROUP BY sender_id
+        ) a ON a.sender_id = u.id
+        GROUP BY u.id
+    """)
+    c.execute("UPDATE project_stats SET last_activity=NULL WHERE last_activity=''")
+    c.execute("UPDATE user_stats SET last_activity=NULL WHERE last_activity=''")
+
+
+# 6: edit history for collaborative editing. project_code becomes the
+# periodic snapshot (code as of `rev`); code_ops holds the ops after it.
+def _code_history(c):
+    if 'rev' not in _columns(c, 'project_code'):
+        c.execute("ALTER TABLE project_code ADD COLUMN rev INTEGER NOT NULL DEFAULT 0")
+    c.execute("""CREATE TABLE IF NOT EXISTS code_ops
+                 (project_id INTEGER NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+                  rev INTEGER NOT NULL,
+                  user_id INTEGER REFERENCES users(id) ON DELETE SET NULL,
+                  op TEXT NOT NULL,
+                  created_date TEXT,
+                  PRIMARY KEY (project_id, rev))""")
+
+
+# 7: give chat messages their own ever-increasing id to page and sync on.
+# Existing messages keep their rowid as their id.
+def _chat_ids(c):
+    c.execute("""CREATE TABLE project_chat_new
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  project_id INTEGER REFERENCES projects(id) ON DELETE CASCADE,
+                  sender_id INTEGER REFERENCES users(id) ON DELETE SET NULL,
+                  message TEXT, sent_date TEXT)""")
+    c.execute("""INSERT INTO project_chat_new (id, project_id, sender_id, message, sent_date)
+                 SELECT rowid, project_id, sender_id, message, sent_date FROM project_chat ORDER BY rowid""")
+    c.execute("DROP TABLE project_chat")
+    c.execute("ALTER TABLE project_chat_new RENAME TO project_chat")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_project_chat_project_date ON project_chat(project_id, sent_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_project_chat_project_id ON project_chat(project_id, id)")
+    # Dropping the old table took its stats trigger with it
+    c.execute('''CREATE TRIGGER IF NOT EXISTS stats_chat_ai AFTER INSERT ON project_chat BEGIN
+                     UPDATE project_stats SET last_activity = new.sent_date WHERE project_id = new.project_id;
+                     UPDATE user_stats SET last_activity = new.sent_date WHERE user_id = new.sender_id;
+                 END''')
+
+
+# 8: content-addressed file store. Each blob's ref_count tracks how many
+# project_files rows point at it; blobstore.gc() removes the ones at zero.
+def _blob_store(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS blobs
+                 (sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL,
+                  ref_count INTEGER NOT NULL DEFAULT 0, created_date TEXT)""")
+    if 'sha256' not in _columns(c, 'project_files'):
+        c.execute("ALTER TABLE project_files ADD COLUMN sha256 TEXT REFERENCES blobs(sha256)")
+        c.execute("ALTER TABLE project_files ADD COLUMN size INTEGER")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_project_files_sha256 ON project_files(sha256)")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS blobs_ref_ai AFTER INSERT ON project_files
+                 WHEN new.sha256 IS NOT NULL BEGIN
+                     UPDATE blobs SET ref_count = ref_count + 1 WHERE sha256 = new.sha256;
+                 END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS blobs_ref_ad AFTER DELETE ON project_files
+                 WHEN old.sha256 IS NOT NULL BEGIN
+                     UPDATE blobs SET ref_count = ref_count - 1 WHERE sha256 = old.sha256;
+                 END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS blobs_ref_au AFTER UPDATE OF sha256 ON project_files BEGIN
+                     UPDATE blobs SET ref_count = ref_count - 1 WHERE sha256 = old.sha256;
+                     UPDATE blobs SET ref_count = ref_count + 1 WHERE sha256 = new.sha256;
+                 END""")
+
+
+# 9: skills on users and projects, and a project's team size, for matching
+# people to projects (recommend.py)
+def _skills(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS skills
+                 (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE COLLATE NOCASE)""")
+    c.executemany("INSERT OR IGNORE INTO skills (name) VALUES (?)",
+                  [(name,) for name in ("Programming", "Design", "Writing", "Research", "Data Analysis")])
+    c.execute("""CREATE TABLE IF NOT EXISTS user_skills
+                 (user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+                  skill_id INTEGER NOT NULL REFERENCES skills(id) ON DELETE CASCADE,
+                  PRIMARY KEY (user_id, skill_id))""")
+    c.execute("""CREATE TABLE IF NOT EXISTS project_skills
+                 (project_id INTEGER NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+                  skill_id INTEGER NOT NULL REFERENCES skills(id) ON DELETE CASCADE,
+                  PRIMARY KEY (project_id, skill_id))""")
+    if 'max_members' not in _columns(c, 'projects'):
+        c.execute("ALTER TABLE projects ADD COLUMN max_members INTEGER")
+
+
+# 10: compressed archive of old chat and messages (archive.py): one block per
+# project, month and table, plus who sent what in it, for user stats
+def _archive(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS archive_blocks
+                 (id INTEGER PRIMARY KEY,
+                  source TEXT NOT NULL,
+                  project_id INTEGER NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+                  month TEXT NOT NULL,
+                  first_date TEXT NOT NULL,
+                  last_date TEXT NOT NULL,
+                  row_count INTEGER NOT NULL,
+                  codec TEXT NOT NULL,
+                  raw_size INTEGER NOT NULL,
+                  payload BLOB NOT NULL,
+                  created_date TEXT,
+                  UNIQUE (source, project_id, month))""")
+    c.execute("""CREATE TABLE IF NOT EXISTS archive_senders
+                 (block_id INTEGER NOT NULL REFERENCES archive_blocks(id) ON DELETE CASCADE,
+                  sender_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+                  last_date TEXT NOT NULL,
+                  PRIMARY KEY (sender_id, block_id))""")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_archive_senders_block ON archive_senders(block_id)")
+
+
+# 11: archive block ids are never reused. Merging late rows into a month
+# replaces its block, and without AUTOINCREMENT the replacement could get the
+# old block's id back, which archive.BlockCache has cached the old rows under.
+def _archive_block_ids(c):
+    cols = ', '.join(_columns(c, 'archive_blocks'))
+    c.execute("""CREATE TABLE archive_blocks_new
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  source TEXT NOT NULL,
+                  project_id INTEGER NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+                  month TEXT NOT NULL,
+                  first_date TEXT NOT NULL,
+                  last_date TEXT NOT NULL,
+                  row_count INTEGER NOT NULL,
+                  codec TEXT NOT NULL,
+                  raw_size INTEGER NOT NULL,
+                  payload BLOB NOT NULL,
+                  created_date TEXT,
+                  UNIQUE (source, project_id, month))""")
+    c.execute(f"INSERT INTO archive_blocks_new ({cols}) SELECT {cols} FROM archive_blocks ORDER BY id")
+    c.execute("DROP TABLE archive_blocks")
+    c.execute("ALTER TABLE archive_blocks_new RENAME TO archive_blocks")
+
+
+# Append new steps to the end; never edit or reorder ones that have shipped.
+# Steps hold their own SQL rather than calling into other modules, whose code
+# moves on: replaying an old step must do what it did when it shipped.
+MIGRATIONS = [
+    (1, "base tables", _base_tables),
+    (2, "foreign keys", _foreign_keys),
+    (3, "indexes", _indexes),
+    (4, "project search", _project_search),
+    (5, "contributor stats", _contributor_stats),
+    (6, "code history", _code_history),
+    (7, "chat ids", _chat_ids),
+    (8, "blob store", _blob_store),
+    (9, "skills", _skills),
+    (10, "archive", _archive),
+    (11, "archive block ids", _archive_block_ids),
+]
+
+
+def current_version(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, name TEXT, applied_date TEXT)")
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def apply_migrations(conn):
+    applied = []
+    # Foreign key enforcement has to be off while tables are being swapped, and
+    # the pragma is a no-op inside a transaction, so toggle it around the whole run
+    conn.execute("PRAGMA foreign_keys=OFF")
+    try:
+        for version, name, step in MIGRATIONS:
+            # BEGIN IMMEDIATE takes the write lock up front, so if several
+            # processes start together only one of them applies each step
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if current_version(conn) >= version:
+                    conn.rollback()
+                    continue
+                step(conn.cursor())
+                conn.execute("INSERT INTO schema_version (version, name, applied_date) VALUES (?, ?, ?)",
+                             (version, name, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(version)
+    finally:
+        conn.execute("PRAGMA foreign_keys=ON")
+    return applied
+
+
+# Runs the pending migrations once per database per process; later calls are
+# free
+def migrate(pool=None):
+    pool = pool or db.get_pool()
+    if pool.path in _migrated:
+        return
+    with _lock:
+        if pool.path in _migrated:
+            return
+        with pool.connection() as conn:
+            apply_migrations(conn)
+        _migrated.add(pool.path)
@@ -0,0 +1,112 @@
+from datetime import timedelta
+
+import cache
+import chat
+import collab
+import data
+import recommend
+import shards
+
+# What each main() menu branch loads, minus the widgets. edutech3.py renders
+# these and bench.py times them, so both take the same (shard-aware) path.
+# `state` is where a page keeps things between reruns: st.session_state in
+# the app, bench.Session.state in the benchmark.
+
+
+def current_user(conn, user_id):
+    return cache.get_cache().user(conn, user_id)
+
+
+# Every skill name, for the skill pickers (Create Project, Profile)
+def skill_names(conn):
+    return recommend.skill_names(conn)
+
+
+# The Profile page: the user, every skill name and the user's own skills
+def profile(conn, user_id):
+    return current_user(conn, user_id), skill_names(conn), recommend.user_skills(conn, user_id)
+
+
+# One editor session per project per browser session, kept across reruns
+def editor_session(state, conn, project_id):
+    sessions = state.setdefault("editor_sessions", {})
+    if project_id not in sessions:
+        sessions[project_id] = collab.EditorSession(collab.get_store(), conn, project_id)
+    return sessions[project_id]
+
+
+# Chat feeds likewise
+def chat_feed(state, conn, project_id):
+    feeds = state.setdefault("chat_feeds", {})
+    if project_id not in feeds:
+        feeds[project_id] = chat.ChatFeed(chat.get_service(), conn, project_id)
+    return feeds[project_id]
+
+
+# A page of Browse Projects, and on the first page of the unfiltered list the
+# user's skill matches as (title, score)
+def browse(conn, user_id, search=None, cursor=None, page_size=data.PAGE_SIZE):
+    projects, next_cursor = shards.browse_projects(conn, search, cursor, page_size)
+    recommended = []
+    if not search and cursor is None:
+        scored = recommend.get_index().for_user(conn, user_id)
+        if scored:
+            titles = cache.get_cache().projects(conn, [pid for pid, _ in scored])
+            recommended = [(titles[pid][1], score) for pid, score in scored if pid in titles]
+    return projects, next_cursor, recommended
+
+
+def my_projects(conn, user_id):
+    return shards.my_projects(conn, user_id)
+
+
+# A project's members as {user_id: user row}
+def team(conn, project_id):
+    lookups = cache.get_cache()
+    return lookups.users(conn, lookups.members(conn, project_id))
+
+
+# People whose skills fit what the project needs, as (user row, score)
+def suggested_teammates(conn, project_id):
+    suggested = recommend.get_index().candidates(conn, project_id)
+    if not suggested:
+        return []
+    people = cache.get_cache().users(conn, [uid for uid, _ in suggested])
+    return [(people[uid], score) for uid, score in suggested if uid in people]
+
+
+# The projects a user can message in, as lookup-cache project rows by title
+def message_projects(conn, user_id):
+    lookups = cache.get_cache()
+    return sorted(lookups.projects(conn, lookups.member_of(conn, user_id)).values())
+
+
+# The Messages page's window: the latest page of a project's messages (or
+# the page before `jump_to`), kept in `state` and extended on later reruns
+# with anything sent since
+def message_window(state, conn, project_id, jump_to=None):
+    window = state.get("message_window")
+    if window is None or window['project_id'] != project_id or window['jump_to'] != jump_to or not window['rows']:
+        before = None
+        if jump_to:
+            before = ((jump_to + timedelta(days=1)).strftime("%Y-%m-%d"), 0)
+        rows = data.message_page(conn, project_id, before)
+        window = {'project_id': project_id, 'jump_to': jump_to, 'rows': rows,
+                  'more': len(rows) == data.MESSAGE_PAGE}
+        state["message_window"] = window
+    elif not jump_to:
+        newest = window['rows'][0]
+        window['rows'] = data.messages_after(conn, project_id, (newest[3], newest[0])) + window['rows']
+    return window
+
+
+# "Load older messages": the next page past the oldest row in the window
+def older_messages(conn, window):
+    oldest = window['rows'][-1]
+    older = data.message_page(conn, window['project_id'], (oldest[3], oldest[0]))
+    window['rows'] += older
+    window['more'] = len(older) == data.MESSAGE_PAGE
+
+
+def community(conn, cursor=None):
+    return shards.user_directory(conn, cursor)
@@ -0,0 +1,92 @@
+import threading
+import weakref
+from collections import deque
+
+QUEUE_SIZE = 1000
+
+
+# One subscriber's mailbox. Bounded: a subscriber that stops draining loses the
+# oldest messages and is told so, and should then resync from the database.
+class Subscription:
+    def __init__(self, hub, topic, maxsize=QUEUE_SIZE, notify=None):
+        self.hub = hub
+        self.topic = topic
+        # Called from the publishing thread after each delivery, for waiters
+        # that can't block on the condition (api.py's event loop)
+        self.notify = notify
+        self._messages = deque(maxlen=maxsize)
+        self._overflowed = False
+        self._cond = threading.Condition()
+
+    def _deliver(self, message):
+        with self._cond:
+            if len(self._messages) == self._messages.maxlen:
+                self._overflowed = True
+            self._messages.append(message)
+            self._cond.notify_all()
+        if self.notify is not None:
+            self.notify()
+
+    # Returns (messages, overflowed) and empties the mailbox
+    def drain(self):
+        with self._cond:
+            messages = list(self._messages)
+            overflowed = self._overflowed
+            self._messages.clear()
+            self._overflowed = False
+        return messages, overflowed
+
+    def wait(self, timeout=None):
+        with self._cond:
+            if not self._messages:
+                self._cond.wait(timeout)
+            return bool(self._messages)
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+# In-process publish/subscribe. Subscribers are held weakly, so one that lives
+# in a Streamlit session goes away with the session without an explicit close.
+class Hub:
+    def __init__(self):
+        self._topics = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, topic, maxsize=QUEUE_SIZE, notify=None):
+        subscription = Subscription(self, topic, maxsize, notify)
+        with self._lock:
+            self._topics.setdefault(topic, weakref.WeakSet()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._topics.get(subscription.topic)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._topics[subscription.topic]
+
+    def publish(self, topic, message):
+        with self._lock:
+            subscribers = list(self._topics.get(topic, ()))
+        for subscription in subscribers:
+            subscription._deliver(message)
+        return len(subscribers)
+
+    def subscriber_count(self, topic):
+        with self._lock:
+            return len(self._topics.get(topic, ()))
+
+
+_hub = None
+_hub_lock = threading.Lock()
+
+
+def get_hub():
+    global _hub
+    if _hub is None:
+        with _hub_lock:
+            if _hub is None:
+                _hub = Hub()
+    return _hub
@@ -0,0 +1,265 @@
+import threading
+import time
+
+import numpy as np
+
+import cache
+import db
+
+# How often the index reloads everything, to pick up writes made by other
+# processes (roster imports, datagen) that never called the update methods
+REBUILD_EVERY = 300
+TOP_K = 5
+
+
+def _marks(keys):
+    return ','.join(['?'] * len(keys))
+
+
+def skill_names(conn):
+    return [row[0] for row in conn.execute("SELECT name FROM skills ORDER BY id")]
+
+
+def user_skills(conn, user_id):
+    return [row[0] for row in conn.execute("""
+        SELECT s.name FROM user_skills us JOIN skills s ON s.id = us.skill_id
+        WHERE us.user_id=? ORDER BY s.id
+    """, (user_id,))]
+
+
+def project_skills(conn, project_id):
+    return [row[0] for row in conn.execute("""
+        SELECT s.name FROM project_skills ps JOIN skills s ON s.id = ps.skill_id
+        WHERE ps.project_id=? ORDER BY s.id
+    """, (project_id,))]
+
+
+# The (sql, params) statements replacing a user's or project's skills with
+# `names`; unknown names are added to the skills table
+def _skill_writes(table, key, owner_id, names):
+    names = list(dict.fromkeys(names))
+    writes = [("INSERT OR IGNORE INTO skills (name) VALUES (?)", (name,)) for name in names]
+    writes.append((f"DELETE FROM {table} WHERE {key}=?", (owner_id,)))
+    if names:
+        writes.append((f"INSERT INTO {table} ({key}, skill_id) SELECT ?, id FROM skills WHERE name IN ({_marks(names)})",
+                       [owner_id] + names))
+    return writes
+
+
+# Run them on `conn`; the caller commits
+def _set_skills(conn, table, key, owner_id, names):
+    for sql, params in _skill_writes(table, key, owner_id, names):
+        conn.execute(sql, params)
+
+
+def set_user_skills(conn, user_id, names):
+    _set_skills(conn, 'user_skills', 'user_id', user_id, names)
+
+
+# The same for the write-behind writer (actions.update_profile)
+def user_skill_writes(user_id, names):
+    return _skill_writes('user_skills', 'user_id', user_id, names)
+
+
+def set_project_skills(conn, project_id, names):
+    _set_skills(conn, 'project_skills', 'project_id', project_id, names)
+
+
+# Rows of `matrix` scaled to unit length, so a dot product is the cosine
+# similarity; all-zero rows (no skills) stay zero and never match anything
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+# Indices of the k largest scores, best first, skipping -inf and zero
+def _top_k(scores, k):
+    if k < len(scores):
+        top = np.argpartition(scores, -k)[-k:]
+    else:
+        top = np.arange(len(scores))
+    top = top[np.argsort(-scores[top], kind='stable')]
+    return top[scores[top] > 0]
+
+
+# One side of the index (users or projects): a skill matrix with a row per
+# id, grown in chunks so adding one row doesn't copy the whole thing
+class _Rows:
+    def __init__(self, ids, matrix):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.matrix = matrix
+        self.count = len(ids)
+        self.row = {int(i): n for n, i in enumerate(self.ids)}
+
+    def row_for(self, owner_id):
+        n = self.row.get(owner_id)
+        if n is None:
+            if self.count == len(self.ids):
+                grow = max(len(self.ids) // 4, 1024)
+                self.ids = np.concatenate([self.ids, np.zeros(grow, dtype=np.int64)])
+                self.matrix = np.vstack([self.matrix, np.zeros((grow, self.matrix.shape[1]), dtype=np.float32)])
+            n = self.count
+            self.ids[n] = owner_id
+            self.row[owner_id] = n
+            self.count += 1
+        return n
+
+    def set(self, owner_id, columns):
+        n = self.row_for(owner_id)
+        vector = np.zeros(self.matrix.shape[1], dtype=np.float32)
+        vector[columns] = 1
+        self.matrix[n] = _normalize(vector[None, :])[0]
+        return n
+
+
+# Skill vectors for every user and project, held in memory as float32
+# matrices. Scoring is one matrix-vector product over all projects (or all
+# users) followed by a partial sort, so a top-k costs a few milliseconds even
+# at 100k users and 50k projects. Projects that are full, and anything the
+# person already belongs to, are masked out before ranking.
+class SkillIndex:
+    def __init__(self, rebuild_every=REBUILD_EVERY):
+        self.rebuild_every = rebuild_every
+        self._lock = threading.RLock()
+        self._built = None
+        self._counts = {'rebuilds': 0, 'queries': 0, 'updates': 0, 'rebuild_seconds': 0.0, 'query_seconds': 0.0}
+
+    def _load(self, conn, ids_sql, skills_sql):
+        ids = np.fromiter((row[0] for row in conn.execute(ids_sql)), dtype=np.int64)
+        pairs = np.array(conn.execute(skills_sql).fetchall(), dtype=np.int64).reshape(-1, 2)
+        matrix = np.zeros((len(ids), len(self.columns)), dtype=np.float32)
+        if len(pairs):
+            rows = np.searchsorted(ids, pairs[:, 0])
+            known = ((rows < len(ids)) & (ids[np.minimum(rows, len(ids) - 1)] == pairs[:, 0])
+                     & (pairs[:, 1] < len(self._column_array)))
+            matrix[rows[known], self._column_array[pairs[known, 1]]] = 1
+        return _Rows(ids, _normalize(matrix))
+
+    def rebuild(self, conn):
+        started = time.perf_counter()
+        with self._lock:
+            skill_ids = [row[0] for row in conn.execute("SELECT id FROM skills ORDER BY id")]
+            self.columns = {skill_id: n for n, skill_id in enumerate(skill_ids)}
+            self._column_array = np.zeros(max(skill_ids, default=0) + 1, dtype=np.int64)
+            self._column_array[skill_ids] = np.arange(len(skill_ids))
+            self.users = self._load(conn, "SELECT id FROM users ORDER BY id",
+                                    "SELECT user_id, skill_id FROM user_skills")
+            self.projects = self._load(conn, "SELECT id FROM projects ORDER BY id",
+                                       "SELECT project_id, skill_id FROM project_skills")
+            # Open places per project; projects without a limit never fill up
+            self.open = np.full(len(self.projects.ids), np.inf, dtype=np.float32)
+            for project_id, max_members, member_count in conn.execute("""
+                    SELECT p.id, p.max_members, COALESCE(ps.member_count, 0)
+                    FROM projects p LEFT JOIN project_stats ps ON ps.project_id = p.id
+                    WHERE p.max_members IS NOT NULL"""):
+                self.open[self.projects.row[project_id]] = max_members - member_count
+            self._built = time.monotonic()
+            self._counts['rebuilds'] += 1
+            self._counts['rebuild_seconds'] += time.perf_counter() - started
+
+    def _ensure(self, conn):
+        if self._built is None or time.monotonic() - self._built > self.rebuild_every:
+            self.rebuild(conn)
+
+    def _skill_columns(self, conn, table, key, owner_id):
+        skill_ids = [row[0] for row in conn.execute(f"SELECT skill_id FROM {table} WHERE {key}=?", (owner_id,))]
+        if any(skill_id not in self.columns for skill_id in skill_ids):
+            return None
+        return [self.columns[skill_id] for skill_id in skill_ids]
+
+    # Call after committing a change to a user's skills (or a new user)
+    def user_changed(self, conn, user_id):
+        with self._lock:
+            if self._built is None:
+                return
+            columns = self._skill_columns(conn, 'user_skills', 'user_id', user_id)
+            if columns is None:
+                # A skill the index has no column for yet
+                self._built = None
+                return
+            self.users.set(user_id, columns)
+            self._counts['updates'] += 1
+
+    # Call after committing a change to a project: its skills, its size
+    # limit or its members
+    def project_changed(self, conn, project_id):
+        with self._lock:
+            if self._built is None:
+                return
+            columns = self._skill_columns(conn, 'project_skills', 'project_id', project_id)
+            row = conn.execute("""
+                SELECT p.max_members, COALESCE(ps.member_count, 0)
+                FROM projects p LEFT JOIN project_stats ps ON ps.project_id = p.id
+                WHERE p.id=?""", (project_id,)).fetchone()
+            if columns is None or row is None:
+                self._built = None
+                return
+            n = self.projects.set(project_id, columns)
+            if n >= len(self.open):
+                self.open = np.concatenate([self.open, np.full(len(self.projects.ids) - len(self.open), np.inf,
+                                                               dtype=np.float32)])
+            self.open[n] = np.inf if row[0] is None else row[0] - row[1]
+            self._counts['updates'] += 1
+
+    def _query(self, rows, vector, mask, k):
+        started = time.perf_counter()
+        scores = rows.matrix[:rows.count] @ vector
+        scores[mask] = -np.inf
+        top = _top_k(scores, k)
+        self._counts['queries'] += 1
+        self._counts['query_seconds'] += time.perf_counter() - started
+        return [(int(rows.ids[n]), float(scores[n])) for n in top]
+
+    # Projects with open places whose skills best match the user's, as
+    # (project_id, score) pairs, best first
+    def for_user(self, conn, user_id, k=TOP_K):
+        with self._lock:
+            self._ensure(conn)
+            n = self.users.row.get(user_id)
+            if n is None or not self.users.matrix[n].any():
+                return []
+            mask = self.open[:self.projects.count] <= 0
+            joined = [self.projects.row[p] for p in cache.get_cache().member_of(conn, user_id) if p in self.projects.row]
+            mask[joined] = True
+            return self._query(self.projects, self.users.matrix[n], mask, k)
+
+    # Users outside the project whose skills best match what it needs, as
+    # (user_id, score) pairs; nobody once the project is full
+    def candidates(self, conn, project_id, k=TOP_K):
+        with self._lock:
+            self._ensure(conn)
+            n = self.projects.row.get(project_id)
+            if n is None or self.open[n] <= 0 or not self.projects.matrix[n].any():
+                return []
+            mask = np.zeros(self.users.count, dtype=bool)
+            members = [self.users.row[u] for u in cache.get_cache().members(conn, project_id) if u in self.users.row]
+            mask[members] = True
+            return self._query(self.users, self.projects.matrix[n], mask, k)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            if self._built is not None:
+                stats['users'] = self.users.count
+                stats['projects'] = self.projects.count
+                stats['skills'] = len(self.columns)
+        stats['query_ms_avg'] = stats['query_seconds'] / stats['queries'] * 1000 if stats['queries'] else 0.0
+        return stats
+
+
+_indexes = {}
+_index_lock = threading.Lock()
+
+
+# One index per database: when sharded, recommendations come from the
+# current shard, i.e. the user's own institution
+def get_index():
+    pool = db.get_pool()
+    index = _indexes.get(pool)
+    if index is None:
+        with _index_lock:
+            index = _indexes.get(pool)
+            if index is None:
+                index = _indexes[pool] = SkillIndex()
+    return index
@@ -0,0 +1,424 @@
+import argparse
+import base64
+import csv
+import json
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+import db
+import migrations
+import stats
+from accounts import is_edu_email
+
+BATCH = 5000
+ROLES = {"student": "Student", "teacher": "Teacher"}
+# Derived or rebuilt on restore, so not worth exporting
+SKIP_TABLES = ("project_stats", "user_stats")
+# Parents before children, so foreign keys hold while restoring
+TABLE_ORDER = ("schema_version", "users", "projects", "blobs", "skills", "project_members", "user_skills",
+               "project_skills", "project_code", "code_ops", "project_chat", "messages", "project_files",
+               "archive_blocks", "archive_senders")
+
+
+class RowError(ValueError):
+    pass
+
+
+class RestoreError(Exception):
+    pass
+
+
+# -- reading rosters
+
+# Dicts with lower-cased, stripped keys from a .csv or .jsonl file ("-" is
+# stdin, in `fmt`). Yields (line_number, row).
+def read_rows(path, fmt=None):
+    fmt = fmt or ("jsonl" if path.endswith((".jsonl", ".ndjson", ".json")) else "csv")
+    f = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8-sig")
+    try:
+        if fmt == "csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, {(k or "").strip().lower(): (v or "").strip() for k, v in row.items()}
+        else:
+            for line_num, line in enumerate(f, 1):
+                if line.strip():
+                    row = json.loads(line)
+                    yield line_num, {k.strip().lower(): v.strip() if isinstance(v, str) else v for k, v in row.items()}
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _batched(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _marks(values):
+    return ','.join(['?'] * len(values))
+
+
+# BLOB columns (archive blocks) go into exports as base64
+def _encode(value):
+    return base64.b64encode(value).decode("ascii") if isinstance(value, bytes) else value
+
+
+def _encode_json(value):
+    if isinstance(value, bytes):
+        return {"base64": _encode(value)}
+    raise TypeError(f"can't export {type(value).__name__}")
+
+
+def _decode_json(value):
+    return base64.b64decode(value["base64"]) if isinstance(value, dict) and "base64" in value else value
+
+
+class Progress:
+    def __init__(self, label, out=sys.stderr):
+        self.label = label
+        self.out = out
+        self.started = time.perf_counter()
+        self.counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'invalid': 0}
+        self.errors = []
+
+    def error(self, line_num, message):
+        self.counts['invalid'] += 1
+        if len(self.errors) < 1000:
+            self.errors.append((line_num, message))
+
+    def show(self, final=False):
+        done = sum(self.counts.values())
+        elapsed = time.perf_counter() - self.started
+        parts = ", ".join(f"{n:,} {name}" for name, n in self.counts.items() if n)
+        self.out.write(f"\r{self.label}: {done:,} rows ({done / max(elapsed, 1e-9):,.0f}/s) {parts}")
+        if final:
+            self.out.write(f" in {elapsed:.1f}s\n")
+        self.out.flush()
+
+
+# -- importing
+
+def _user_row(row):
+    email = row.get("email") or ""
+    if not email or "@" not in email:
+        raise RowError(f"missing or malformed email {email!r}")
+    if not is_edu_email(email):
+        raise RowError(f"{email} is not an educational address")
+    name = row.get("name") or ""
+    if not name:
+        raise RowError(f"{email}: missing name")
+    role = ROLES.get((row.get("role") or "student").lower())
+    if role is None:
+        raise RowError(f"{email}: role must be Student or Teacher, not {row.get('role')!r}")
+    join_date = row.get("join_date") or datetime.now().strftime("%Y-%m-%d")
+    return (name, email, row.get("institution") or None, role, join_date)
+
+
+# Upsert on email: new addresses are inserted, known ones get their name,
+# institution and role updated. Profile pictures and join dates are kept.
+def import_users(conn, rows, progress, batch_size=BATCH):
+    for batch in _batched(rows, batch_size):
+        valid = {}
+        for line_num, row in batch:
+            try:
+                user = _user_row(row)
+            except RowError as e:
+                progress.error(line_num, str(e))
+                continue
+            valid[user[1]] = user  # the last row for an address wins
+        if not valid:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        emails = list(valid)
+        existing = {email: (name, institution, role) for email, name, institution, role in conn.execute(
+            f"SELECT email, name, institution, role FROM users WHERE email IN ({_marks(emails)})", emails)}
+        conn.executemany("""
+            INSERT INTO users (name, email, institution, role, join_date) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(email) DO UPDATE SET name=excluded.name, institution=excluded.institution, role=excluded.role
+            WHERE (name, institution, role) IS NOT (excluded.name, excluded.institution, excluded.role)
+        """, list(valid.values()))
+        conn.commit()
+        for email, user in valid.items():
+            before = existing.get(email)
+            if before is None:
+                progress.counts['inserted'] += 1
+            elif before == (user[0], user[2], user[3]):
+                progress.counts['unchanged'] += 1
+            else:
+                progress.counts['updated'] += 1
+        progress.show()
+
+
+def _user_ids(conn, emails):
+    emails = list(set(emails))
+    found = {}
+    for i in range(0, len(emails), 900):
+        chunk = emails[i:i + 900]
+        found.update(conn.execute(f"SELECT email, id FROM users WHERE email IN ({_marks(chunk)})", chunk).fetchall())
+    return found
+
+
+def _user_ref(row, emails, email_key, id_key):
+    if row.get(email_key):
+        user_id = emails.get(row[email_key])
+        if user_id is None:
+            raise RowError(f"no user with email {row[email_key]}")
+        return user_id
+    if row.get(id_key):
+        return int(row[id_key])
+    raise RowError(f"needs {email_key} or {id_key}")
+
+
+# The ones of `ids` that are users; ids that aren't numbers are left for
+# _user_ref() to reject
+def _existing_user_ids(conn, ids):
+    ids = list({int(i) for i in ids if str(i).strip().lstrip("-").isdigit()})
+    found = set()
+    for i in range(0, len(ids), 900):
+        chunk = ids[i:i + 900]
+        found.update(user_id for (user_id,) in conn.execute(f"SELECT id FROM users WHERE id IN ({_marks(chunk)})", chunk))
+    return found
+
+
+# Projects have no natural key, so (title, creator) is treated as one: a row
+# matching an existing project updates its description. Creators are added as
+# members, as the Create Project form does.
+def import_projects(conn, rows, progress, batch_size=BATCH):
+    known = {(title, created_by): project_id for project_id, title, created_by in
+             conn.execute("SELECT id, title, created_by FROM projects")}
+    for batch in _batched(rows, batch_size):
+        emails = _user_ids(conn, [row["creator_email"] for _, row in batch if row.get("creator_email")])
+        user_ids = _existing_user_ids(conn, [row["created_by"] for _, row in batch
+                                             if row.get("created_by") and not row.get("creator_email")])
+        conn.execute("BEGIN IMMEDIATE")
+        for line_num, row in batch:
+            try:
+                title = row.get("title") or ""
+                if not title:
+                    raise RowError("missing title")
+                created_by = _user_ref(row, emails, "creator_email", "created_by")
+                if not row.get("creator_email") and created_by not in user_ids:
+                    raise RowError(f"no user with id {created_by}")
+            except (RowError, ValueError) as e:
+                progress.error(line_num, str(e))
+                continue
+            description = row.get("description") or ""
+            project_id = known.get((title, created_by))
+            if project_id is None:
+                c = conn.execute("INSERT INTO projects (title, description, created_by, created_date) VALUES (?, ?, ?, ?)",
+                                 (title, description, created_by, row.get("created_date") or datetime.now().strftime("%Y-%m-%d")))
+                known[(title, created_by)] = project_id = c.lastrowid
+                progress.counts['inserted'] += 1
+            else:
+                c = conn.execute("UPDATE projects SET description=? WHERE id=? AND description IS NOT ?",
+                                 (description, project_id, description))
+                progress.counts['updated' if c.rowcount else 'unchanged'] += 1
+            conn.execute("INSERT OR IGNORE INTO project_members (project_id, user_id) VALUES (?, ?)", (project_id, created_by))
+        conn.commit()
+        progress.show()
+
+
+# Rows name the user by email (or user_id) and the project by project_id, or
+# by title when that title is unique
+def import_memberships(conn, rows, progress, batch_size=BATCH):
+    titles = {}
+    for project_id, title in conn.execute("SELECT id, title FROM projects"):
+        titles[title] = None if title in titles else project_id
+    for batch in _batched(rows, batch_size):
+        emails = _user_ids(conn, [row["email"] for _, row in batch if row.get("email")])
+        pairs = []
+        for line_num, row in batch:
+            try:
+                user_id = _user_ref(row, emails, "email", "user_id")
+                if row.get("project_id"):
+                    project_id = int(row["project_id"])
+                elif row.get("project"):
+                    if row["project"] not in titles:
+                        raise RowError(f"no project titled {row['project']!r}")
+                    project_id = titles[row["project"]]
+                    if project_id is None:
+                        raise RowError(f"several projects are titled {row['project']!r}; use project_id")
+                else:
+                    raise RowError("needs project_id or project")
+            except (RowError, ValueError) as e:
+                progress.error(line_num, str(e))
+                continue
+            pairs.append((project_id, user_id))
+        if not pairs:
+            continue
+        # rowcount, not total_changes: the stats triggers' writes would count
+        # too outside stats.bulk_load()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            added = conn.executemany("INSERT OR IGNORE INTO project_members (project_id, user_id) VALUES (?, ?)",
+                                     pairs).rowcount
+        except sqlite3.IntegrityError:
+            # A project or user id that doesn't exist: redo the batch row by row
+            conn.rollback()
+            conn.execute("BEGIN IMMEDIATE")
+            added = 0
+            kept = []
+            for pair in pairs:
+                try:
+                    added += conn.execute("INSERT OR IGNORE INTO project_members (project_id, user_id) VALUES (?, ?)",
+                                          pair).rowcount
+                    kept.append(pair)
+                except sqlite3.IntegrityError:
+                    progress.error(None, f"project {pair[0]} or user {pair[1]} does not exist")
+            pairs = kept
+        conn.commit()
+        progress.counts['inserted'] += added
+        progress.counts['unchanged'] += len(pairs) - added
+        progress.show()
+
+
+IMPORTERS = {'users': import_users, 'projects': import_projects, 'members': import_memberships}
+
+
+def import_file(conn, kind, path, fmt=None, batch_size=BATCH):
+    progress = Progress(f"{kind} from {path}")
+    if kind == 'members':
+        with stats.bulk_load(conn):
+            IMPORTERS[kind](conn, read_rows(path, fmt), progress, batch_size)
+    else:
+        IMPORTERS[kind](conn, read_rows(path, fmt), progress, batch_size)
+    progress.show(final=True)
+    return progress
+
+
+# -- export and restore
+
+def export_tables(conn):
+    return [name for (name,) in conn.execute("""
+        SELECT name FROM sqlite_master
+        WHERE type='table' AND name NOT LIKE 'sqlite_%' AND name NOT LIKE 'projects_fts%'
+        ORDER BY name
+    """) if name not in SKIP_TABLES]
+
+
+# Stream every table to <out_dir>/<table>.jsonl (or .csv), a batch of rows at
+# a time, from one read transaction so the files are consistent with each
+# other. Returns {table: rows}.
+def export(conn, out_dir, fmt="jsonl", tables=None, batch_size=BATCH):
+    os.makedirs(out_dir, exist_ok=True)
+    counts = {}
+    conn.execute("BEGIN")
+    try:
+        for table in tables or export_tables(conn):
+            cursor = conn.execute(f"SELECT * FROM {table} ORDER BY rowid")
+            columns = [d[0] for d in cursor.description]
+            path = os.path.join(out_dir, f"{table}.{fmt}")
+            n = 0
+            with open(path + ".tmp", "w", newline="", encoding="utf-8") as f:
+                if fmt == "csv":
+                    out = csv.writer(f)
+                    out.writerow(columns)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    if fmt == "csv":
+                        out.writerows([_encode(value) for value in row] for row in rows)
+                    else:
+                        f.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=_encode_json) + "\n"
+                                     for row in rows)
+                    n += len(rows)
+                    sys.stderr.write(f"\r{table}: {n:,} rows")
+            os.replace(path + ".tmp", path)
+            sys.stderr.write(f"\r{table}: {n:,} rows\n")
+            counts[table] = n
+    finally:
+        conn.rollback()
+    return counts
+
+
+# Load a JSONL export into a freshly migrated, empty database, keeping ids.
+# File contents live under project_uploads/ and uploads/; copy those across
+# separately.
+def restore(conn, in_dir, batch_size=BATCH):
+    if conn.execute("SELECT EXISTS (SELECT 1 FROM users)").fetchone()[0]:
+        raise RestoreError("restore needs an empty database")
+    files = {name[:-len(".jsonl")] for name in os.listdir(in_dir) if name.endswith(".jsonl")}
+    tables = [t for t in TABLE_ORDER if t in files] + sorted(files - set(TABLE_ORDER))
+    counts = {}
+    with stats.bulk_load(conn):
+        for table in tables:
+            path = os.path.join(in_dir, f"{table}.jsonl")
+            if table == "schema_version":
+                # The target was migrated already; its own history stands
+                continue
+            n = 0
+            for batch in _batched((row for _, row in read_rows(path, "jsonl")), batch_size):
+                columns = list(batch[0])
+                conn.execute("BEGIN IMMEDIATE")
+                # OR REPLACE: migrations seed a few rows (skills) the export has too
+                conn.executemany(f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({_marks(columns)})",
+                                 [[_decode_json(row.get(c)) for c in columns] for row in batch])
+                conn.commit()
+                n += len(batch)
+                sys.stderr.write(f"\r{table}: {n:,} rows")
+            sys.stderr.write(f"\r{table}: {n:,} rows\n")
+            counts[table] = n
+        # The reference-count triggers counted every file again on top of the
+        # exported counts
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("UPDATE blobs SET ref_count = (SELECT COUNT(*) FROM project_files f WHERE f.sha256 = blobs.sha256)")
+        conn.commit()
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk roster import, and export/restore of the whole database.")
+    parser.add_argument("--db", default=db.DB_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    p = commands.add_parser("import", help="upsert users, projects or memberships from CSV/JSONL files")
+    p.add_argument("kind", choices=sorted(IMPORTERS))
+    p.add_argument("files", nargs="+", help='.csv or .jsonl files, or "-" for stdin')
+    p.add_argument("--format", choices=["csv", "jsonl"], help="file format when it can't be told from the name")
+    p.add_argument("--batch", type=int, default=BATCH, help="rows per transaction")
+    p = commands.add_parser("export", help="stream every table to a directory")
+    p.add_argument("out_dir")
+    p.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    p.add_argument("--tables", nargs="*")
+    p = commands.add_parser("restore", help="load a JSONL export into an empty database")
+    p.add_argument("in_dir")
+    args = parser.parse_args(argv)
+
+    pool = db.ConnectionPool(args.db, size=1)
+    migrations.migrate(pool)
+    with pool.connection() as conn:
+        if args.command == "import":
+            failed = False
+            for path in args.files:
+                progress = import_file(conn, args.kind, path, args.format, args.batch)
+                for line_num, message in progress.errors[:20]:
+                    print(f"  {path}:{line_num or '?'}: {message}", file=sys.stderr)
+                if progress.counts['invalid'] > 20:
+                    print(f"  ... and {progress.counts['invalid'] - 20} more", file=sys.stderr)
+                failed = failed or progress.counts['invalid'] > 0
+            if failed:
+                sys.exit(1)
+        elif args.command == "export":
+            counts = export(conn, args.out_dir, args.format, args.tables)
+            print(f"Exported {sum(counts.values()):,} rows from {len(counts)} tables to {args.out_dir}")
+        else:
+            try:
+                counts = restore(conn, args.in_dir)
+            except RestoreError as e:
+                sys.exit(str(e))
+            print(f"Restored {sum(counts.values()):,} rows into {len(counts)} tables")
+    pool.close()
+
+
+if __name__ == "__main__":
+    main()
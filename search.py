@@ -0,0 +1,63 @@
+import re
+
+# bm25() weights per indexed column: a hit in the title counts for more
+PROJECT_WEIGHTS = (10.0, 1.0)
+SNIPPET_TOKENS = 24
+
+_TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+
+# Turns what people type into an FTS5 MATCH expression: "quoted text" stays an
+# exact phrase, every other word becomes a prefix term, and all of them must
+# match. Everything is quoted so stray punctuation can't break the query
+# syntax. Returns None when there is nothing searchable left.
+def match_query(text):
+    terms = []
+    for phrase, word in _TERM.findall(text or ""):
+        if phrase.strip():
+            terms.append('"' + phrase.replace('"', '""') + '"')
+        elif word:
+            word = word.strip('"*')
+            if re.search(r'\w', word):
+                terms.append('"' + word.replace('"', '""') + '"*')
+    return ' AND '.join(terms) or None
+
+
+# Ranked project search. Rows are (id, title, description, created_by,
+# created_date, creator_name, snippet), best match first; the snippet marks
+# hits with ** so it renders bold in markdown. Pagination is keyset on
+# (rank, id): pass the cursor returned with the previous page as `after`.
+def search_projects(conn, text, after=None, page_size=20):
+    rows = ranked_matches(conn, text, after, page_size + 1)
+    next_cursor = None
+    if len(rows) > page_size:
+        last = rows[page_size - 1]
+        next_cursor = (last[7], last[0])
+    return [row[:7] for row in rows[:page_size]], next_cursor
+
+
+# Up to `limit` matches after the (rank, id) `after`, as search_projects()
+# rows with the rank appended; shards.py merges these across databases
+def ranked_matches(conn, text, after=None, limit=21):
+    query = match_query(text)
+    if query is None:
+        return []
+    weights = ', '.join(str(w) for w in PROJECT_WEIGHTS)
+    sql = f"""
+        SELECT p.id, p.title, p.description, p.created_by, p.created_date, u.name, hit.snippet, hit.rank
+        FROM (
+            SELECT rowid AS id, rank,
+                   snippet(projects_fts, -1, '**', '**', '...', {SNIPPET_TOKENS}) AS snippet
+            FROM projects_fts
+            WHERE projects_fts MATCH ? AND rank MATCH 'bm25({weights})'
+        ) hit
+        JOIN projects p ON p.id = hit.id
+        LEFT JOIN users u ON u.id = p.created_by
+    """
+    params = [query]
+    if after is not None:
+        sql += " WHERE (hit.rank, hit.id) > (?, ?)"
+        params += list(after)
+    sql += " ORDER BY hit.rank, hit.id LIMIT ?"
+    params.append(limit)
+    return conn.execute(sql, params).fetchall()
@@ -0,0 +1,592 @@
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import cache
+import data
+import db
+import migrations
+import search
+import stats
+
+# Per-institution databases. With EDUCOLLAB_SHARD_DIR set, every institution
+# (by email domain) gets its own SQLite file in that directory, holding its
+# users, the projects they create and everything hanging off those projects
+# (members, chat, messages, code, files). A small directory database maps
+# user and project ids to shards and hands out the ids, so ids stay unique
+# across all of them. Someone who joins a project at another institution gets
+# a copy of their user row on that shard ("guest" row), so the project's
+# joins and foreign keys work locally. Pages that read across institutions
+# (Browse, Community, My Projects) fan out to every shard in parallel and
+# merge.
+DIRECTORY_DB = "directory.db"
+FANOUT_WORKERS = int(os.environ.get("EDUCOLLAB_FANOUT_WORKERS", "8"))
+# Id -> shard lookups kept in memory; ids never move between shards
+LOCATION_CACHE = 200000
+DEFAULT_SHARD = "default"
+
+DIRECTORY_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS shards
+       (key TEXT PRIMARY KEY, institution TEXT, created_date TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS user_directory
+       (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT UNIQUE,
+        shard TEXT NOT NULL REFERENCES shards(key))''',
+    '''CREATE TABLE IF NOT EXISTS project_directory
+       (id INTEGER PRIMARY KEY AUTOINCREMENT, shard TEXT NOT NULL REFERENCES shards(key))''',
+    '''CREATE INDEX IF NOT EXISTS ix_user_directory_shard ON user_directory(shard)''',
+]
+KINDS = {'user': 'user_directory', 'project': 'project_directory'}
+
+
+def enabled():
+    return db.SHARD_DIR is not None
+
+
+def _marks(keys):
+    return ','.join(['?'] * len(keys))
+
+
+# The shard an account belongs to: its institution's email domain, without
+# department subdomains (cs.mit.edu -> mit.edu, maths.ox.ac.uk -> ox.ac.uk),
+# or the institution's name when there is no usable domain
+def shard_key(email, institution=None):
+    domain = email.rsplit("@", 1)[1].strip().lower() if email and "@" in email else ""
+    labels = [label for label in re.sub(r"[^a-z0-9.-]", "", domain).split(".") if label]
+    if len(labels) >= 3 and labels[-2] in ("ac", "edu"):
+        return ".".join(labels[-3:])
+    if len(labels) >= 2:
+        return ".".join(labels[-2:])
+    return re.sub(r"[^a-z0-9]+", "-", (institution or "").lower()).strip("-") or DEFAULT_SHARD
+
+
+class ShardRouter:
+    def __init__(self, root=None, workers=FANOUT_WORKERS):
+        self.root = root or db.SHARD_DIR
+        os.makedirs(self.root, exist_ok=True)
+        self.directory = db.ConnectionPool(os.path.join(self.root, DIRECTORY_DB), size=4)
+        with self.directory.connection() as conn:
+            for statement in DIRECTORY_SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shard-fan-out")
+        self._lock = threading.Lock()
+        self._keys = None
+        self._locations = {}
+        self._stats = {'fan_outs': 0, 'fan_out_seconds': 0.0, 'guest_copies': 0}
+
+    # -- shards and connections
+
+    def keys(self):
+        if self._keys is None:
+            with self.directory.connection() as conn:
+                self._keys = [row[0] for row in conn.execute("SELECT key FROM shards ORDER BY key")]
+        return self._keys
+
+    def add_shard(self, conn, key, institution=None):
+        conn.execute("INSERT OR IGNORE INTO shards (key, institution, created_date) VALUES (?, ?, datetime('now'))",
+                     (key, institution))
+        self._keys = None
+
+    def pool(self, key):
+        pool = db.get_pool(key)
+        migrations.migrate(pool)
+        return pool
+
+    # A connection to `key`, with `key` current for the block so the writer,
+    # recommendations and anything else built on db.get_pool() follow it
+    @contextmanager
+    def connection(self, key):
+        pool = self.pool(key)
+        with db.use_shard(key), pool.connection() as conn:
+            yield conn
+
+    # Run fn(conn) on each shard in parallel; {key: result}
+    def fan_out(self, fn, keys=None):
+        keys = self.keys() if keys is None else keys
+        return self.fan_out_groups({key: None for key in keys}, lambda conn, _: fn(conn))
+
+    # Run fn(conn, ids) for each {shard: ids} group in parallel
+    def fan_out_groups(self, groups, fn):
+        started = time.perf_counter()
+
+        def run(item):
+            key, ids = item
+            with self.connection(key) as conn:
+                return fn(conn, ids)
+        # A fan-out from inside a fan-out (a cache miss while loading a shard)
+        # runs in line: waiting on the executor from its own workers could
+        # deadlock it
+        if len(groups) > 1 and not getattr(_worker, 'active', False):
+            results = dict(zip(groups, self._executor.map(_as_worker(run), groups.items())))
+        else:
+            results = {key: run((key, ids)) for key, ids in groups.items()}
+        with self._lock:
+            self._stats['fan_outs'] += 1
+            self._stats['fan_out_seconds'] += time.perf_counter() - started
+        return results
+
+    # -- the directory
+
+    def locate_many(self, kind, ids):
+        found, missing = {}, []
+        for owner_id in dict.fromkeys(ids):
+            key = self._locations.get((kind, owner_id))
+            if key is None:
+                missing.append(owner_id)
+            else:
+                found[owner_id] = key
+        if missing:
+            with self.directory.connection() as conn:
+                for start in range(0, len(missing), 500):
+                    chunk = missing[start:start + 500]
+                    for owner_id, key in conn.execute(
+                            f"SELECT id, shard FROM {KINDS[kind]} WHERE id IN ({_marks(chunk)})", chunk):
+                        found[owner_id] = key
+            with self._lock:
+                if len(self._locations) > LOCATION_CACHE:
+                    self._locations.clear()
+                self._locations.update(((kind, owner_id), found[owner_id]) for owner_id in missing
+                                       if owner_id in found)
+        return found
+
+    def locate(self, kind, owner_id):
+        return self.locate_many(kind, [owner_id]).get(owner_id)
+
+    # {shard: [ids]} for ids the directory knows about
+    def group(self, kind, ids):
+        groups = {}
+        for owner_id, key in self.locate_many(kind, ids).items():
+            groups.setdefault(key, []).append(owner_id)
+        return groups
+
+    def find_user(self, email):
+        with self.directory.connection() as conn:
+            row = conn.execute("SELECT id FROM user_directory WHERE email=?", (email,)).fetchone()
+        return row[0] if row else None
+
+    # Claims the email in the directory, then writes the user to their shard.
+    # A taken email raises sqlite3.IntegrityError, as the users table would.
+    def register_user(self, name, email, institution, role, join_date):
+        key = shard_key(email, institution)
+        with self.directory.connection() as conn:
+            self.add_shard(conn, key, institution)
+            user_id = conn.execute("INSERT INTO user_directory (email, shard) VALUES (?, ?)", (email, key)).lastrowid
+            conn.commit()
+        try:
+            with self.connection(key) as conn:
+                conn.execute("INSERT INTO users (id, name, email, institution, role, join_date) VALUES (?, ?, ?, ?, ?, ?)",
+                             (user_id, name, email, institution, role, join_date))
+                conn.commit()
+        except Exception:
+            with self.directory.connection() as conn:
+                conn.execute("DELETE FROM user_directory WHERE id=?", (user_id,))
+                conn.commit()
+            raise
+        return user_id
+
+    def new_project_id(self, key):
+        with self.directory.connection() as conn:
+            project_id = conn.execute("INSERT INTO project_directory (shard) VALUES (?)", (key,)).lastrowid
+            conn.commit()
+        return project_id
+
+    # Copy a user's row from their home shard to `key` so they can belong to
+    # a project there; refreshed by user_changed()
+    def add_guest(self, key, user_id):
+        home = self.locate('user', user_id)
+        if home is None or home == key:
+            return
+        with self.connection(home) as conn:
+            row = conn.execute(f"SELECT {cache.USER_COLUMNS} FROM users WHERE id=?", (user_id,)).fetchone()
+        if row is None:
+            return
+        with self.connection(key) as conn:
+            if conn.execute(f"INSERT OR IGNORE INTO users ({cache.USER_COLUMNS}) VALUES ({_marks(row)})",
+                            row).rowcount:
+                with self._lock:
+                    self._stats['guest_copies'] += 1
+            conn.commit()
+
+    # After a profile edit on the home shard: bring the guest rows up to date
+    def user_changed(self, user_id):
+        home = self.locate('user', user_id)
+        if home is None:
+            return
+        with self.connection(home) as conn:
+            row = conn.execute(f"SELECT {cache.USER_COLUMNS} FROM users WHERE id=?", (user_id,)).fetchone()
+        if row is None:
+            return
+        columns = cache.USER_COLUMNS.split(", ")[1:]
+
+        def update(conn):
+            conn.execute(f"UPDATE users SET {', '.join(c + '=?' for c in columns)} WHERE id=?", row[1:] + row[:1])
+            conn.commit()
+        self.fan_out(update, [key for key in self.keys() if key != home])
+
+    # -- reads across shards
+
+    # data.browse_projects() over every shard. Project ids come from the
+    # directory, so newest-first pages merge on id and the same cursor works
+    # on every shard. Search merges on bm25 rank, which each shard computes
+    # from its own statistics: close to, not exactly, a single index's order.
+    def browse_projects(self, text=None, cursor=None, page_size=data.PAGE_SIZE):
+        if text:
+            results = self.fan_out(lambda conn: search.ranked_matches(conn, text, cursor, page_size + 1))
+            rows = sorted((row for rows in results.values() for row in rows), key=lambda row: (row[7], row[0]))
+            next_cursor = (rows[page_size - 1][7], rows[page_size - 1][0]) if len(rows) > page_size else None
+            return [row[:7] for row in rows[:page_size]], next_cursor
+        results = self.fan_out(lambda conn: data.browse_projects(conn, None, cursor, page_size))
+        rows = sorted((row for rows, _ in results.values() for row in rows), key=lambda row: row[0], reverse=True)
+        more = len(rows) > page_size or any(next_cursor is not None for _, next_cursor in results.values())
+        return rows[:page_size], rows[page_size - 1][0] if more else None
+
+    # data.my_projects() from every shard, in id order
+    def my_projects(self, user_id):
+        results = self.fan_out(lambda conn: data.my_projects(conn, user_id))
+        return sorted((row for rows in results.values() for row in rows), key=lambda row: row[0])
+
+    # stats.user_directory() across shards. The page of ids comes from the
+    # directory; each person's stats are the sum over the shards they have
+    # rows on (home plus guest rows), since each shard only counts its own
+    # projects.
+    def user_directory(self, after_id=None, page_size=stats.USER_PAGE_SIZE):
+        with self.directory.connection() as conn:
+            ids = [row[0] for row in conn.execute("SELECT id FROM user_directory WHERE id > ? ORDER BY id LIMIT ?",
+                                                  (after_id or 0, page_size + 1))]
+        next_cursor = ids[page_size - 1] if len(ids) > page_size else None
+        ids = ids[:page_size]
+        if not ids:
+            return [], None
+        homes = self.locate_many('user', ids)
+        merged = {}
+        for key, rows in self.fan_out(lambda conn: stats.user_rows(conn, ids)).items():
+            for row in rows:
+                user_id = row[0]
+                if user_id not in merged:
+                    merged[user_id] = [None, 0, 0, None]
+                entry = merged[user_id]
+                if key == homes.get(user_id):
+                    entry[0] = row[:5]
+                entry[1] += row[5]
+                entry[2] += row[6]
+                entry[3] = max(filter(None, (entry[3], row[7])), default=None)
+        return [entry[0] + tuple(entry[1:]) for user_id, entry in sorted(merged.items()) if entry[0]], next_cursor
+
+    # Lookup-cache loaders (cache.KINDS) that find rows wherever they live
+
+    def load_users(self, user_ids):
+        return self._load_grouped('user', user_ids, cache.LOCAL_LOADERS['user'])
+
+    def load_projects(self, project_ids):
+        return self._load_grouped('project', project_ids, cache.LOCAL_LOADERS['project'])
+
+    def load_members(self, project_ids):
+        return self._load_grouped('project', project_ids, cache.LOCAL_LOADERS['members'])
+
+    def load_member_of(self, user_ids):
+        found = {user_id: set() for user_id in user_ids}
+        for projects in self.fan_out(lambda conn: cache.LOCAL_LOADERS['member_of'](conn, user_ids)).values():
+            for user_id, project_ids in projects.items():
+                found[user_id].update(project_ids)
+        return {user_id: frozenset(project_ids) for user_id, project_ids in found.items()}
+
+    def _load_grouped(self, kind, ids, load):
+        found = {}
+        for rows in self.fan_out_groups(self.group(kind, ids), load).values():
+            found.update(rows)
+        return found
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['locations_cached'] = len(self._locations)
+        stats['shards'] = len(self.keys())
+        stats['fan_out_ms_avg'] = stats['fan_out_seconds'] / stats['fan_outs'] * 1000 if stats['fan_outs'] else 0.0
+        return stats
+
+
+_worker = threading.local()
+
+
+def _as_worker(fn):
+    def run(*args):
+        _worker.active = True
+        try:
+            return fn(*args)
+        finally:
+            _worker.active = False
+    return run
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = ShardRouter()
+    return _router
+
+
+# Turn sharding on for this process, with the shards in `root`. Done at
+# import when EDUCOLLAB_SHARD_DIR is set; CLIs taking --dir call it
+# themselves. From then on the lookup cache finds users, projects and
+# memberships on whichever shard holds them instead of the connection it is
+# handed.
+def enable(root):
+    db.SHARD_DIR = root
+    cache.KINDS.update({
+        'user': ('users', lambda conn, ids: get_router().load_users(ids)),
+        'project': ('projects', lambda conn, ids: get_router().load_projects(ids)),
+        'member_of': ('project_members', lambda conn, ids: get_router().load_member_of(ids)),
+        'members': ('project_members', lambda conn, ids: get_router().load_members(ids)),
+    })
+
+
+if enabled():
+    enable(db.SHARD_DIR)
+
+
+# The app's entry points. Each one falls back to the single database when
+# sharding is off, so pages call these the same way either way.
+
+# Make the user's home shard current for the rest of this rerun
+def bind(user_id):
+    if enabled():
+        db.set_shard(get_router().locate('user', user_id) if user_id is not None else None)
+
+
+def find_user(email):
+    if enabled():
+        return get_router().find_user(email)
+    with db.connection() as conn:
+        row = conn.execute("SELECT id FROM users WHERE email=?", (email,)).fetchone()
+    return row[0] if row else None
+
+
+def register_user(name, email, institution, role, join_date):
+    if enabled():
+        return get_router().register_user(name, email, institution, role, join_date)
+    with db.connection() as conn:
+        user_id = conn.execute("INSERT INTO users (name, email, institution, role, join_date) VALUES (?, ?, ?, ?, ?)",
+                               (name, email, institution, role, join_date)).lastrowid
+        conn.commit()
+    return user_id
+
+
+# An id for a new project on the current shard; None (let SQLite pick) when
+# not sharded
+def new_project_id():
+    return get_router().new_project_id(db.current_shard()) if enabled() else None
+
+
+# The project's shard, current for the block; just db.connection() otherwise
+@contextmanager
+def project_connection(project_id):
+    if not enabled():
+        with db.connection() as conn:
+            yield conn
+        return
+    key = get_router().locate('project', project_id)
+    if key is None:
+        import actions
+        raise actions.NotFound("Project not found")
+    with get_router().connection(key) as conn:
+        yield conn
+
+
+# Before adding someone to a project: make sure the project's shard has
+# their user row
+def ensure_member_row(project_id, user_id):
+    if enabled():
+        router = get_router()
+        router.add_guest(router.locate('project', project_id), user_id)
+
+
+def user_changed(user_id):
+    if enabled():
+        get_router().user_changed(user_id)
+
+
+def browse_projects(conn, text=None, cursor=None, page_size=data.PAGE_SIZE):
+    if enabled():
+        return get_router().browse_projects(text, cursor, page_size)
+    return data.browse_projects(conn, text, cursor, page_size)
+
+
+def my_projects(conn, user_id):
+    if enabled():
+        return get_router().my_projects(user_id)
+    return data.my_projects(conn, user_id)
+
+
+def user_directory(conn, after_id=None):
+    if enabled():
+        return get_router().user_directory(after_id)
+    return stats.user_directory(conn, after_id)
+
+
+def shard_stats():
+    return get_router().stats() if enabled() else {}
+
+
+# -- splitting a single database into shards
+
+# Which rows of each table go to a shard, given temp tables of the shard's
+# own users (home_users), projects (shard_projects) and every user its rows
+# refer to (shard_users). Tables are copied in this order.
+SPLIT = [
+    ("users", "id IN (SELECT id FROM shard_users)"),
+    ("projects", "id IN (SELECT id FROM shard_projects)"),
+    ("skills", None),
+    ("blobs", "sha256 IN (SELECT sha256 FROM src.project_files WHERE project_id IN (SELECT id FROM shard_projects))"),
+    ("project_members", "project_id IN (SELECT id FROM shard_projects)"),
+    ("user_skills", "user_id IN (SELECT id FROM home_users)"),
+    ("project_skills", "project_id IN (SELECT id FROM shard_projects)"),
+    ("project_code", "project_id IN (SELECT id FROM shard_projects)"),
+    ("code_ops", "project_id IN (SELECT id FROM shard_projects)"),
+    ("project_chat", "project_id IN (SELECT id FROM shard_projects)"),
+    ("messages", "project_id IN (SELECT id FROM shard_projects)"),
+    ("archive_blocks", "project_id IN (SELECT id FROM shard_projects)"),
+    ("archive_senders", "block_id IN (SELECT id FROM src.archive_blocks "
+                        "WHERE project_id IN (SELECT id FROM shard_projects))"),
+    ("project_files", "project_id IN (SELECT id FROM shard_projects)"),
+]
+# Maintained by the shard itself (migrations, stats and FTS triggers)
+SPLIT_SKIP = ("schema_version", "project_stats", "user_stats", "sqlite_sequence", "sqlite_stat1")
+# Columns that point at users, per table, for the guest rows a shard needs
+USER_REFERENCES = [("projects", "created_by"), ("project_members", "user_id"), ("code_ops", "user_id"),
+                   ("project_chat", "sender_id"), ("messages", "sender_id"), ("project_files", "uploader_id"),
+                   ("archive_senders", "sender_id")]
+
+
+def _user_tables(conn, schema="main"):
+    return [row[0] for row in conn.execute(
+        f"SELECT name FROM {schema}.sqlite_master WHERE type='table' AND name NOT LIKE 'projects_fts%'")]
+
+
+# Copy `source` (a single, unsharded database) into shards under db.SHARD_DIR,
+# which must not have any yet. Uploaded files stay where they are: every
+# shard's blobs point into the same blob directory.
+def split(source, out=sys.stderr):
+    router = get_router()
+    if router.keys():
+        sys.exit(f"{router.root} already has shards")
+    source_pool = db.ConnectionPool(source, size=1)
+    migrations.migrate(source_pool)
+    with source_pool.connection() as conn:
+        unknown = set(_user_tables(conn)) - {table for table, _ in SPLIT} - set(SPLIT_SKIP)
+        if unknown:
+            sys.exit(f"don't know how to split: {', '.join(sorted(unknown))}")
+        homes = {user_id: (shard_key(email, institution), institution)
+                 for user_id, email, institution in conn.execute("SELECT id, email, institution FROM users")}
+        projects = {project_id: homes.get(created_by, (DEFAULT_SHARD, None))[0]
+                    for project_id, created_by in conn.execute("SELECT id, created_by FROM projects")}
+        emails = conn.execute("SELECT id, email FROM users").fetchall()
+    source_pool.close()
+
+    with router.directory.connection() as conn:
+        institutions = dict.fromkeys(projects.values())
+        institutions.update((key, institution) for key, institution in homes.values())
+        for key, institution in sorted(institutions.items()):
+            router.add_shard(conn, key, institution)
+        conn.executemany("INSERT INTO user_directory (id, email, shard) VALUES (?, ?, ?)",
+                         [(user_id, email, homes[user_id][0]) for user_id, email in emails])
+        conn.executemany("INSERT INTO project_directory (id, shard) VALUES (?, ?)", projects.items())
+        conn.commit()
+
+    counts = {}
+    for key in router.keys():
+        started = time.perf_counter()
+        with router.connection(key) as conn:
+            conn.execute("ATTACH DATABASE ? AS src", (source,))
+            try:
+                conn.execute("CREATE TEMP TABLE home_users (id INTEGER PRIMARY KEY)")
+                conn.execute("CREATE TEMP TABLE shard_projects (id INTEGER PRIMARY KEY)")
+                conn.execute("CREATE TEMP TABLE shard_users (id INTEGER PRIMARY KEY)")
+                conn.executemany("INSERT INTO home_users VALUES (?)",
+                                 [(user_id,) for user_id, home in homes.items() if home[0] == key])
+                conn.executemany("INSERT INTO shard_projects VALUES (?)",
+                                 [(project_id,) for project_id, home in projects.items() if home == key])
+                conn.execute("INSERT INTO shard_users SELECT id FROM home_users")
+                splits = dict(SPLIT)
+                for table, column in USER_REFERENCES:
+                    conn.execute(f"""INSERT OR IGNORE INTO shard_users
+                                     SELECT {column} FROM src.{table}
+                                     WHERE {splits[table]} AND {column} IN (SELECT id FROM src.users)""")
+                conn.commit()
+                with stats.bulk_load(conn):
+                    conn.execute("BEGIN IMMEDIATE")
+                    for table, where in SPLIT:
+                        info = conn.execute(f"PRAGMA main.table_info({table})").fetchall()
+                        columns = [row[1] for row in info]
+                        # Keep rowids too, which some lists are ordered by
+                        # (members in the order they joined)
+                        if [row[2].upper() for row in info if row[5]] != ["INTEGER"]:
+                            columns.insert(0, "rowid")
+                        columns = ', '.join(columns)
+                        conn.execute(f"INSERT OR REPLACE INTO main.{table} ({columns}) SELECT {columns} FROM src.{table}"
+                                     + (f" WHERE {where}" if where else "") + " ORDER BY rowid")
+                    # The reference-count triggers counted each file on top of
+                    # the copied counts
+                    conn.execute("UPDATE blobs SET ref_count = (SELECT COUNT(*) FROM project_files f "
+                                 "WHERE f.sha256 = blobs.sha256)")
+                    conn.commit()
+                counts[key] = {
+                    'users': conn.execute("SELECT COUNT(*) FROM home_users").fetchone()[0],
+                    'guests': conn.execute("SELECT COUNT(*) FROM shard_users").fetchone()[0]
+                              - conn.execute("SELECT COUNT(*) FROM home_users").fetchone()[0],
+                    'projects': conn.execute("SELECT COUNT(*) FROM shard_projects").fetchone()[0],
+                }
+                conn.execute("DROP TABLE temp.home_users")
+                conn.execute("DROP TABLE temp.shard_projects")
+                conn.execute("DROP TABLE temp.shard_users")
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                conn.execute("DETACH DATABASE src")
+        out.write(f"{key}: {counts[key]['users']:,} users, {counts[key]['guests']:,} guests, "
+                  f"{counts[key]['projects']:,} projects in {time.perf_counter() - started:.1f}s\n")
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-institution database shards.")
+    parser.add_argument("--dir", default=db.SHARD_DIR, help="shard directory (default: $EDUCOLLAB_SHARD_DIR)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    p = commands.add_parser("split", help="copy a single database into shards")
+    p.add_argument("source", nargs="?", default=db.DB_PATH)
+    commands.add_parser("status", help="list shards with their sizes")
+    args = parser.parse_args(argv)
+    if not args.dir:
+        sys.exit("set EDUCOLLAB_SHARD_DIR or pass --dir")
+    enable(args.dir)
+
+    if args.command == "split":
+        if not os.path.exists(args.source):
+            sys.exit(f"{args.source} does not exist")
+        started = time.perf_counter()
+        counts = split(args.source)
+        print(f"Split {args.source} into {len(counts)} shards in {time.perf_counter() - started:.1f}s")
+    else:
+        router = get_router()
+        with router.directory.connection() as conn:
+            users = dict(conn.execute("SELECT shard, COUNT(*) FROM user_directory GROUP BY shard").fetchall())
+            projects = dict(conn.execute("SELECT shard, COUNT(*) FROM project_directory GROUP BY shard").fetchall())
+        for key in router.keys():
+            size = os.path.getsize(db.shard_path(key)) if os.path.exists(db.shard_path(key)) else 0
+            print(f"{key:<32} {users.get(key, 0):>9,} users {projects.get(key, 0):>9,} projects "
+                  f"{size / 1e6:>9.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
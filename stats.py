@@ -0,0 +1,194 @@
+import sys
+from contextlib import contextmanager
+
+import db
+
+USER_PAGE_SIZE = 24
+
+# Counters are kept current by triggers, so every path that touches
+# memberships or chat (the UI, bulk imports, migrations) is covered without
+# having to remember to call anything. Code is the one exception: line counts
+# use str.splitlines(), which SQL can't express, so saving code goes through
+# code_saved() below and the triggers push the delta on to the members.
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS project_stats
+       (project_id INTEGER PRIMARY KEY REFERENCES projects(id) ON DELETE CASCADE,
+        member_count INTEGER NOT NULL DEFAULT 0,
+        lines_of_code INTEGER NOT NULL DEFAULT 0,
+        last_activity TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS user_stats
+       (user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+        projects_involved INTEGER NOT NULL DEFAULT 0,
+        lines_of_code INTEGER NOT NULL DEFAULT 0,
+        last_activity TEXT)''',
+    '''CREATE TRIGGER IF NOT EXISTS stats_member_ai AFTER INSERT ON project_members BEGIN
+           INSERT INTO project_stats (project_id, member_count, last_activity)
+           VALUES (new.project_id, 1, datetime('now', 'localtime'))
+           ON CONFLICT(project_id) DO UPDATE SET member_count = member_count + 1,
+                                                 last_activity = excluded.last_activity;
+           INSERT INTO user_stats (user_id, projects_involved, lines_of_code, last_activity)
+           VALUES (new.user_id, 1,
+                   COALESCE((SELECT lines_of_code FROM project_stats WHERE project_id = new.project_id), 0),
+                   datetime('now', 'localtime'))
+           ON CONFLICT(user_id) DO UPDATE SET projects_involved = projects_involved + 1,
+                                              lines_of_code = lines_of_code + excluded.lines_of_code,
+                                              last_activity = excluded.last_activity;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS stats_member_ad AFTER DELETE ON project_members BEGIN
+           UPDATE project_stats SET member_count = MAX(member_count - 1, 0)
+           WHERE project_id = old.project_id;
+           UPDATE user_stats SET projects_involved = MAX(projects_involved - 1, 0),
+                                 lines_of_code = MAX(lines_of_code - COALESCE(
+                                     (SELECT lines_of_code FROM project_stats WHERE project_id = old.project_id), 0), 0)
+           WHERE user_id = old.user_id;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS stats_code_au AFTER UPDATE OF lines_of_code ON project_stats BEGIN
+           UPDATE user_stats SET lines_of_code = lines_of_code + new.lines_of_code - old.lines_of_code
+           WHERE user_id IN (SELECT user_id FROM project_members WHERE project_id = new.project_id);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS stats_chat_ai AFTER INSERT ON project_chat BEGIN
+           UPDATE project_stats SET last_activity = new.sent_date WHERE project_id = new.project_id;
+           UPDATE user_stats SET last_activity = new.sent_date WHERE user_id = new.sender_id;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS stats_message_ai AFTER INSERT ON messages BEGIN
+           UPDATE project_stats SET last_activity = new.sent_date WHERE project_id = new.project_id;
+           UPDATE user_stats SET last_activity = new.sent_date WHERE user_id = new.sender_id;
+       END''',
+]
+
+
+def count_lines(code):
+    return len(code.splitlines()) if code else 0
+
+
+def create_schema(c):
+    for statement in SCHEMA:
+        c.execute(statement)
+
+
+# Record a code save. The stats_code_au trigger moves every member's total by
+# the difference, so this costs the same however many members there are.
+def code_saved(conn, project_id, user_id, code, saved_at):
+    lines = count_lines(code)
+    conn.execute("""
+        INSERT INTO project_stats (project_id, member_count, lines_of_code, last_activity)
+        VALUES (?, 0, ?, ?)
+        ON CONFLICT(project_id) DO UPDATE SET lines_of_code = excluded.lines_of_code,
+                                              last_activity = excluded.last_activity
+    """, (project_id, lines, saved_at))
+    conn.execute("UPDATE user_stats SET last_activity=? WHERE user_id=?", (saved_at, user_id))
+
+
+# Recompute both tables from scratch. Used when the stats tables are first
+# created, and as a repair tool: python stats.py rebuild. Last activity is
+# aggregated once per table rather than looked up per user: there is no
+# index on sender_id, so a per-user lookup scans all messages every time.
+def rebuild(c):
+    c.execute("DELETE FROM user_stats")
+    c.execute("DELETE FROM project_stats")
+    lines = {project_id: count_lines(code)
+             for project_id, code in c.execute("SELECT project_id, code FROM project_code").fetchall()}
+    c.execute("""
+        INSERT INTO project_stats (project_id, member_count, lines_of_code, last_activity)
+        SELECT p.id,
+               (SELECT COUNT(*) FROM project_members pm WHERE pm.project_id = p.id),
+               0,
+               MAX(COALESCE(p.created_date, ''), COALESCE(a.last, ''))
+        FROM projects p
+        LEFT JOIN (
+            SELECT project_id, MAX(last) AS last FROM (
+                SELECT project_id, MAX(sent_date) AS last FROM project_chat GROUP BY project_id
+                UNION ALL SELECT project_id, MAX(sent_date) FROM messages GROUP BY project_id
+                UNION ALL SELECT project_id, MAX(upload_date) FROM project_files GROUP BY project_id
+                UNION ALL SELECT project_id, MAX(last_date) FROM archive_blocks GROUP BY project_id
+            ) GROUP BY project_id
+        ) a ON a.project_id = p.id
+    """)
+    # Plain UPDATE fires stats_code_au, but user_stats is still empty here
+    c.executemany("UPDATE project_stats SET lines_of_code=? WHERE project_id=?",
+                  [(n, project_id) for project_id, n in lines.items()])
+    c.execute("""
+        INSERT INTO user_stats (user_id, projects_involved, lines_of_code, last_activity)
+        SELECT u.id,
+               COUNT(pm.project_id),
+               COALESCE(SUM(ps.lines_of_code), 0),
+               MAX(COALESCE(u.join_date, ''), COALESCE(a.last, ''))
+        FROM users u
+        LEFT JOIN project_members pm ON pm.user_id = u.id
+        LEFT JOIN project_stats ps ON ps.project_id = pm.project_id
+        LEFT JOIN (
+            SELECT sender_id, MAX(last) AS last FROM (
+                SELECT sender_id, MAX(sent_date) AS last FROM project_chat GROUP BY sender_id
+                UNION ALL SELECT sender_id, MAX(sent_date) FROM messages GROUP BY sender_id
+                UNION ALL SELECT sender_id, MAX(last_date) FROM archive_senders GROUP BY sender_id
+            ) GROUP BY sender_id
+        ) a ON a.sender_id = u.id
+        GROUP BY u.id
+    """)
+    c.execute("UPDATE project_stats SET last_activity=NULL WHERE last_activity=''")
+    c.execute("UPDATE user_stats SET last_activity=NULL WHERE last_activity=''")
+
+
+# For bulk loads (datagen.py, roster.py): per-row stats triggers dominate the
+# cost, so they are dropped for the duration and both tables rebuilt once at
+# the end. Counters read by a running app are stale until then.
+@contextmanager
+def bulk_load(conn):
+    triggers = [name for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='trigger' AND name LIKE 'stats_%'")]
+    for name in triggers:
+        conn.execute(f"DROP TRIGGER {name}")
+    conn.commit()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute("BEGIN IMMEDIATE")
+        create_schema(conn)
+        rebuild(conn)
+        conn.commit()
+
+
+DIRECTORY_SQL = """
+    SELECT u.id, u.name, u.institution, u.role, u.profile_pic,
+           COALESCE(s.projects_involved, 0), COALESCE(s.lines_of_code, 0), s.last_activity
+    FROM users u
+    LEFT JOIN user_stats s ON s.user_id = u.id
+"""
+
+
+# One page of the user directory with precomputed stats, keyset on id. Rows
+# are (id, name, institution, role, profile_pic, projects_involved,
+# lines_of_code, last_activity).
+def user_directory(conn, after_id=None, page_size=USER_PAGE_SIZE):
+    sql = DIRECTORY_SQL
+    params = []
+    if after_id is not None:
+        sql += " WHERE u.id > ?"
+        params.append(after_id)
+    sql += " ORDER BY u.id LIMIT ?"
+    params.append(page_size + 1)
+    rows = conn.execute(sql, params).fetchall()
+    next_cursor = rows[page_size - 1][0] if len(rows) > page_size else None
+    return rows[:page_size], next_cursor
+
+
+# user_directory() rows for the given users, in no particular order
+def user_rows(conn, user_ids):
+    marks = ','.join(['?'] * len(user_ids))
+    return conn.execute(DIRECTORY_SQL + f" WHERE u.id IN ({marks})", list(user_ids)).fetchall()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python stats.py rebuild")
+    import migrations
+    migrations.migrate()
+    with db.connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        rebuild(conn)
+        conn.commit()
+        users = conn.execute("SELECT COUNT(*) FROM user_stats").fetchone()[0]
+        projects = conn.execute("SELECT COUNT(*) FROM project_stats").fetchone()[0]
+    print(f"Rebuilt stats for {users} users and {projects} projects")
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Keep metrics.prom and slow_queries.log out of the working directory
+os.environ["EDUCOLLAB_METRICS_FILE"] = ""
+os.environ["EDUCOLLAB_SLOW_QUERY_LOG"] = ""
+
+import archive  # noqa: E402
+import cache  # noqa: E402
+import db  # noqa: E402
+import migrations  # noqa: E402
+
+
+# A fresh, migrated database as the app's own, with empty process caches
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    pool = db.ConnectionPool(str(tmp_path / "test.db"), size=2)
+    monkeypatch.setattr(db, "_pool", pool)
+    monkeypatch.setattr(db, "SHARD_DIR", None)
+    db.set_shard(None)
+    monkeypatch.setattr(cache, "_cache", None)
+    monkeypatch.setattr(archive, "_blocks", archive.BlockCache())
+    migrations.migrate(pool)
+    with pool.connection() as conn:
+        yield conn
+    pool.close()
+
+
+def add_user(conn, name, email=None, institution="Test University"):
+    email = email or f"{name.lower()}@test.edu"
+    user_id = conn.execute("INSERT INTO users (name, email, institution, role, join_date) VALUES (?, ?, ?, 'Student', '2024-01-01')",
+                           (name, email, institution)).lastrowid
+    conn.commit()
+    return user_id
+
+
+def add_project(conn, title, created_by, members=()):
+    project_id = conn.execute("INSERT INTO projects (title, description, created_by, created_date) VALUES (?, '', ?, '2024-01-01')",
+                              (title, created_by)).lastrowid
+    conn.executemany("INSERT INTO project_members (project_id, user_id) VALUES (?, ?)",
+                     [(project_id, user_id) for user_id in (created_by, *members)])
+    conn.commit()
+    return project_id
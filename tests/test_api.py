@@ -0,0 +1,120 @@
+import base64
+import json
+import socket
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import actions
+import api
+import writer
+from conftest import add_project, add_user
+
+
+def _cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+
+@pytest.mark.parametrize("error, status", [
+    (actions.NotFound("Project not found"), 404),
+    (actions.Forbidden("Only members"), 403),
+    (actions.ActionError("Cannot send an empty message."), 400),
+    (api.HTTPError(411, "Send a Content-Length"), 411),
+    (writer.QueueFull("busy"), 503),
+    (KeyError("title"), 500),
+    (IndexError("list index out of range"), 500),
+])
+def test_error_status(error, status):
+    assert api._error(error)[0] == status
+
+
+def test_unexpected_errors_do_not_leak_details():
+    assert api._error(KeyError("secret"))[1] == "Internal error"
+
+
+@pytest.mark.parametrize("cursor, shape, valid", [
+    (12, (int,), True),
+    ([1.5, 12], ((int, float), int), True),
+    (["2024-01-01 10:00:00", 12], (str, int), True),
+    ([1, 2], (int,), False),
+    (12, (str, int), False),
+    (True, (int,), False),
+    (["2024-01-01", "12"], (str, int), False),
+    (["2024-01-01", 12, 3], (str, int), False),
+    ({"id": 12}, (int,), False),
+])
+def test_cursor_shape(cursor, shape, valid):
+    request = api.Request("GET", "/", {'cursor': _cursor(cursor)}, {}, b"")
+    if valid:
+        assert request.cursor(*shape) == cursor
+    else:
+        with pytest.raises(api.HTTPError) as e:
+            request.cursor(*shape)
+        assert e.value.status == 400
+
+
+def test_garbled_cursor():
+    with pytest.raises(api.HTTPError):
+        api.Request("GET", "/", {'cursor': "!!not base64"}, {}, b"").cursor(int)
+
+
+@pytest.fixture
+def server(conn):
+    sock = socket.create_server(("localhost", 0))
+    server = api.APIServer(workers=2)
+    threading.Thread(target=server.run_forever, args=(sock,), daemon=True).start()
+    port = sock.getsockname()[1]
+
+    def call(method, path, body=None, token=None):
+        request = urllib.request.Request(f"http://localhost:{port}{path}", method=method,
+                                         data=json.dumps(body).encode() if body is not None else None)
+        if token:
+            request.add_header("Authorization", f"Bearer {token}")
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+    return call
+
+
+def test_api_errors_over_http(conn, server):
+    ada = add_user(conn, "Ada")
+    bob = add_user(conn, "Bob")
+    project_id = add_project(conn, "Engines", ada)
+    ada_token = api.make_token(ada)
+
+    assert server("GET", "/api/me")[0] == 401
+    assert server("POST", "/api/login", {'email': "nobody@test.edu"})[0] == 404
+    assert server("GET", "/api/projects/9999", token=ada_token) == (404, {'error': "Project not found"})
+    assert server("GET", f"/api/projects/{project_id}/messages", token=api.make_token(bob))[0] == 403
+    assert server("POST", f"/api/projects/{project_id}/chat", {'message': " "}, ada_token)[0] == 400
+    assert server("GET", f"/api/projects?cursor={_cursor([1, 2])}", token=ada_token)[0] == 400
+    assert server("GET", f"/api/projects?q=engines&cursor={_cursor(3)}", token=ada_token)[0] == 400
+    assert server("GET", f"/api/projects/{project_id}/messages?cursor={_cursor(3)}", token=ada_token)[0] == 400
+
+    status, page = server("GET", "/api/projects?limit=1", token=ada_token)
+    assert status == 200 and [p['id'] for p in page['projects']] == [project_id]
+    status, sent = server("POST", f"/api/projects/{project_id}/messages", {'message': "hello"}, ada_token)
+    assert status == 201 and sent['message'] == "hello"
+
+
+def test_update_profile(conn, server):
+    ada = add_user(conn, "Ada")
+    token = api.make_token(ada)
+
+    with pytest.raises(actions.ActionError):
+        actions.update_profile(conn, ada, "Ada", "Test University", "Admin")
+    with pytest.raises(actions.ActionError):
+        actions.update_profile(conn, ada, " ", "Test University", "Student")
+    actions.update_profile(conn, ada, "Ada L.", "Analytical U", "Teacher", ["python", "math", "python"])
+    assert conn.execute("SELECT name, institution, role FROM users WHERE id=?", (ada,)).fetchone() == \
+        ("Ada L.", "Analytical U", "Teacher")
+
+    status, me = server("POST", "/api/me", {'skills': ["math"]}, token)
+    assert status == 200
+    assert (me['name'], me['role'], me['skills']) == ("Ada L.", "Teacher", ["math"])
+    assert server("POST", "/api/me", {'role': "Admin"}, token)[0] == 400
+    assert server("POST", "/api/me", {'skills': "math"}, token)[0] == 400
@@ -0,0 +1,64 @@
+import archive
+import data
+from conftest import add_project, add_user
+
+
+def _send(conn, project_id, sender_id, text, sent_date):
+    conn.execute("INSERT INTO messages (project_id, sender_id, message, sent_date) VALUES (?, ?, ?, ?)",
+                 (project_id, sender_id, text, sent_date))
+    conn.commit()
+
+
+def _texts(conn, project_id, limit=50):
+    rows, before = [], None
+    while True:
+        page = data.message_page(conn, project_id, before, limit)
+        rows += page
+        if len(page) < limit:
+            return [row[1] for row in rows]
+        before = (page[-1][3], page[-1][0])
+
+
+def test_archived_messages_page_like_live_ones(conn):
+    ada = add_user(conn, "Ada")
+    project_id = add_project(conn, "Engines", ada)
+    for day in range(1, 29):
+        _send(conn, project_id, ada, f"old {day}", f"2020-01-{day:02d} 10:00:00")
+    _send(conn, project_id, ada, "new", "2099-01-01 10:00:00")
+    before = _texts(conn, project_id, limit=5)
+
+    counts = archive.archive(conn, older_than_days=30)
+
+    assert counts['rows'] == 28 and counts['blocks'] == 1
+    assert conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 1
+    assert _texts(conn, project_id, limit=5) == before
+    assert data.message_page(conn, project_id, limit=2)[1][2] == "Ada"
+
+
+def test_rows_merged_into_an_archived_month_show_up(conn):
+    ada = add_user(conn, "Ada")
+    project_id = add_project(conn, "Engines", ada)
+    _send(conn, project_id, ada, "first", "2020-01-05 10:00:00")
+    archive.archive(conn, older_than_days=30)
+    assert _texts(conn, project_id) == ["first"]
+
+    # Dated back into the archived month, e.g. restored from an export
+    _send(conn, project_id, ada, "late", "2020-01-20 10:00:00")
+    archive.archive(conn, older_than_days=30)
+
+    assert conn.execute("SELECT row_count FROM archive_blocks").fetchall() == [(2,)]
+    assert _texts(conn, project_id) == ["late", "first"]
+    assert _texts(conn, project_id, limit=1) == ["late", "first"]
+
+
+def test_merge_never_reuses_a_block_id(conn):
+    ada = add_user(conn, "Ada")
+    project_id = add_project(conn, "Engines", ada)
+    _send(conn, project_id, ada, "first", "2020-01-05 10:00:00")
+    archive.archive(conn, older_than_days=30)
+    old_id = conn.execute("SELECT id FROM archive_blocks").fetchone()[0]
+    _send(conn, project_id, ada, "late", "2020-01-20 10:00:00")
+    archive.archive(conn, older_than_days=30)
+
+    assert conn.execute("SELECT id FROM archive_blocks").fetchone()[0] > old_id
+    assert conn.execute("SELECT COUNT(*) FROM archive_senders WHERE block_id=?", (old_id,)).fetchone()[0] == 0
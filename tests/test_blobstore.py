@@ -0,0 +1,93 @@
+import io
+import os
+
+import pytest
+
+import blobstore
+from conftest import add_project, add_user
+
+OLD = "2000-01-01 00:00:00"
+
+
+@pytest.fixture(autouse=True)
+def blob_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(blobstore, "BLOB_DIR", str(tmp_path / "blobs"))
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("", None),
+    ("bytes=0-99", (0, 99)),
+    ("bytes=10-", (10, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=990-5000", (990, 999)),
+    ("bytes=0-0", (0, 0)),
+    ("bytes=0-1,5-6", None),
+    ("items=0-10", None),
+    ("bytes=-", None),
+])
+def test_parse_range(header, expected):
+    assert blobstore.parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=500-100", "bytes=abc-", "bytes=-0"])
+def test_unsatisfiable_ranges(header):
+    with pytest.raises(ValueError):
+        blobstore.parse_range(header, 1000)
+
+
+def test_read_range(conn):
+    sha256, size = blobstore.store(conn, io.BytesIO(b"0123456789"))
+    assert size == 10
+    assert blobstore.read_range(sha256, 2, 4) == b"234"
+    assert blobstore.read_range(sha256, *blobstore.parse_range("bytes=-3", size)) == b"789"
+
+
+def test_gc_removes_only_unreferenced_blobs(conn):
+    ada = add_user(conn, "Ada")
+    project_id = add_project(conn, "Engines", ada)
+    kept, _ = blobstore.store(conn, io.BytesIO(b"kept"))
+    dropped, _ = blobstore.store(conn, io.BytesIO(b"dropped"))
+    conn.execute("INSERT INTO project_files (project_id, filename, sha256) VALUES (?, 'kept.txt', ?)", (project_id, kept))
+    conn.execute("UPDATE blobs SET created_date=?", (OLD,))
+    conn.commit()
+
+    assert blobstore.gc(conn) == (1, len(b"dropped"))
+    assert os.path.exists(blobstore.blob_path(kept))
+    assert not os.path.exists(blobstore.blob_path(dropped))
+
+
+def test_reuploading_an_unreferenced_blob_keeps_it(conn):
+    ada = add_user(conn, "Ada")
+    project_id = add_project(conn, "Engines", ada)
+    sha256, _ = blobstore.store(conn, io.BytesIO(b"report"))
+    conn.execute("UPDATE blobs SET created_date=?", (OLD,))
+    conn.commit()
+
+    assert blobstore.add_project_file(conn, project_id, ada, "report.txt", io.BytesIO(b"report"))
+
+    assert blobstore.gc(conn) == (0, 0)
+    assert os.path.exists(blobstore.blob_path(sha256))
+
+
+def test_upload_survives_gc_running_in_the_middle(conn, monkeypatch):
+    ada = add_user(conn, "Ada")
+    project_id = add_project(conn, "Engines", ada)
+    sha256, _ = blobstore.store(conn, io.BytesIO(b"report"))
+    conn.execute("UPDATE blobs SET created_date=?", (OLD,))
+    conn.commit()
+    write_blob = blobstore._write_blob
+
+    # gc() runs after the upload found the blob on disk, before its rows land
+    def write_then_gc(fileobj, *args):
+        found = write_blob(fileobj, *args)
+        monkeypatch.setattr(blobstore, "_write_blob", write_blob)
+        assert blobstore.gc(conn) == (1, len(b"report"))
+        return found
+    monkeypatch.setattr(blobstore, "_write_blob", write_then_gc)
+
+    assert blobstore.add_project_file(conn, project_id, ada, "report.txt", io.BytesIO(b"report"))
+
+    assert os.path.exists(blobstore.blob_path(sha256))
+    assert conn.execute("SELECT ref_count FROM blobs WHERE sha256=?", (sha256,)).fetchone() == (1,)
@@ -0,0 +1,76 @@
+import cache
+from conftest import add_project, add_user
+
+
+def test_bump_invalidates(conn):
+    lookups = cache.LookupCache()
+    ada = add_user(conn, "Ada")
+    assert lookups.user(conn, ada)[1] == "Ada"
+    assert lookups.user(conn, ada)[1] == "Ada"
+    assert (lookups.stats()['hits'], lookups.stats()['misses']) == (1, 1)
+
+    # Until the table's version moves, the cached row is served as is
+    conn.execute("UPDATE users SET name='Ada L' WHERE id=?", (ada,))
+    conn.commit()
+    assert lookups.user(conn, ada)[1] == "Ada"
+
+    lookups.bump('users')
+    assert lookups.user(conn, ada)[1] == "Ada L"
+    stats = lookups.stats()
+    assert (stats['hits'], stats['misses'], stats['stale']) == (2, 2, 1)
+    assert stats['versions'] == {'users': 1}
+
+
+def test_bump_only_touches_its_table(conn):
+    lookups = cache.LookupCache()
+    ada, bob = add_user(conn, "Ada"), add_user(conn, "Bob")
+    engines = add_project(conn, "Engines", ada)
+    assert lookups.members(conn, engines) == (ada,)
+    assert lookups.project(conn, engines)[1] == "Engines"
+
+    conn.execute("INSERT INTO project_members (project_id, user_id) VALUES (?, ?)", (engines, bob))
+    conn.commit()
+    lookups.bump('project_members')
+    assert lookups.members(conn, engines) == (ada, bob)
+    assert lookups.member_of(conn, bob) == {engines}
+    assert lookups.project(conn, engines)[1] == "Engines"
+    assert lookups.stats()['stale'] == 1
+
+
+def test_entries_expire(conn, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    lookups = cache.LookupCache(ttl=60)
+    ada = add_user(conn, "Ada")
+    lookups.user(conn, ada)
+    conn.execute("UPDATE users SET name='Ada L' WHERE id=?", (ada,))
+    conn.commit()
+
+    now[0] += 59
+    assert lookups.user(conn, ada)[1] == "Ada"
+    now[0] += 2
+    assert lookups.user(conn, ada)[1] == "Ada L"
+    stats = lookups.stats()
+    assert (stats['hits'], stats['misses'], stats['stale']) == (1, 2, 1)
+
+
+def test_evicts_least_recently_used(conn):
+    lookups = cache.LookupCache(max_entries=2)
+    ada, bob, cy = add_user(conn, "Ada"), add_user(conn, "Bob"), add_user(conn, "Cy")
+    lookups.users(conn, [ada, bob])
+    lookups.user(conn, ada)
+    lookups.user(conn, cy)
+    stats = lookups.stats()
+    assert (stats['entries'], stats['evictions']) == (2, 1)
+    lookups.user(conn, ada)
+    assert lookups.stats()['hits'] == 2
+    lookups.user(conn, bob)
+    assert lookups.stats()['misses'] == 4
+
+
+def test_missing_rows_are_left_out(conn):
+    lookups = cache.LookupCache()
+    ada = add_user(conn, "Ada")
+    assert set(lookups.users(conn, [ada, ada + 100])) == {ada}
+    assert lookups.project(conn, 1) is None
+    assert lookups.member_of(conn, ada) == frozenset()
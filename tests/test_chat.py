@@ -0,0 +1,69 @@
+import chat
+import pubsub
+from conftest import add_project, add_user
+
+
+def insert_chat(conn, project_id, sender_id, message):
+    msg_id = conn.execute("INSERT INTO project_chat (project_id, sender_id, message, sent_date) VALUES (?, ?, ?, '2024-03-01 10:00:00')",
+                          (project_id, sender_id, message)).lastrowid
+    conn.commit()
+    return (msg_id, message, "Ada", "2024-03-01 10:00:00")
+
+
+class Queries:
+    def __init__(self, conn):
+        self.conn = conn
+        self.count = 0
+
+    def __enter__(self):
+        self.conn.set_trace_callback(self)
+        return self
+
+    def __exit__(self, *exc):
+        self.conn.set_trace_callback(None)
+
+    def __call__(self, statement):
+        self.count += 1
+
+
+def test_messages_published_out_of_order_are_all_delivered(conn):
+    ada = add_user(conn, "Ada")
+    project_id = add_project(conn, "Engines", ada)
+    service = chat.ChatService(pubsub.Hub())
+    feed = chat.ChatFeed(service, conn, project_id)
+    first = insert_chat(conn, project_id, ada, "first")
+    second = insert_chat(conn, project_id, ada, "second")
+
+    # Committed together, the second sender published first
+    service.hub.publish(('chat', project_id), second)
+    assert [msg[1] for msg in feed.poll(conn)] == ["first", "second"]
+    service.hub.publish(('chat', project_id), first)
+    assert [msg[1] for msg in feed.poll(conn)] == ["first", "second"]
+    assert feed.cursor == second[0]
+
+
+def test_messages_in_order_need_no_queries(conn):
+    ada = add_user(conn, "Ada")
+    project_id = add_project(conn, "Engines", ada)
+    service = chat.ChatService(pubsub.Hub())
+    feed = chat.ChatFeed(service, conn, project_id)
+    sent = [insert_chat(conn, project_id, ada, text) for text in ("one", "two", "three")]
+
+    # The same batch drained in reverse: sorted, it still follows the cursor
+    for msg in reversed(sent):
+        service.hub.publish(('chat', project_id), msg)
+    with Queries(conn) as queries:
+        assert [msg[1] for msg in feed.poll(conn)] == ["one", "two", "three"]
+        assert [msg[1] for msg in feed.poll(conn)] == ["one", "two", "three"]
+    assert queries.count == 0
+
+
+def test_send_reaches_open_feeds(conn):
+    ada = add_user(conn, "Ada")
+    project_id = add_project(conn, "Engines", ada)
+    service = chat.ChatService(pubsub.Hub())
+    feed = chat.ChatFeed(service, conn, project_id)
+
+    service.send(conn, project_id, ada, "hello")
+
+    assert [msg[1:3] for msg in feed.poll(conn)] == [("hello", "Ada")]
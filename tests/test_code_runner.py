@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+import code_runner
+
+
+@pytest.fixture
+def runner():
+    return code_runner.CodeRunner(workers=1, timeout=2)
+
+
+def test_runs_code_and_caches_clean_runs(runner):
+    first = runner.run(1, "print(6 * 7)")
+    again = runner.run(2, "print(6 * 7)")
+
+    assert first.output.strip() == "42" and first.returncode == 0 and not first.cached
+    assert again.cached and again.output == first.output
+
+
+def test_failed_and_timed_out_runs_are_not_cached(runner):
+    assert runner.run(1, "raise SystemExit(3)").returncode == 3
+    assert not runner.run(1, "raise SystemExit(3)").cached
+
+    slow = "import time; time.sleep(10)"
+    assert runner.run(1, slow).timed_out
+    assert not runner.run(1, slow).cached
+    assert runner.metrics()['cache_entries'] == 0
+
+
+def test_run_gives_up_after_timeout(runner):
+    runner.submit(1, "import time; time.sleep(10)")
+    started = time.perf_counter()
+    with pytest.raises(code_runner.QueueFull):
+        runner.run(2, "print('queued behind a slow run')", timeout=0.5)
+    assert time.perf_counter() - started < 2
+    assert runner.metrics()['abandoned'] == 1
+    # The abandoned run is dropped, and the same code can be queued again
+    assert runner.run(2, "print('queued behind a slow run')", timeout=10).returncode == 0
+
+
+def test_worker_start_failure_fails_the_job_and_keeps_dispatching(runner, monkeypatch):
+    runner.run(1, "pass")  # the dispatcher is parked on the queue with a warm worker
+    broken = {'left': 3}
+    real = code_runner._Worker
+
+    def flaky(*args):
+        if broken['left']:
+            broken['left'] -= 1
+            raise ValueError("no interpreter")
+        return real(*args)
+    monkeypatch.setattr(code_runner, "_Worker", flaky)
+
+    assert runner.run(1, "print(1)", timeout=10).output.strip() == "1"
+    with pytest.raises(RuntimeError):
+        runner.run(1, "print(2)", timeout=10)
+    assert runner.run(1, "print(3)", timeout=10).output.strip() == "3"
+    assert runner.metrics()['worker_failures'] == 3
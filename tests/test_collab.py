@@ -0,0 +1,93 @@
+import random
+
+import pytest
+
+import collab
+import pubsub
+from conftest import add_project, add_user
+
+WORDS = ["def ", "return ", "x", "y = 1\n", "\n", "print(x)\n", "# note\n", "pass\n"]
+
+
+def random_edit(rng, text):
+    chars = list(text)
+    for _ in range(rng.randint(1, 4)):
+        pos = rng.randint(0, len(chars))
+        if chars and rng.random() < 0.4:
+            del chars[pos:pos + rng.randint(1, 6)]
+        else:
+            chars[pos:pos] = rng.choice(WORDS)
+    return ''.join(chars)
+
+
+def test_concurrent_ops_converge():
+    rng = random.Random(0)
+    for _ in range(500):
+        doc = random_edit(rng, "def f(x):\n    return x\n" * rng.randint(0, 3))
+        a = collab.diff(doc, random_edit(rng, doc))
+        b = collab.diff(doc, random_edit(rng, doc))
+
+        a_prime, b_prime = collab.transform(a, b)
+
+        assert collab.apply(collab.apply(doc, a), b_prime) == collab.apply(collab.apply(doc, b), a_prime), (doc, a, b)
+
+
+def test_diff_round_trips():
+    old = "one\ntwo\nthree\n"
+    new = "zero\none\nthree\nfour\n"
+    assert collab.apply(old, collab.diff(old, new)) == new
+    assert collab.diff(old, old) == [len(old)]
+
+
+def test_same_spot_inserts_put_the_first_op_first():
+    a_prime, b_prime = collab.transform([2, "A", 1], [2, "B", 1])
+    assert collab.apply(collab.apply("xyz", [2, "A", 1]), b_prime) == "xyABz"
+    assert collab.apply(collab.apply("xyz", [2, "B", 1]), a_prime) == "xyABz"
+
+
+def test_overlapping_deletes_delete_once():
+    a_prime, b_prime = collab.transform([1, -3, 2], [2, -3, 1])
+    assert collab.apply(collab.apply("abcdef", [1, -3, 2]), b_prime) == "af"
+    assert collab.apply(collab.apply("abcdef", [2, -3, 1]), a_prime) == "af"
+
+
+def test_apply_rejects_an_op_for_another_document():
+    with pytest.raises(ValueError):
+        collab.apply("abc", [5])
+
+
+def test_editors_saving_concurrently_both_keep_their_edits(conn):
+    ada = add_user(conn, "Ada")
+    bob = add_user(conn, "Bob")
+    project_id = add_project(conn, "Engines", ada, members=[bob])
+    store = collab.DocumentStore(pubsub.Hub())
+    store.submit(conn, project_id, ada, 0, collab.diff("", "a = 1\nb = 2\nc = 3\n"))
+
+    first = collab.EditorSession(store, conn, project_id)
+    second = collab.EditorSession(store, conn, project_id)
+    first.buffer = "a = 10\nb = 2\nc = 3\n"
+    second.buffer = "a = 1\nb = 2\nc = 30\nd = 4\n"
+    assert first.push(conn, ada)
+    # second's unsaved edit is rebased over first's save, then merged in
+    assert second.push(conn, bob)
+    first.pull(conn)
+
+    expected = "a = 10\nb = 2\nc = 30\nd = 4\n"
+    assert first.text == second.text == first.buffer == expected
+    assert store.open(conn, project_id) == (3, expected)
+    assert not second.push(conn, bob)
+
+
+def test_a_save_from_an_old_revision_is_transformed(conn):
+    ada = add_user(conn, "Ada")
+    project_id = add_project(conn, "Engines", ada)
+    store = collab.DocumentStore(pubsub.Hub())
+    store.submit(conn, project_id, ada, 0, collab.diff("", "hello\n"))
+    store.submit(conn, project_id, ada, 1, collab.diff("hello\n", "hello world\n"))
+
+    rev, op = store.submit(conn, project_id, ada, 1, collab.diff("hello\n", "> hello\n"))
+
+    assert rev == 3
+    assert store.open(conn, project_id) == (3, "> hello world\n")
+    with pytest.raises(ValueError):
+        store.submit(conn, project_id, ada, 7, [len("> hello world\n")])
@@ -0,0 +1,80 @@
+import sqlite3
+import threading
+
+import pytest
+
+import db
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = db.ConnectionPool(str(tmp_path / "pool.db"), size=1, timeout=5)
+    yield pool
+    pool.close()
+
+
+def test_nested_checkout_shares_the_connection(pool):
+    with pool.connection() as outer:
+        with pool.connection() as inner:
+            assert inner is outer
+            inner.execute("CREATE TABLE t (x)")
+        # Leaving the inner block neither releases nor rolls back
+        assert pool.stats()['in_use'] == 1
+        outer.execute("INSERT INTO t VALUES (1)")
+        outer.commit()
+    stats = pool.stats()
+    assert (stats['misses'], stats['hits'], stats['in_use'], stats['idle']) == (1, 0, 0, 1)
+
+    with pool.connection() as again:
+        assert again is outer
+        assert again.execute("SELECT x FROM t").fetchall() == [(1,)]
+    assert pool.stats()['hits'] == 1
+
+
+def test_pragmas_applied(pool):
+    with pool.connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+        assert conn.execute("PRAGMA foreign_keys").fetchone() == (1,)
+
+
+def test_released_connections_are_rolled_back(pool):
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE t (x)")
+        conn.commit()
+    with pytest.raises(RuntimeError):
+        with pool.connection() as conn:
+            conn.execute("INSERT INTO t VALUES (1)")
+            raise RuntimeError
+    with pool.connection() as conn:
+        assert not conn.in_transaction
+        assert conn.execute("SELECT COUNT(*) FROM t").fetchone() == (0,)
+
+
+def test_exhausted_pool_waits(pool):
+    holding, release = threading.Event(), threading.Event()
+
+    def hold():
+        with pool.connection():
+            holding.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    holding.wait(5)
+    threading.Timer(0.05, release.set).start()
+    with pool.connection():
+        pass
+    thread.join()
+    stats = pool.stats()
+    assert (stats['misses'], stats['waits'], stats['open']) == (1, 1, 1)
+    assert stats['avg_wait'] > 0 and stats['max_wait'] >= stats['avg_wait']
+    assert stats['hit_rate'] == 0.5
+
+
+def test_exhausted_pool_times_out(tmp_path):
+    pool = db.ConnectionPool(str(tmp_path / "pool.db"), size=1, timeout=0.05)
+    conn = pool.acquire()
+    with pytest.raises(sqlite3.OperationalError):
+        pool.acquire()
+    pool.release(conn)
+    pool.close()
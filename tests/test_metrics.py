@@ -0,0 +1,49 @@
+import json
+
+import db
+import metrics
+
+
+def test_slow_query_plan_does_not_touch_the_callers_connection(tmp_path, monkeypatch):
+    registry = metrics.Registry(slow_ms=0, slow_log=None)
+    monkeypatch.setattr(metrics, "_registry", registry)
+    pool = db.ConnectionPool(str(tmp_path / "m.db"), size=1)
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, name TEXT)")
+        conn.execute("CREATE INDEX ix_t_name ON t(name)")
+        conn.executemany("INSERT INTO t (name) VALUES (?)", [("x",), ("x",)])
+        conn.commit()
+
+    with registry.rerun():
+        with pool.connection() as conn:
+            cursor = conn.execute("SELECT id FROM t WHERE name = ?", ("x",))
+            cursor.fetchone()
+        # The unfinished statement is logged when the rerun ends, after its
+        # connection went back to the pool, here even after it was closed
+        pool.close()
+
+    entry = registry.recent_slow[-1]
+    assert entry['sql'] == "SELECT id FROM t WHERE name = ?"
+    assert "ix_t_name" in entry['plan']
+
+
+def test_slow_log_is_written_outside_the_registry_lock(tmp_path, monkeypatch):
+    log = tmp_path / "slow.log"
+    registry = metrics.Registry(slow_ms=0, slow_log=str(log))
+    monkeypatch.setattr(metrics, "_registry", registry)
+    held = []
+
+    def watched_open(*args, **kwargs):
+        held.append(registry._lock.locked())
+        return open(*args, **kwargs)
+
+    monkeypatch.setattr(metrics, "open", watched_open, raising=False)
+    pool = db.ConnectionPool(str(tmp_path / "m.db"), size=1)
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY)").fetchall()
+    pool.close()
+
+    assert held and not any(held)
+    entries = [json.loads(line) for line in log.read_text().splitlines()]
+    assert entries[-1]['sql'] == "CREATE TABLE t (id INTEGER PRIMARY KEY)"
+    assert entries[-1] == registry.recent_slow[-1]
@@ -0,0 +1,102 @@
+import sqlite3
+
+import pytest
+
+import db
+import migrations
+
+# The schema init_db() created before migrations existed
+BASELINE = [
+    '''CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT, email TEXT, institution TEXT,
+                           role TEXT, join_date TEXT, profile_pic TEXT)''',
+    '''CREATE TABLE projects (id INTEGER PRIMARY KEY, title TEXT, description TEXT,
+                              created_by INTEGER, created_date TEXT)''',
+    '''CREATE TABLE project_members (project_id INTEGER, user_id INTEGER)''',
+    '''CREATE TABLE messages (id INTEGER PRIMARY KEY, project_id INTEGER, sender_id INTEGER,
+                              message TEXT, sent_date TEXT)''',
+    '''CREATE TABLE project_code (project_id INTEGER PRIMARY KEY, code TEXT)''',
+    '''CREATE TABLE project_chat (project_id INTEGER, sender_id INTEGER, message TEXT, sent_date TEXT)''',
+    '''CREATE TABLE project_files (id INTEGER PRIMARY KEY, project_id INTEGER, filename TEXT, uploader_id INTEGER,
+                                   upload_date TEXT)''',
+]
+
+ADA, BOB, ADA_AGAIN, GONE = 1, 2, 3, 99
+ENGINES, LOOMS, ADOPTED, LOST = 10, 11, 12, 77
+
+
+@pytest.fixture
+def baseline(tmp_path):
+    path = str(tmp_path / "baseline.db")
+    conn = sqlite3.connect(path)
+    for sql in BASELINE:
+        conn.execute(sql)
+    conn.executemany("INSERT INTO users VALUES (?, ?, ?, 'Test University', 'Student', '2024-01-01', NULL)", [
+        (ADA, "Ada", "ada@test.edu"), (BOB, "Bob", "bob@test.edu"), (ADA_AGAIN, "Ada L.", "ada@test.edu")])
+    conn.executemany("INSERT INTO projects VALUES (?, ?, '', ?, '2024-01-01')", [
+        (ENGINES, "Engines", ADA), (LOOMS, "Looms", GONE), (ADOPTED, "Adopted", ADA_AGAIN)])
+    conn.executemany("INSERT INTO project_members VALUES (?, ?)", [
+        (ENGINES, ADA), (ENGINES, ADA), (ENGINES, ADA_AGAIN), (ENGINES, BOB),
+        (LOOMS, BOB), (LOOMS, GONE), (LOST, ADA), (ADOPTED, ADA_AGAIN)])
+    conn.executemany("INSERT INTO messages (project_id, sender_id, message, sent_date) VALUES (?, ?, ?, '2024-02-01')", [
+        (ENGINES, ADA_AGAIN, "from the duplicate"), (ENGINES, GONE, "from nobody"), (LOST, ADA, "lost")])
+    conn.executemany("INSERT INTO project_chat VALUES (?, ?, ?, '2024-02-01 10:00:00')", [
+        (ENGINES, ADA, "first"), (ENGINES, ADA_AGAIN, "second"), (LOST, BOB, "lost")])
+    conn.executemany("INSERT INTO project_code VALUES (?, ?)", [(ENGINES, "print('hi')\n"), (LOST, "lost")])
+    conn.executemany("INSERT INTO project_files (project_id, filename, uploader_id, upload_date) VALUES (?, ?, ?, '2024-02-01')",
+                     [(ENGINES, "notes.txt", ADA_AGAIN), (LOST, "lost.txt", ADA)])
+    conn.commit()
+    conn.close()
+    pool = db.ConnectionPool(path, size=1)
+    yield pool
+    pool.close()
+
+
+def test_baseline_database_upgrades(baseline):
+    migrations.migrate(baseline)
+
+    with baseline.connection() as conn:
+        assert [v for v, _, _ in migrations.MIGRATIONS] == [row[0] for row in conn.execute(
+            "SELECT version FROM schema_version ORDER BY version")]
+        # Duplicate accounts fold onto the oldest, taking their rows along
+        assert conn.execute("SELECT id, name FROM users ORDER BY id").fetchall() == [(ADA, "Ada"), (BOB, "Bob")]
+        assert conn.execute("SELECT id, created_by FROM projects ORDER BY id").fetchall() == [
+            (ENGINES, ADA), (LOOMS, None), (ADOPTED, ADA)]
+        assert conn.execute("SELECT project_id, user_id FROM project_members ORDER BY 1, 2").fetchall() == [
+            (ENGINES, ADA), (ENGINES, BOB), (LOOMS, BOB), (ADOPTED, ADA)]
+        assert conn.execute("SELECT message, sender_id FROM messages ORDER BY id").fetchall() == [
+            ("from the duplicate", ADA), ("from nobody", None)]
+        assert conn.execute("SELECT id, message, sender_id FROM project_chat ORDER BY id").fetchall() == [
+            (1, "first", ADA), (2, "second", ADA)]
+        assert conn.execute("SELECT project_id, code FROM project_code").fetchall() == [(ENGINES, "print('hi')\n")]
+        assert conn.execute("SELECT filename, uploader_id, sha256 FROM project_files").fetchall() == [
+            ("notes.txt", ADA, None)]
+        assert conn.execute("PRAGMA foreign_key_check").fetchall() == []
+        assert conn.execute("PRAGMA integrity_check").fetchone() == ("ok",)
+        # The constraints the cleanup made room for are enforced now
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("INSERT INTO users (name, email) VALUES ('Ada', 'ada@test.edu')")
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("INSERT INTO project_members VALUES (?, ?)", (ENGINES, BOB))
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("INSERT INTO project_members VALUES (?, ?)", (LOST, BOB))
+        conn.rollback()
+        # Derived tables are filled from what was already there
+        assert conn.execute("SELECT rowid FROM projects_fts WHERE projects_fts MATCH 'looms'").fetchall() == [(LOOMS,)]
+        assert conn.execute("SELECT member_count FROM project_stats WHERE project_id=?", (ENGINES,)).fetchone() == (2,)
+
+
+def test_migrating_again_changes_nothing(baseline):
+    with baseline.connection() as conn:
+        migrations.apply_migrations(conn)
+        before = list(conn.iterdump())
+
+        assert migrations.apply_migrations(conn) == []
+        assert list(conn.iterdump()) == before
+
+
+def test_a_new_database_gets_every_step(tmp_path):
+    pool = db.ConnectionPool(str(tmp_path / "new.db"), size=1)
+    with pool.connection() as conn:
+        assert migrations.apply_migrations(conn) == [v for v, _, _ in migrations.MIGRATIONS]
+        assert migrations.current_version(conn) == migrations.MIGRATIONS[-1][0]
+    pool.close()
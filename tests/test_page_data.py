@@ -0,0 +1,77 @@
+import datetime
+
+import data
+import page_data
+import recommend
+from conftest import add_project, add_user
+
+
+def add_messages(conn, project_id, sender_id, count, day="2024-03-01"):
+    conn.executemany("INSERT INTO messages (project_id, sender_id, message, sent_date) VALUES (?, ?, ?, ?)",
+                     [(project_id, sender_id, f"message {n}", f"{day} 10:{n // 60:02d}:{n % 60:02d}")
+                      for n in range(count)])
+    conn.commit()
+
+
+def test_message_window_pages_and_picks_up_new_messages(conn):
+    ada = add_user(conn, "Ada")
+    project_id = add_project(conn, "Engines", ada)
+    add_messages(conn, project_id, ada, data.MESSAGE_PAGE + 10)
+    state = {}
+
+    window = page_data.message_window(state, conn, project_id)
+    assert state["message_window"] is window
+    assert len(window['rows']) == data.MESSAGE_PAGE and window['more']
+    assert window['rows'][0][1] == f"message {data.MESSAGE_PAGE + 9}"
+
+    page_data.older_messages(conn, window)
+    assert len(window['rows']) == data.MESSAGE_PAGE + 10 and not window['more']
+
+    add_messages(conn, project_id, ada, 1, day="2024-03-02")
+    window = page_data.message_window(state, conn, project_id)
+    assert len(window['rows']) == data.MESSAGE_PAGE + 11
+    assert window['rows'][0][1:] == ("message 0", "Ada", "2024-03-02 10:00:00")
+
+
+def test_message_window_jumps_to_a_date(conn):
+    ada = add_user(conn, "Ada")
+    project_id = add_project(conn, "Engines", ada)
+    add_messages(conn, project_id, ada, 3, day="2024-03-01")
+    add_messages(conn, project_id, ada, 3, day="2024-03-05")
+    state = {}
+
+    window = page_data.message_window(state, conn, project_id, datetime.date(2024, 3, 2))
+    assert [row[3][:10] for row in window['rows']] == ["2024-03-01"] * 3
+    # A later rerun at the same date doesn't pull in newer messages
+    assert page_data.message_window(state, conn, project_id, datetime.date(2024, 3, 2))['rows'] == window['rows']
+    assert len(page_data.message_window(state, conn, project_id)['rows']) == 6
+
+
+def test_browse_and_projects_pages(conn):
+    ada = add_user(conn, "Ada")
+    bob = add_user(conn, "Bob")
+    engines = add_project(conn, "Engines", ada, members=[bob])
+    looms = add_project(conn, "Looms", bob)
+
+    projects, next_cursor, recommended = page_data.browse(conn, ada, page_size=1)
+    assert [p[0] for p in projects] == [looms] and next_cursor == looms
+    assert recommended == []
+    projects, next_cursor, _ = page_data.browse(conn, ada, cursor=next_cursor, page_size=1)
+    assert [p[0] for p in projects] == [engines] and next_cursor is None
+
+    assert [p[0] for p in page_data.my_projects(conn, bob)] == [engines, looms]
+    assert [p[1] for p in page_data.message_projects(conn, ada)] == ["Engines"]
+    assert set(page_data.team(conn, engines)) == {ada, bob}
+    assert page_data.current_user(conn, bob)[1] == "Bob"
+
+
+def test_profile(conn):
+    ada = add_user(conn, "Ada")
+    recommend.set_user_skills(conn, ada, ["python", "math"])
+    conn.commit()
+
+    user, skill_names, user_skills = page_data.profile(conn, ada)
+
+    assert user[1] == "Ada"
+    assert set(user_skills) == {"python", "math"} and set(user_skills) <= set(skill_names)
+    assert page_data.skill_names(conn) == skill_names
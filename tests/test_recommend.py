@@ -0,0 +1,92 @@
+import recommend
+from conftest import add_project, add_user
+
+
+def _skills(conn, user_skills=(), project_skills=()):
+    for user_id, names in user_skills:
+        recommend.set_user_skills(conn, user_id, names)
+    for project_id, names in project_skills:
+        recommend.set_project_skills(conn, project_id, names)
+    conn.commit()
+
+
+def test_ranks_by_skill_match(conn):
+    ada, bob, cy = add_user(conn, "Ada"), add_user(conn, "Bob"), add_user(conn, "Cy")
+    engines = add_project(conn, "Engines", bob)
+    looms = add_project(conn, "Looms", bob)
+    add_project(conn, "Poems", bob)
+    _skills(conn, [(ada, ["Python", "SQL"]), (cy, ["Python"])],
+            [(engines, ["Python", "SQL"]), (looms, ["Python", "C"])])
+    index = recommend.SkillIndex()
+
+    assert [pid for pid, _ in index.for_user(conn, ada)] == [engines, looms]
+    assert index.for_user(conn, ada)[0][1] > 0.99
+    assert [uid for uid, _ in index.candidates(conn, engines)] == [ada, cy]
+    # No skills, no suggestions
+    assert index.for_user(conn, bob) == []
+    assert index.stats()['rebuilds'] == 1
+
+
+def test_masks_joined_and_full_projects(conn):
+    ada, bob, cy = add_user(conn, "Ada"), add_user(conn, "Bob"), add_user(conn, "Cy")
+    engines = add_project(conn, "Engines", bob)
+    looms = add_project(conn, "Looms", bob, members=[cy])
+    mills = add_project(conn, "Mills", ada)
+    conn.execute("UPDATE projects SET max_members=2 WHERE id=?", (looms,))
+    conn.commit()
+    _skills(conn, [(ada, ["Python"]), (cy, ["Python"])],
+            [(engines, ["Python"]), (looms, ["Python"]), (mills, ["Python"])])
+    index = recommend.SkillIndex()
+
+    # Ada is in Mills already and Looms is full
+    assert [pid for pid, _ in index.for_user(conn, ada)] == [engines]
+    assert index.candidates(conn, looms) == []
+    assert [uid for uid, _ in index.candidates(conn, engines)] == [ada, cy]
+
+    # A place opens up once Cy leaves
+    conn.execute("DELETE FROM project_members WHERE project_id=? AND user_id=?", (looms, cy))
+    conn.commit()
+    index.project_changed(conn, looms)
+    assert sorted(pid for pid, _ in index.for_user(conn, ada)) == [engines, looms]
+    assert [uid for uid, _ in index.candidates(conn, looms)] == [ada, cy]
+
+
+def test_user_changed_grows_the_matrix(conn):
+    ada = add_user(conn, "Ada")
+    engines = add_project(conn, "Engines", ada)
+    _skills(conn, project_skills=[(engines, ["Python"])])
+    index = recommend.SkillIndex()
+    assert index.candidates(conn, engines) == []
+    assert index.users.matrix.shape[0] == 1
+
+    # New users get rows without a rebuild; the matrix grows in chunks
+    newcomers = [add_user(conn, f"New{n}") for n in range(3)]
+    for user_id in newcomers:
+        _skills(conn, [(user_id, ["Python"])])
+        index.user_changed(conn, user_id)
+    assert index.users.count == 4
+    assert index.users.matrix.shape[0] == 1 + 1024
+    assert sorted(uid for uid, _ in index.candidates(conn, engines)) == newcomers
+
+    # Changed skills move a user out of the results
+    _skills(conn, [(newcomers[0], [])])
+    index.user_changed(conn, newcomers[0])
+    assert sorted(uid for uid, _ in index.candidates(conn, engines)) == newcomers[1:]
+    stats = index.stats()
+    assert (stats['rebuilds'], stats['updates'], stats['users']) == (1, 4, 4)
+
+
+def test_unknown_skill_forces_a_rebuild(conn):
+    ada, bob = add_user(conn, "Ada"), add_user(conn, "Bob")
+    engines = add_project(conn, "Engines", ada)
+    _skills(conn, project_skills=[(engines, ["Rust"])])
+    index = recommend.SkillIndex()
+    assert index.candidates(conn, engines) == []
+    skills = index.stats()['skills']
+
+    # "Rust" existed, but "Go" has no column yet
+    _skills(conn, [(bob, ["Rust", "Go"])])
+    index.user_changed(conn, bob)
+    assert [uid for uid, _ in index.candidates(conn, engines)] == [bob]
+    assert index.stats()['rebuilds'] == 2
+    assert index.stats()['skills'] == skills + 1
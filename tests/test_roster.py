@@ -0,0 +1,50 @@
+import io
+
+import pytest
+
+import roster
+from conftest import add_project, add_user
+
+
+def _progress():
+    return roster.Progress("test", out=io.StringIO())
+
+
+def test_projects_with_unknown_creators_are_reported(conn):
+    ada = add_user(conn, "Ada")
+    rows = [(2, {"title": "Engines", "created_by": str(ada)}),
+            (3, {"title": "Ghost", "created_by": "9999"}),
+            (4, {"title": "Nobody", "creator_email": "nobody@test.edu"}),
+            (5, {"title": "Looms", "creator_email": "ada@test.edu"})]
+    progress = _progress()
+
+    roster.import_projects(conn, rows, progress)
+
+    assert progress.counts['inserted'] == 2
+    assert [line for line, _ in progress.errors] == [3, 4]
+    assert "9999" in progress.errors[0][1]
+    assert sorted(t for (t,) in conn.execute("SELECT title FROM projects")) == ["Engines", "Looms"]
+    assert conn.execute("SELECT COUNT(*) FROM project_members WHERE user_id=?", (ada,)).fetchone()[0] == 2
+
+
+def test_memberships_with_unknown_references_are_reported(conn):
+    ada = add_user(conn, "Ada")
+    add_user(conn, "Bob")
+    project_id = add_project(conn, "Engines", ada)
+    rows = [(2, {"email": "bob@test.edu", "project": "Engines"}),
+            (3, {"email": "nobody@test.edu", "project": "Engines"}),
+            (4, {"user_id": "9999", "project_id": str(project_id)}),
+            (5, {"email": "bob@test.edu", "project_id": "9999"})]
+    progress = _progress()
+
+    roster.import_memberships(conn, rows, progress)
+
+    assert progress.counts['inserted'] == 1
+    assert progress.counts['invalid'] == 3
+    assert conn.execute("SELECT COUNT(*) FROM project_members").fetchone()[0] == 2
+
+
+def test_restore_refuses_a_database_with_users(conn, tmp_path):
+    add_user(conn, "Ada")
+    with pytest.raises(roster.RestoreError):
+        roster.restore(conn, str(tmp_path))
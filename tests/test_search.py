@@ -0,0 +1,102 @@
+import pytest
+
+import search
+from conftest import add_user
+
+
+@pytest.fixture
+def projects(conn):
+    ada = add_user(conn, "Ada")
+
+    def add(title, description=""):
+        project_id = conn.execute("INSERT INTO projects (title, description, created_by, created_date) VALUES (?, ?, ?, '2024-01-01')",
+                                  (title, description, ada)).lastrowid
+        conn.commit()
+        return project_id
+    return add
+
+
+def ids(rows):
+    return [row[0] for row in rows]
+
+
+@pytest.mark.parametrize("text, query", [
+    ("robot arm", '"robot"* AND "arm"*'),
+    ('"machine learning" lab', '"machine learning" AND "lab"*'),
+    ('say "hi', '"say"* AND "hi"*'),
+    ("wild* card", '"wild"* AND "card"*'),
+    ("NEAR(a b)", '"NEAR(a"* AND "b)"*'),
+    ("-excluded", '"-excluded"*'),
+    ("cats OR dogs", '"cats"* AND "OR"* AND "dogs"*'),
+    ("OR", '"OR"*'),
+    ('"" * -- ', None),
+    ("", None),
+    (None, None),
+])
+def test_match_query(text, query):
+    assert search.match_query(text) == query
+
+
+@pytest.mark.parametrize("text", ['"', '*', 'NEAR(', 'NEAR(robot', '-', 'OR', 'AND', 'robot OR', '^robot', 'title:robot', '(', ')'])
+def test_operators_in_user_input_never_break_the_query(conn, projects, text):
+    projects("Robot arm")
+    search.search_projects(conn, text)
+
+
+def test_words_match_as_prefixes(conn, projects):
+    robotics = projects("Robotics club", "Building small robots")
+    projects("Gardening", "Tomatoes")
+
+    assert ids(search.search_projects(conn, "rob")[0]) == [robotics]
+    assert ids(search.search_projects(conn, "robot club")[0]) == [robotics]
+    assert search.search_projects(conn, "robot garden")[0] == []
+
+
+def test_phrases_match_exactly(conn, projects):
+    learning = projects("Machine learning lab")
+    projects("Learning to machine parts")
+
+    assert ids(search.search_projects(conn, '"machine learning"')[0]) == [learning]
+
+
+def test_snippet_marks_hits(conn, projects):
+    projects("Weather station", "Collects climate readings from rooftop sensors")
+
+    (row,), _ = search.search_projects(conn, "climate")
+
+    assert "**climate**" in row[6]
+    assert row[5] == "Ada"
+
+
+def test_title_hits_rank_first(conn, projects):
+    in_description = projects("Field notes", "A compilers reading group")
+    in_title = projects("Compilers", "Writing a small language")
+    twice = projects("Compilers compilers", "compilers everywhere")
+
+    rows, _ = search.search_projects(conn, "compilers")
+
+    assert ids(rows) == [twice, in_title, in_description]
+
+
+def test_pages_follow_rank(conn, projects):
+    for n in range(5):
+        projects(f"Quantum {n}", "quantum " * (n + 1))
+    everything = ids(search.search_projects(conn, "quantum")[0])
+
+    seen, cursor = [], None
+    while True:
+        rows, cursor = search.search_projects(conn, "quantum", cursor, page_size=2)
+        seen += ids(rows)
+        if cursor is None:
+            break
+
+    assert seen == everything and len(seen) == 5
+
+
+def test_index_follows_edits(conn, projects):
+    project_id = projects("Old name")
+    conn.execute("UPDATE projects SET title='New name' WHERE id=?", (project_id,))
+    conn.commit()
+
+    assert search.search_projects(conn, "old")[0] == []
+    assert ids(search.search_projects(conn, "new")[0]) == [project_id]
@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+import actions
+import cache
+import db
+import shards
+
+
+@pytest.fixture
+def sharded(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "SHARD_DIR", None)
+    monkeypatch.setattr(db, "_shard_pools", {})
+    monkeypatch.setattr(db, "_pool", db.ConnectionPool(str(tmp_path / "unsharded.db")))
+    monkeypatch.setattr(cache, "KINDS", dict(cache.KINDS))
+    monkeypatch.setattr(cache, "_cache", None)
+    monkeypatch.setattr(shards, "_router", None)
+    shards.enable(str(tmp_path / "shards"))
+    yield tmp_path / "shards"
+    shards.get_router().directory.close()
+    for pool in db._shard_pools.values():
+        pool.close()
+
+
+def test_shard_key():
+    assert shards.shard_key("ada@cs.mit.edu") == "mit.edu"
+    assert shards.shard_key("bob@maths.ox.ac.uk") == "ox.ac.uk"
+    assert shards.shard_key("eve@localhost", "Open University") == "open-university"
+    assert shards.shard_key("", None) == shards.DEFAULT_SHARD
+
+
+def test_users_and_projects_route_to_their_institution(sharded):
+    ada = actions.register("Ada", "ada@cs.mit.edu", "MIT", "Student")
+    bob = actions.register("Bob", "bob@maths.ox.ac.uk", "Oxford", "Student")
+    router = shards.get_router()
+
+    assert router.keys() == ["mit.edu", "ox.ac.uk"]
+    assert router.locate('user', ada) == "mit.edu" and router.locate('user', bob) == "ox.ac.uk"
+    assert actions.login("ada@cs.mit.edu") == ada
+    assert sorted(name for name in os.listdir(sharded) if name.endswith(".db")) == [
+        "directory.db", "mit.edu.db", "ox.ac.uk.db"]
+
+    shards.bind(ada)
+    with db.connection() as conn:
+        engines = actions.create_project(conn, ada, "Engines", "")
+    shards.bind(bob)
+    with db.connection() as conn:
+        looms = actions.create_project(conn, bob, "Looms", "")
+    assert router.locate('project', engines) == "mit.edu" and router.locate('project', looms) == "ox.ac.uk"
+    assert engines != looms
+
+    # Bob joins Ada's project from his own shard: his row is copied over
+    with shards.project_connection(engines) as conn:
+        assert actions.join_project(conn, bob, engines)
+        assert conn.execute("SELECT name FROM users WHERE id=?", (bob,)).fetchone() == ("Bob",)
+    with db.connection() as conn:
+        assert cache.get_cache().member_of(conn, bob) == {engines, looms}
+        assert [row[0] for row in shards.my_projects(conn, bob)] == sorted([engines, looms])
+        rows, _ = shards.browse_projects(conn)
+    assert [row[1] for row in rows] == ["Looms", "Engines"]
+    with pytest.raises(actions.NotFound):
+        with shards.project_connection(9999):
+            pass
+
+
+def test_sharding_leaves_the_single_database_alone(sharded, tmp_path):
+    actions.register("Ada", "ada@cs.mit.edu", "MIT", "Student")
+    assert not os.path.exists(tmp_path / "unsharded.db")
+
+
+def test_enable_routes_the_lookup_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "SHARD_DIR", None)
+    monkeypatch.setattr(cache, "KINDS", dict(cache.KINDS))
+    monkeypatch.setattr(shards, "_router", None)
+    assert cache.KINDS['user'][1] is cache.LOCAL_LOADERS['user']
+
+    shards.main(["--dir", str(tmp_path / "cli"), "status"])
+
+    assert db.SHARD_DIR == str(tmp_path / "cli")
+    assert cache.KINDS['user'][1] is not cache.LOCAL_LOADERS['user']
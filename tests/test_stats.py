@@ -0,0 +1,68 @@
+import stats
+from conftest import add_project, add_user
+
+
+def _counts(conn):
+    users = [(row[0], row[5], row[6]) for row in stats.user_directory(conn, page_size=100)[0]]
+    projects = conn.execute("SELECT project_id, member_count, lines_of_code FROM project_stats ORDER BY project_id").fetchall()
+    return users, projects
+
+
+def _save_code(conn, project_id, user_id, code):
+    conn.execute("INSERT INTO project_code (project_id, code) VALUES (?, ?) "
+                 "ON CONFLICT(project_id) DO UPDATE SET code=excluded.code", (project_id, code))
+    stats.code_saved(conn, project_id, user_id, code, "2024-02-01 10:00:00")
+    conn.commit()
+
+
+def test_triggers_count_members_and_lines(conn):
+    ada, bob, cy = add_user(conn, "Ada"), add_user(conn, "Bob"), add_user(conn, "Cy")
+    engines = add_project(conn, "Engines", ada, members=[bob])
+    _save_code(conn, engines, ada, "a = 1\nb = 2\nc = 3\n")
+
+    assert _counts(conn) == ([(ada, 1, 3), (bob, 1, 3), (cy, 0, 0)], [(engines, 2, 3)])
+
+    # Joining picks up the project's lines; saving moves every member's total
+    conn.execute("INSERT INTO project_members (project_id, user_id) VALUES (?, ?)", (engines, cy))
+    _save_code(conn, engines, bob, "a = 1\n")
+    assert _counts(conn) == ([(ada, 1, 1), (bob, 1, 1), (cy, 1, 1)], [(engines, 3, 1)])
+
+    conn.execute("DELETE FROM project_members WHERE project_id=? AND user_id=?", (engines, bob))
+    conn.commit()
+    assert _counts(conn) == ([(ada, 1, 1), (bob, 0, 0), (cy, 1, 1)], [(engines, 2, 1)])
+
+
+def test_chat_and_messages_touch_last_activity(conn):
+    ada = add_user(conn, "Ada")
+    engines = add_project(conn, "Engines", ada)
+    conn.execute("INSERT INTO project_chat (project_id, sender_id, message, sent_date) VALUES (?, ?, 'hi', '2030-01-01 09:00:00')",
+                 (engines, ada))
+    conn.commit()
+    assert stats.user_rows(conn, [ada])[0][7] == "2030-01-01 09:00:00"
+    conn.execute("INSERT INTO messages (project_id, sender_id, message, sent_date) VALUES (?, ?, 'hi', '2030-01-02 09:00:00')",
+                 (engines, ada))
+    conn.commit()
+    assert stats.user_rows(conn, [ada])[0][7] == "2030-01-02 09:00:00"
+    assert conn.execute("SELECT last_activity FROM project_stats WHERE project_id=?", (engines,)).fetchone() == (
+        "2030-01-02 09:00:00",)
+
+
+# Whatever the triggers have built up, rebuild() arrives at the same counts
+def test_rebuild_matches_triggers(conn):
+    users = [add_user(conn, name) for name in ("Ada", "Bob", "Cy", "Dee")]
+    engines = add_project(conn, "Engines", users[0], members=users[1:3])
+    looms = add_project(conn, "Looms", users[1], members=[users[3]])
+    add_project(conn, "Empty", users[2])
+    _save_code(conn, engines, users[0], "x\n" * 7)
+    _save_code(conn, looms, users[1], "y\n" * 4)
+    _save_code(conn, engines, users[1], "x\n" * 5)
+    conn.execute("DELETE FROM project_members WHERE project_id=? AND user_id=?", (engines, users[2]))
+    conn.execute("INSERT INTO project_members (project_id, user_id) VALUES (?, ?)", (looms, users[0]))
+    conn.commit()
+
+    by_triggers = _counts(conn)
+    conn.execute("BEGIN IMMEDIATE")
+    stats.rebuild(conn)
+    conn.commit()
+    assert _counts(conn) == by_triggers
+    assert by_triggers[0] == [(users[0], 2, 9), (users[1], 2, 9), (users[2], 1, 0), (users[3], 1, 4)]
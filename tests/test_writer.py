@@ -0,0 +1,73 @@
+import sqlite3
+import time
+
+import pytest
+
+import db
+import writer
+from conftest import add_project, add_user
+
+SEND = "INSERT INTO project_chat (project_id, sender_id, message, sent_date) VALUES (?, ?, ?, '2024-03-01 10:00:00')"
+
+
+@pytest.fixture
+def writes(conn):
+    # A long linger so everything submitted below lands in one batch
+    writes = writer.WriteBehind(db.get_pool(), linger=0.3)
+    yield writes
+    writes.flush()
+
+
+def chat(conn, project_id):
+    return [row[0] for row in conn.execute("SELECT message FROM project_chat WHERE project_id=? ORDER BY id", (project_id,))]
+
+
+def test_a_bad_write_fails_alone(conn, writes):
+    ada = add_user(conn, "Ada")
+    project_id = add_project(conn, "Engines", ada)
+
+    futures = [writes.submit(SEND, (project_id, ada, "first")),
+               writes.submit(SEND, (project_id + 100, ada, "no such project")),
+               writes.submit(SEND, (project_id, ada, "last"), result=True)]
+
+    assert futures[0].result(5) is None
+    with pytest.raises(sqlite3.IntegrityError):
+        futures[1].result(5)
+    assert futures[2].result(5)[1] == 1
+    assert chat(conn, project_id) == ["first", "last"]
+    metrics = writes.metrics()
+    assert (metrics['batches'], metrics['retried_batches'], metrics['written'], metrics['failed']) == (1, 1, 2, 1)
+
+
+def test_the_writer_keeps_going_after_a_failed_write(conn, writes):
+    ada = add_user(conn, "Ada")
+    project_id = add_project(conn, "Engines", ada)
+
+    with pytest.raises(sqlite3.OperationalError):
+        writes.execute("INSERT INTO no_such_table VALUES (1)")
+    lastrowid, rowcount = writes.execute(SEND, (project_id, ada, "still here"), result=True)
+
+    assert rowcount == 1
+    assert chat(conn, project_id) == ["still here"]
+
+
+def test_a_full_queue_rejects_instead_of_piling_up(conn):
+    writes = writer.WriteBehind(db.get_pool(), max_queued=1)
+    ada = add_user(conn, "Ada")
+    project_id = add_project(conn, "Engines", ada)
+    writes.flush()
+    # Hold the write lock so the writer can't drain the queue
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        writes.submit(SEND, (project_id, ada, "taken by the writer"))
+        deadline = time.monotonic() + 5
+        while writes.metrics()['queue_depth'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        writes.submit(SEND, (project_id, ada, "queued"))
+        with pytest.raises(writer.QueueFull):
+            writes.submit(SEND, (project_id, ada, "rejected"), timeout=0.1)
+    finally:
+        conn.rollback()
+    writes.flush(timeout=15)
+    assert chat(conn, project_id) == ["taken by the writer", "queued"]
+    assert writes.metrics()['rejected'] == 1
@@ -0,0 +1,208 @@
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from itertools import groupby
+
+import db
+
+MAX_QUEUED = 2000
+MAX_BATCH = 500
+# How long the writer waits for more writes before committing a small batch.
+# Zero: whatever queued up during the previous commit is batch enough
+LINGER = 0
+# How long a caller waits for room in a full queue before giving up
+PUT_TIMEOUT = 2
+
+
+class QueueFull(Exception):
+    pass
+
+
+# One write: a statement and its parameters. Intents that need their own
+# result (lastrowid/rowcount) run one at a time; the rest are grouped by SQL
+# and run with executemany.
+class WriteIntent:
+    __slots__ = ('sql', 'params', 'result', 'future', 'queued_at')
+
+    def __init__(self, sql, params, result):
+        self.sql = sql
+        self.params = params
+        self.result = result
+        self.future = Future()
+        self.queued_at = time.perf_counter()
+
+
+# A single writer thread that owns all the small, frequent writes (chat,
+# messages, memberships, file metadata). Whatever arrives while one commit
+# is in flight goes into the next transaction together, so a burst of a
+# hundred sends costs a handful of commits instead of a hundred sessions
+# queueing on SQLite's write lock.
+class WriteBehind:
+    def __init__(self, pool=None, max_queued=MAX_QUEUED, max_batch=MAX_BATCH, linger=LINGER):
+        self.pool = pool or db.get_pool()
+        self.max_batch = max_batch
+        self.linger = linger
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._counts = {'submitted': 0, 'written': 0, 'failed': 0, 'rejected': 0, 'batches': 0, 'retried_batches': 0}
+        self._batch_sizes = deque(maxlen=500)
+        self._commit_times = deque(maxlen=500)
+        self._waits = deque(maxlen=500)
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    # Queue a write; the Future resolves once it is committed, to
+    # (lastrowid, rowcount) if `result` was asked for and None otherwise.
+    # Blocks for up to `timeout` seconds when the queue is full, then raises
+    # QueueFull, so a burst slows callers down instead of piling up.
+    def submit(self, sql, params=(), result=False, timeout=PUT_TIMEOUT):
+        intent = WriteIntent(sql, params, result)
+        try:
+            self._queue.put(intent, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self._counts['rejected'] += 1
+            raise QueueFull("The server is busy saving other changes; please try again in a moment.")
+        with self._lock:
+            self._counts['submitted'] += 1
+        return intent.future
+
+    # submit() and wait for the commit
+    def execute(self, sql, params=(), result=False):
+        return self.submit(sql, params, result).result()
+
+    # Wait until everything queued so far is committed
+    def flush(self, timeout=None):
+        barrier = self.submit(None, timeout=timeout)
+        barrier.result(timeout)
+
+    def _take_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.linger
+        while len(batch) < self.max_batch:
+            try:
+                remaining = deadline - time.perf_counter()
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            try:
+                self._conn = self.pool.connect()
+                break
+            except sqlite3.Error:
+                time.sleep(1)
+        while True:
+            batch = self._take_batch()
+            writes = [intent for intent in batch if intent.sql is not None]
+            if writes:
+                self._write(writes)
+            for intent in batch:
+                if intent.sql is None:
+                    intent.future.set_result(None)
+
+    def _write(self, batch):
+        started = time.perf_counter()
+        conn = self._conn
+        try:
+            try:
+                results = self._apply(conn, batch)
+            except sqlite3.Error:
+                conn.rollback()
+                with self._lock:
+                    self._counts['retried_batches'] += 1
+                results = self._apply_one_by_one(conn, batch)
+        except Exception as e:
+            # Couldn't even take the write lock or commit: fail the whole batch
+            if conn.in_transaction:
+                conn.rollback()
+            for intent in batch:
+                intent.future.set_exception(e)
+            with self._lock:
+                self._counts['failed'] += len(batch)
+            return
+        committed = time.perf_counter()
+        failed = 0
+        for intent, outcome in zip(batch, results):
+            if isinstance(outcome, Exception):
+                intent.future.set_exception(outcome)
+                failed += 1
+            else:
+                intent.future.set_result(outcome)
+        with self._lock:
+            self._counts['batches'] += 1
+            self._counts['written'] += len(batch) - failed
+            self._counts['failed'] += failed
+            self._batch_sizes.append(len(batch))
+            self._commit_times.append(committed - started)
+            self._waits.extend(committed - intent.queued_at for intent in batch)
+
+    # The whole batch in one transaction. Runs of the same statement that
+    # don't need a result go through executemany.
+    def _apply(self, conn, batch):
+        results = []
+        conn.execute("BEGIN IMMEDIATE")
+        for (sql, needs_result), group in groupby(batch, key=lambda i: (i.sql, i.result)):
+            group = list(group)
+            if needs_result:
+                for intent in group:
+                    c = conn.execute(sql, intent.params)
+                    results.append((c.lastrowid, c.rowcount))
+            else:
+                conn.executemany(sql, [intent.params for intent in group])
+                results.extend([None] * len(group))
+        conn.commit()
+        return results
+
+    # After a failure, find the write(s) at fault: each one gets a savepoint,
+    # so a bad row fails its own future and the rest still commit together
+    def _apply_one_by_one(self, conn, batch):
+        results = []
+        conn.execute("BEGIN IMMEDIATE")
+        for intent in batch:
+            conn.execute("SAVEPOINT intent")
+            try:
+                c = conn.execute(intent.sql, intent.params)
+                results.append((c.lastrowid, c.rowcount) if intent.result else None)
+                conn.execute("RELEASE intent")
+            except sqlite3.Error as e:
+                conn.execute("ROLLBACK TO intent")
+                conn.execute("RELEASE intent")
+                results.append(e)
+        conn.commit()
+        return results
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._counts)
+            sizes = sorted(self._batch_sizes)
+            commit_times = sorted(self._commit_times)
+            waits = sorted(self._waits)
+        metrics['queue_depth'] = self._queue.qsize()
+        metrics['batch_size_avg'] = sum(sizes) / len(sizes) if sizes else 0.0
+        metrics['batch_size_max'] = sizes[-1] if sizes else 0
+        for name, samples in (('commit_time', commit_times), ('wait_time', waits)):
+            metrics[f'{name}_p50'] = samples[len(samples) // 2] if samples else 0.0
+            metrics[f'{name}_p95'] = samples[int(len(samples) * 0.95)] if samples else 0.0
+        return metrics
+
+
+_writers = {}
+_writer_lock = threading.Lock()
+
+
+# One writer per database: the current shard's, when sharded
+def get_writer():
+    pool = db.get_pool()
+    writer = _writers.get(pool)
+    if writer is None:
+        with _writer_lock:
+            writer = _writers.get(pool)
+            if writer is None:
+                writer = _writers[pool] = WriteBehind(pool)
+    return writer